@@ -0,0 +1,158 @@
+"""Notification cost: PropertiesChanged over D-Bus versus an AcquireNotify socket
+
+Serves one notify characteristic against the fake BlueZ on a private bus and
+sends --count values through Characteristic.notify_value both ways:
+
+  dbus    a subscriber in another process receives PropertiesChanged signals
+          routed by the bus daemon, as BlueZ does without AcquireNotify
+  socket  AcquireNotify is called directly and a reader drains the returned
+          SOCK_SEQPACKET socket, as BlueZ does after acquiring the characteristic
+
+For each path it reports the main loop CPU time per notification and the time
+until the receiver has all of them.
+
+Run from the repository root:
+
+    python -m benchmarks.acquire_notify --count 20000
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from utils.core.bletools import BleTools
+from utils.core.fakebluez import FakeBluezProcess
+
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+PAYLOAD_SIZE = 20
+MTU = 23
+
+
+def receive_signals(address, sender, path, count, conn):
+    # Runs in the subscriber process
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    mainloop = GObject.MainLoop()
+    received = [0, None]
+
+    def properties_changed(interface, changed, invalidated):
+        received[0] += 1
+        if received[0] == count:
+            received[1] = time.monotonic()
+            mainloop.quit()
+
+    bus.add_signal_receiver(properties_changed, signal_name="PropertiesChanged",
+                            dbus_interface=DBUS_PROP_IFACE, bus_name=sender, path=path)
+    # Round trip to the daemon so the match rule is installed before "ready"
+    bus.call_blocking("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                      "org.freedesktop.DBus", "GetId", "", [])
+    conn.send("ready")
+    mainloop.run()
+    conn.send(received[1])
+
+
+def receive_socket(fd, count, done):
+    sock = socket.socket(fileno=fd)
+    for _ in range(count):
+        sock.recv(MTU)
+    done.append(time.monotonic())
+    sock.close()
+
+
+def run_dbus(app, chrc, address, count, payloads):
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    subscriber = context.Process(target=receive_signals,
+                                 args=(address, app.bus.get_unique_name(), chrc.path,
+                                       count, child_conn))
+    subscriber.start()
+    parent_conn.recv()
+
+    start = time.monotonic()
+    cpu = time.thread_time()
+    for payload in payloads:
+        chrc.notify_value(payload)
+    cpu = time.thread_time() - cpu
+
+    main_context = GObject.MainContext.default()
+    while not parent_conn.poll():
+        main_context.iteration(False)
+    end = parent_conn.recv()
+    subscriber.join()
+
+    return cpu, end - start
+
+
+def run_socket(chrc, count, payloads):
+    fd, mtu = chrc.AcquireNotify({"mtu": dbus.UInt16(MTU)})
+    done = []
+    # Stands in for bluetoothd; a thread is enough as recv() releases the GIL
+    reader = threading.Thread(target=receive_socket, args=(fd.take(), count, done))
+    reader.start()
+
+    start = time.monotonic()
+    cpu = time.thread_time()
+    for payload in payloads:
+        while not chrc.notify_value(payload, force=True):
+            # Socket buffer full: let the reader catch up, as the main loop would
+            time.sleep(0)
+    cpu = time.thread_time() - cpu
+    reader.join()
+    chrc.release_notify()
+
+    return cpu, done[0] - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000, help="notifications per path")
+    args = parser.parse_args()
+
+    fake = FakeBluezProcess()
+    address = fake.start()
+    BleTools.set_bus(fake.connect())
+
+    from utils.gatt.profile import Application, Service, Characteristic
+
+    class BenchCharacteristic(Characteristic):
+        def __init__(self, service):
+            self.notifying = False
+            Characteristic.__init__(self, "0x2AD2", ["notify"], service)
+
+        def StartNotify(self):
+            self.notifying = True
+
+        def StopNotify(self):
+            self.notifying = False
+
+    app = Application()
+    service = Service(0, "0x1826", True)
+    chrc = BenchCharacteristic(service)
+    service.add_characteristic(chrc)
+    app.add_service(service)
+
+    payloads = [os.urandom(PAYLOAD_SIZE) for _ in range(args.count)]
+    print("%8s %14s %14s %12s" % ("path", "cpu us/notify", "wall ms", "notify/s"))
+    try:
+        for name, run in (("dbus", lambda: run_dbus(app, chrc, address, args.count, payloads)),
+                          ("socket", lambda: run_socket(chrc, args.count, payloads))):
+            cpu, wall = run()
+            print("%8s %14.2f %14.1f %12.0f" % (name, cpu / args.count * 1e6, wall * 1000,
+                                                args.count / wall))
+    finally:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
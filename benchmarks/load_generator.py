@@ -0,0 +1,216 @@
+"""Load generator: N subscribed centrals against the FTMS and heart rate profiles
+
+Runs the GATT server against the fake BlueZ on a private bus. The centrals live in
+a separate process with one bus connection each; every central subscribes to Indoor
+Bike Data and Heart Rate Measurement, and the first one also writes Set Target
+Power to the FTMS control point at --write-hz. For each central count it reports
+notification throughput, end-to-end notification latency percentiles, control
+point round-trip latency and the server process CPU and RSS.
+
+Run from the repository root:
+
+    python -m benchmarks.load_generator --centrals 1 10 100 --notify-ms 250
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from utils.core.bletools import BleTools
+from utils.core.fakebluez import FakeBluezProcess, FakeCentral
+from utils.core.samples import start_producer, SPEED, CADENCE, POWER, HEART_RATE
+
+INDOOR_BIKE_DATA_UUID = "0x2AD2"
+HEART_RATE_MEASUREMENT_UUID = "0x2A37"
+CONTROL_POINT_UUID = "0x2AD9"
+REQUEST_CONTROL = bytes([0x00])
+SET_TARGET_POWER = bytes([0x05, 0xC8, 0x00])  # 200 W
+GRACE = 0.5
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+
+    return float("nan")
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_centrals(address, destination, count, duration, write_hz, conn):
+    # Runs in the centrals process; reports receive times per path and central
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    centrals = [FakeCentral(dbus.bus.BusConnection(address), destination) for _ in range(count)]
+    received = {}
+    write_rtts = []
+
+    for central in centrals:
+        for uuid in (INDOOR_BIKE_DATA_UUID, HEART_RATE_MEASUREMENT_UUID):
+            times = []
+            received.setdefault(central.get_interface(uuid)[0], []).append(times)
+            central.start_notify(uuid, lambda value, times=times: times.append(time.monotonic()))
+
+    controller = centrals[0]
+    controller.write(CONTROL_POINT_UUID, REQUEST_CONTROL)
+    control_point = controller.get_interface(CONTROL_POINT_UUID)[1]
+    writing = [True]
+
+    def write_target_power():
+        sent = time.monotonic()
+        control_point.WriteValue(dbus.Array(SET_TARGET_POWER, signature="y"), controller.options(),
+                                 reply_handler=lambda: write_rtts.append(time.monotonic() - sent),
+                                 error_handler=lambda error: None)
+        return writing[0]
+
+    # Notifications received while subscribing are not part of the measurement
+    for per_central in received.values():
+        for times in per_central:
+            del times[:]
+    conn.send("ready")
+    if write_hz > 0:
+        GObject.timeout_add(int(1000 / write_hz), write_target_power)
+    controller.spin(duration)
+    writing[0] = False
+    controller.spin(GRACE)
+
+    conn.send((received, write_rtts))
+
+
+def record_emissions(chrc, emissions):
+    signal = chrc.PropertiesChanged
+    times = emissions.setdefault(chrc.path, [])
+
+    def properties_changed(interface, changed, invalidated):
+        times.append(time.monotonic())
+        signal(interface, changed, invalidated)
+
+    chrc.PropertiesChanged = properties_changed
+
+
+def run(app, address, count, duration, write_hz, emissions):
+    # Spawned, not forked: a fork would share the server's bus connection
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    centrals = context.Process(target=run_centrals,
+                               args=(address, app.bus.get_unique_name(), count,
+                                     duration, write_hz, child_conn))
+    centrals.start()
+    stats = {}
+
+    def stop():
+        stats["wall"] = time.monotonic() - stats["start"]
+        stats["cpu"] = cpu_seconds() - stats["cpu_start"]
+        app.mainloop.quit()
+        return False
+
+    def wait_ready():
+        if not parent_conn.poll():
+            return True
+
+        parent_conn.recv()
+        for times in emissions.values():
+            del times[:]
+        stats["start"] = time.monotonic()
+        stats["cpu_start"] = cpu_seconds()
+        GObject.timeout_add(int(duration * 1000), stop)
+        return False
+
+    GObject.timeout_add(10, wait_ready)
+    app.run()
+    received, write_rtts = parent_conn.recv()
+    centrals.join()
+
+    latencies = []
+    notifications = 0
+    for path, per_central in received.items():
+        emitted = emissions.get(path, [])
+        for times in per_central:
+            # The server starts its window a poll after "ready"; CLOCK_MONOTONIC is
+            # shared between the processes, so earlier receives can be dropped here
+            times = [got for got in times if got >= stats["start"]]
+            notifications += len(times)
+            # Emission stopped before the centrals stopped listening, so the
+            # last receive matches the last emission
+            for sent, got in zip(reversed(emitted), reversed(times)):
+                latencies.append(got - sent)
+
+    return {
+        "centrals": count,
+        "notify_rate": notifications / stats["wall"],
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "write_p50": percentile(write_rtts, 0.5) * 1000,
+        "write_p99": percentile(write_rtts, 0.99) * 1000,
+        "cpu": stats["cpu"] / stats["wall"] * 100,
+        "rss": rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--centrals", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--notify-ms", type=int, default=1000, help="notification interval")
+    parser.add_argument("--write-hz", type=float, default=4.0, help="control point writes per second")
+    args = parser.parse_args()
+
+    fake = FakeBluezProcess()
+    fake.start()
+    BleTools.set_bus(fake.connect())
+
+    import fitness_machine
+    import heart_rate
+    fitness_machine.NOTIFY_TIMEOUT = args.notify_ms
+    heart_rate.NOTIFY_TIMEOUT = args.notify_ms
+
+    for channel, value in ((SPEED, 25.0), (CADENCE, 90.0), (POWER, 180), (HEART_RATE, 120)):
+        start_producer(channel, lambda value=value: value, 10)
+
+    from utils.gatt.profile import Application
+    app = Application()
+    app.add_service(fitness_machine.HERLFitnessMachineService(1))
+    app.add_service(heart_rate.HERLHeartRateService(2))
+    app.register()
+
+    emissions = {}
+    for service in app.services:
+        for chrc in service.get_characteristics():
+            record_emissions(chrc, emissions)
+
+    print("%8s %12s %9s %9s %9s %11s %11s %7s %8s" % (
+        "centrals", "notify/s", "p50 ms", "p95 ms", "p99 ms", "write p50", "write p99", "cpu %", "rss MB"))
+    try:
+        for count in args.centrals:
+            result = run(app, fake.address, count, args.duration, args.write_hz, emissions)
+            print("%(centrals)8d %(notify_rate)12.1f %(p50)9.2f %(p95)9.2f %(p99)9.2f "
+                  "%(write_p50)11.2f %(write_p99)11.2f %(cpu)7.1f %(rss)8.1f" % result)
+    finally:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
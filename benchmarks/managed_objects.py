@@ -0,0 +1,69 @@
+"""Microbenchmark for Application.GetManagedObjects against object tree size
+
+Run from the repository root: python -m benchmarks.managed_objects
+"""
+import timeit
+
+from utils.gatt.profile import Application, Service, Characteristic, Descriptor
+
+CHARACTERISTICS_PER_SERVICE = 8
+DESCRIPTORS_PER_CHARACTERISTIC = 2
+SERVICE_COUNTS = (1, 4, 16, 64)
+CALLS = 200
+
+
+class BenchDescriptor(Descriptor):
+    def __init__(self, characteristic):
+        Descriptor.__init__(self, "2901", ["read"], characteristic)
+
+
+class BenchCharacteristic(Characteristic):
+    def __init__(self, service):
+        Characteristic.__init__(self, "0x2A37", ["read", "notify"], service)
+        for _ in range(DESCRIPTORS_PER_CHARACTERISTIC):
+            self.add_descriptor(BenchDescriptor(self))
+
+
+class BenchService(Service):
+    PATH_BASE = "/org/bluez/bench/service"
+
+    def __init__(self, index):
+        Service.__init__(self, index, "0x180D", True)
+        for _ in range(CHARACTERISTICS_PER_SERVICE):
+            self.add_characteristic(BenchCharacteristic(self))
+
+
+def uncached(app):
+    # Drop every level of the cache so each call rebuilds the whole tree
+    for service in app.services:
+        for chrc in service.characteristics:
+            chrc.managed_objects = None
+        service.managed_objects = None
+    app.invalidate()
+    return app.GetManagedObjects()
+
+
+def main():
+    app = Application()
+    next_index = 0
+
+    print("%8s %8s %14s %14s %14s" % ("services", "objects", "uncached (us)", "cached (us)", "1 add (us)"))
+    for count in SERVICE_COUNTS:
+        while len(app.services) < count:
+            app.add_service(BenchService(next_index))
+            next_index += 1
+
+        objects = len(uncached(app))
+        cold = timeit.timeit(lambda: uncached(app), number=CALLS) / CALLS
+        warm = timeit.timeit(app.GetManagedObjects, number=CALLS) / CALLS
+
+        # Cost of the first call after a descriptor is added to one characteristic
+        chrc = app.services[0].characteristics[0]
+        chrc.add_descriptor(BenchDescriptor(chrc))
+        incremental = timeit.timeit(app.GetManagedObjects, number=1)
+
+        print("%8d %8d %14.1f %14.1f %14.1f" % (count, objects, cold * 1e6, warm * 1e6, incremental * 1e6))
+
+
+if __name__ == '__main__':
+    main()
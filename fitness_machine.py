@@ -1,13 +1,26 @@
 import random
 
-import dbus
-
+from utils.core.bletools import BLUEZ_SERVICE_NAME, DBUS_PROP_IFACE
+from utils.core.log import get_logger, setup_logging
+from utils.core.samples import sensors, start_producer, SPEED, CADENCE, POWER
+from utils.core.ftms import encode_indoor_bike_data, IBD_INSTANTANEOUS_CADENCE, IBD_INSTANTANEOUS_POWER
+from utils.core.ftms import ControlPointEngine
 from utils.gap.advertisement import Advertisement
-from utils.gatt.profile import Application, Service, Characteristic, Descriptor
+from utils.gatt.profile import Application, Service, Characteristic, StaticCharacteristic
 
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+DEVICE_IFACE = "org.bluez.Device1"
 NOTIFY_TIMEOUT = 1000
-import struct
+# Resend an unchanged status after this many suppressed notifications
+KEEPALIVE_TICKS = 30
+
+# Advertised by the standalone script and merged into the launcher's advertisement
+SERVICE_UUIDS = ["0x1818", "0x1826"]
+# Set flags (8 bits) little endian represented with decimal 1, fitness machine (16 bits) little endian
+# represented with decimal numbers 32 and 0
+SERVICE_DATA = {"0x1826": bytes([1, 32, 0])}
+
+log = get_logger("ftms")
 
 
 class HERLParacycleAdvertisement(Advertisement):
@@ -15,11 +28,10 @@ class HERLParacycleAdvertisement(Advertisement):
         Advertisement.__init__(self, index, "peripheral")
         self.add_local_name("HERL FM")
         self.include_tx_power = True
-        self.add_service_uuid("0x1818")
-        self.add_service_uuid("0x1826")
-        # Set flags (8 bits) little endian represented with decimal 1, fitness machine (16 bits) little endian
-        # represented with decimal numbers 32 and 0
-        self.add_service_data("0x1826", bytes([1, 32, 0]))
+        for uuid in SERVICE_UUIDS:
+            self.add_service_uuid(uuid)
+        for uuid, data in SERVICE_DATA.items():
+            self.add_service_data(uuid, data)
 
 
 class HERLFitnessMachineService(Service):
@@ -27,26 +39,24 @@ class HERLFitnessMachineService(Service):
 
     def __init__(self, index):
         Service.__init__(self, index, self.HERL_FITNESS_MACHINE_UUID, True)
+        self.engine = ControlPointEngine(self.machine_status_changed)
         self.add_characteristic(FitnessMachineFeature(self))
         self.add_characteristic(TrainingStatus(self))
         self.add_characteristic(FitnessMachineControlPoint(self))
-        self.add_characteristic(FitnessMachineStatus(self))
+        self.machine_status = FitnessMachineStatus(self)
+        self.add_characteristic(self.machine_status)
         self.add_characteristic(IndoorBikeData(self))
         self.add_characteristic(SupportedResistanceLevelRange(self))
         self.add_characteristic(SupportedPowerRange(self))
 
+    def machine_status_changed(self, value):
+        self.machine_status.push_status(value)
+
 
-class FitnessMachineFeature(Characteristic):
+class FitnessMachineFeature(StaticCharacteristic):
     FITNESS_MACHINE_FEATURE_CHARACTERISTIC_UUID = "0x2ACC"
 
     def __init__(self, service):
-        self.notifying = False
-
-        Characteristic.__init__(
-            self, self.FITNESS_MACHINE_FEATURE_CHARACTERISTIC_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
         #                          <---------------------------------- read from left to right
         # fitnessMachineFeatures = 00000000 00000000 01000000 00000011
         #                          <---------------------------------- read from left to right
@@ -56,7 +66,9 @@ class FitnessMachineFeature(Characteristic):
         # Flags set based on Fitness Machine Service specification
         # Refer to: https://www.bluetooth.com/specifications/specs/fitness-machine-service-1-0/
         # using the decimal value for each octet above to build a list and convert to bytes
-        return bytes([3, 64, 0, 0, 12, 224, 0, 0])
+        StaticCharacteristic.__init__(
+            self, self.FITNESS_MACHINE_FEATURE_CHARACTERISTIC_UUID,
+            [3, 64, 0, 0, 12, 224, 0, 0], service)
 
 
 class TrainingStatus(Characteristic):
@@ -68,14 +80,14 @@ class TrainingStatus(Characteristic):
         Characteristic.__init__(
             self, self.TRAINING_STATUS_CHARACTERISTIC_UUID,
             ["notify", "read"], service)
+        self.set_change_only(keepalive=KEEPALIVE_TICKS)
 
     def ReadValue(self, options):
         return bytes([2])
 
     def set_training_status_callback(self):
         if self.notifying:
-            value = bytes([2])
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+            self.notify_value(bytes([2]))
 
         return self.notifying
 
@@ -84,11 +96,12 @@ class TrainingStatus(Characteristic):
             return
 
         self.notifying = True
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": bytes([2])}, [])
+        self.notify_value(bytes([2]), force=True)
         self.add_timeout(NOTIFY_TIMEOUT, self.set_training_status_callback)
 
     def StopNotify(self):
         self.notifying = False
+        self.remove_timeout()
 
 
 class FitnessMachineControlPoint(Characteristic):
@@ -96,59 +109,55 @@ class FitnessMachineControlPoint(Characteristic):
 
     def __init__(self, service):
         self.notifying = False
+        self.watched_owner = None
+        self.owner_match = None
 
         Characteristic.__init__(
             self, self.FITNESS_MACHINE_CONTROL_POINT_CHARACTERISTIC_UUID,
             ["indicate", "write"], service)
 
     def WriteValue(self, value, options):
-        print("Received Value:")
-        print(value)
-        # get value from dbus array: dbus.Array([dbus.Byte(0)], signature=dbus.Signature('y'))
-        byte_array = [bytes([v]).hex() for v in value]
-
-        if len(byte_array) > 0:
-            case = byte_array[0]
-            print("Byte value")
-            print(case)
-            if case == "00":
-                # send ok
-                print("Sending ack OK")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(b"\x00"), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            elif case == "01":
-                print("Sending ack Reset")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(b"\x00"), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            elif case == "02":
-                print("Sending ack Speed")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(b"\xFA"), dbus.Byte(b"\x00"), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            elif case == "05":
-                print("Sending ack Target Power")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(b"\x3C"), dbus.Byte(b"\x00"), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            elif case == "07":
-                print("Sending ack Start/Resume")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(b"\x07"), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            elif case == "08":
-                print("Sending ack Stop/Pause")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(b"\x02"), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            elif case == "11":
-                print("Sending ack Simulation Params")
-                data_array = [dbus.Byte(b"\x80"), dbus.Byte(17), dbus.Byte(0), dbus.Byte(0), dbus.Byte(231), dbus.Byte(0), dbus.Byte(40), dbus.Byte(b"\x01")]
-                self.Indicate(data_array)
-            else:
-                print(case)
-                print("Not implemented")
-        else:
-            print("Received empty array")
+        engine = self.service.engine
+        response = engine.handle(bytes(value), options.get("device"))
+        log.debug("Control point request %s -> %s", bytes(value), response)
+        if response is not None:
+            self.Indicate(response)
+        self.watch_owner(engine.owner)
+        engine.flush()
+
+    def watch_owner(self, device):
+        # Follows the Connected property of the central in control, so control is
+        # released when it goes away instead of locking everyone else out
+        if device == self.watched_owner:
+            return
+
+        if self.owner_match is not None:
+            self.owner_match.remove()
+            self.owner_match = None
+        self.watched_owner = device
+
+        bus = self.get_bus()
+        if device is None or bus is None:
+            return
+
+        self.owner_match = bus.add_signal_receiver(
+            lambda interface, changed, invalidated: self.owner_changed(device, changed),
+            signal_name="PropertiesChanged", dbus_interface=DBUS_PROP_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME, path=device, arg0=DEVICE_IFACE)
+
+    def owner_changed(self, device, changed):
+        if changed.get("Connected", True):
+            return
+
+        engine = self.service.engine
+        if engine.release_control(device):
+            log.info("%s disconnected, control released", device)
+        self.watch_owner(engine.owner)
+        engine.flush()
 
     # Used to indicate
     def Indicate(self, value):
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+        self.notify_value(value)
 
 
 class FitnessMachineStatus(Characteristic):
@@ -161,21 +170,13 @@ class FitnessMachineStatus(Characteristic):
             self, self.FITNESS_MACHINE_STATUS_CHARACTERISTIC_UUID,
             ["notify"], service)
 
-    # Todo: Set proper status values based on BLE specification
-    def set_fitness_machine_status_callback(self):
+    def push_status(self, value):
+        # Status is event only: each change is notified once, when it happens
         if self.notifying:
-            value = bytes([2])
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-
-        return self.notifying
+            self.notify_value(value)
 
     def StartNotify(self):
-        if self.notifying:
-            return
-
         self.notifying = True
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": bytes([2])}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.set_fitness_machine_status_callback)
 
     def StopNotify(self):
         self.notifying = False
@@ -183,6 +184,8 @@ class FitnessMachineStatus(Characteristic):
 
 class IndoorBikeData(Characteristic):
     INDOOR_BIKE_DATA_CHARACTERISTIC_UUID = "0x2AD2"
+    # Instantaneous speed (bit 0 cleared), instantaneous cadence and instantaneous power
+    FLAGS = IBD_INSTANTANEOUS_CADENCE | IBD_INSTANTANEOUS_POWER
 
     def __init__(self, service):
         self.notifying = False
@@ -191,44 +194,19 @@ class IndoorBikeData(Characteristic):
             self, self.INDOOR_BIKE_DATA_CHARACTERISTIC_UUID,
             ["read", "notify"], service)
 
-    def get_indoor_bike_data_packed(self):
-        bike_data = self.get_indoor_bike_data()
-        data_array = []
-        for byte in bike_data:
-            data_array.append(dbus.Byte(byte))
-
-        return data_array
+    def get_sample(self):
+        return {
+            "speed": sensors.latest(SPEED, 0),
+            "cadence": sensors.latest(CADENCE, 0),
+            "power": sensors.latest(POWER, 0),
+        }
 
     def get_indoor_bike_data(self):
-        value = []
-        flags = [68, 0]  # b'\xe0'
-        value.extend(flags)
-
-        # Add the instantaneous speed
-        speed_oct1 = random.randrange(250, 255)
-        ins_speed = [109, 2]
-        value.extend(ins_speed)
-
-        # Add the instantaneous cadence
-        cadence_oct1 = random.randrange(100, 150)
-        ins_cadence = [84, 0]
-        value.extend(ins_cadence)
-
-        # Add the instantaneous power
-        pow_oct1 = random.randrange(5, 16)
-        ins_power = [51, 0]
-        value.extend(ins_power)
-
-        # print("indoor_bike_data")
-        # print(value)
-
-        # bytes([68, 0, 250, 1, 0, 0, 0, 0])
-        return bytes(value)
+        return encode_indoor_bike_data(self.FLAGS, self.get_sample())
 
     def set_bike_data_callback(self):
         if self.notifying:
-            value = self.get_indoor_bike_data_packed()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+            self.notify_value(self.get_indoor_bike_data())
 
         return self.notifying
 
@@ -237,62 +215,74 @@ class IndoorBikeData(Characteristic):
             return
 
         self.notifying = True
-        value = self.get_indoor_bike_data_packed()
-
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+        self.notify_value(self.get_indoor_bike_data(), force=True)
         self.add_timeout(NOTIFY_TIMEOUT, self.set_bike_data_callback)
 
     def StopNotify(self):
         self.notifying = False
+        self.remove_timeout()
 
     def ReadValue(self, options):
-        print("Reading Bike Data")
         value = self.get_indoor_bike_data()
-        print("Bike Data")
-        print(value)
+        log.debug("Indoor bike data read: %s", value)
 
         return value
 
 
-class SupportedResistanceLevelRange(Characteristic):
+class SupportedResistanceLevelRange(StaticCharacteristic):
     SUPPORTED_RESISTANCE_LEVEL_CHARACTERISTIC_UUID = "0x2AD6"
 
     def __init__(self, service):
-        self.notifying = False
-
-        Characteristic.__init__(
+        # minimum 0, maximum 100, increment 1 (uint16 little endian each)
+        StaticCharacteristic.__init__(
             self, self.SUPPORTED_RESISTANCE_LEVEL_CHARACTERISTIC_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
-        minvalue = 0
-        maxvalue = 100
-        inc = 1
-        payload = [0, 0, 100, 0, 1, 0]
-        return bytes(payload)
+            [0, 0, 100, 0, 1, 0], service)
 
 
-class SupportedPowerRange(Characteristic):
+class SupportedPowerRange(StaticCharacteristic):
     SUPPORTED_POWER_RANGE_CHARACTERISTIC_UUID = "0x2AD8"
 
     def __init__(self, service):
-        self.notifying = False
-
-        Characteristic.__init__(
-            self, self.SUPPORTED_POWER_RANGE_CHARACTERISTIC_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
         # min_power = 00000000 00000000 (0 W)
         # max_power = 00000111 11010000 (2000 W)
         # power_increments = 00000000 00000001 (1 W)
-        power = [0, 0, 208, 7, 1, 0]
-        return bytes(power)
+        StaticCharacteristic.__init__(
+            self, self.SUPPORTED_POWER_RANGE_CHARACTERISTIC_UUID,
+            [0, 0, 208, 7, 1, 0], service)
+
+
+def add_services(app, index, options=None):
+    app.add_service(HERLFitnessMachineService(index))
+
+    return index + 1
+
+
+def attach_replay(app, replay):
+    # Replayed Fitness Machine Status changes are sent from the main loop
+    for service in app.services:
+        if isinstance(service, HERLFitnessMachineService):
+            replay.add_status_listener(
+                lambda value, service=service: Characteristic.scheduler.timer_add(
+                    0, lambda: service.machine_status_changed(value)))
+
+
+def start_sensors(options=None):
+    if getattr(options, "replay", None):
+        # The launcher's RideReplay feeds the bike channels
+        return
+
+    # Simulated bike until real sensor readers are attached
+    start_producer(SPEED, lambda: random.uniform(20, 30), 4)
+    start_producer(CADENCE, lambda: random.uniform(80, 95), 4)
+    start_producer(POWER, lambda: random.randrange(150, 200), 4)
 
 
 if __name__ == '__main__':
+    setup_logging()
+    start_sensors()
+
     app = Application()
-    app.add_service(HERLFitnessMachineService(1))
+    add_services(app, 1)
     app.register()
 
     adv = HERLParacycleAdvertisement(0)
@@ -21,16 +21,27 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import random
+import struct
 
 import dbus
 
 from utils.gap.advertisement import Advertisement
-from utils.gatt.profile import Application, Service, Characteristic, Descriptor
-from gpiozero import CPUTemperature
-import math
+from utils.gatt.profile import Application, Service, Characteristic, FailedException
+from utils.gatt.profile import StaticCharacteristic, CharacteristicUserDescriptionDescriptor
+from utils.core.log import get_logger, setup_logging
+from utils.core.samples import sensors, start_producer, HEART_RATE, RR_INTERVAL, ENERGY_EXPENDED, SENSOR_CONTACT
+from utils.core.hrm import encode_heart_rate_measurement, DEFAULT_MTU, HRCP_RESET_ENERGY_EXPENDED
 
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
 NOTIFY_TIMEOUT = 1000
+# RR-Intervals waiting for a notification beyond this are dropped, oldest first
+RR_BACKLOG = 64
+
+# Advertised by the standalone script and merged into the launcher's advertisement
+SERVICE_UUIDS = ["0x180D"]
+SERVICE_DATA = {}
+
+log = get_logger("hrm")
 
 
 class HERLParacycleAdvertisement(Advertisement):
@@ -38,7 +49,8 @@ class HERLParacycleAdvertisement(Advertisement):
         Advertisement.__init__(self, index, "peripheral")
         self.add_local_name("HERL HRM")
         self.include_tx_power = True
-        self.add_service_uuid("0x180D")
+        for uuid in SERVICE_UUIDS:
+            self.add_service_uuid(uuid)
 
 
 class GenericAccess(Service):
@@ -51,55 +63,36 @@ class GenericAccess(Service):
         self.add_characteristic(PeripheralPreferredConnectionCharacteristic(self))
 
 
-class DeviceNameCharacteristic(Characteristic):
+class DeviceNameCharacteristic(StaticCharacteristic):
     DeviceNameCharacteristic_UUID = "0x2A00"
 
     def __init__(self, service):
-        Characteristic.__init__(
+        StaticCharacteristic.__init__(
             self, self.DeviceNameCharacteristic_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
-        value = []
-
-        val = "HERL HR"
-        value.append(dbus.Byte(val.encode()))
-
-        return value
+            "HERL HR", service)
 
 
-class AppearanceCharacteristic(Characteristic):
+class AppearanceCharacteristic(StaticCharacteristic):
     DeviceNameCharacteristic_UUID = "0x2A01"
+    # Heart Rate Sensor: Heart Rate Belt
+    APPEARANCE = 833
 
     def __init__(self, service):
-        Characteristic.__init__(
+        StaticCharacteristic.__init__(
             self, self.DeviceNameCharacteristic_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
-        value = []
+            struct.pack("<H", self.APPEARANCE), service)
 
-        val = bytes([833])
-        value.append(dbus.Byte(val))
 
-        return value
-
-
-class PeripheralPreferredConnectionCharacteristic(Characteristic):
+class PeripheralPreferredConnectionCharacteristic(StaticCharacteristic):
     PeripheralPreferredCharacteristic_UUID = "0x2A04"
+    # Minimum and maximum connection interval, peripheral latency and supervision
+    # timeout; 0xFFFF means no specific preference
+    NO_PREFERENCE = 0xFFFF
 
     def __init__(self, service):
-        Characteristic.__init__(
+        StaticCharacteristic.__init__(
             self, self.PeripheralPreferredCharacteristic_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
-        value = []
-
-        val = bytes([833])
-        value.append(dbus.Byte(val))
-
-        return value
+            struct.pack("<HHHH", *[self.NO_PREFERENCE] * 4), service)
 
 
 class HERLHeartRateService(Service):
@@ -107,15 +100,27 @@ class HERLHeartRateService(Service):
 
     def __init__(self, index):
         self.units = "BPM"
+        self.energy_offset = 0
 
         Service.__init__(self, index, self.HERL_HEART_RATE_SVC_UUID, True)
         self.add_characteristic(HeartRateMeasurementCharacteristic(self))
         self.add_characteristic(BodySensorLocation(self))
+        self.add_characteristic(HeartRateControlPoint(self))
         self.add_characteristic(HeartRateUnitCharacteristic(self))
 
     def get_units(self):
         return self.units
 
+    def get_energy(self):
+        energy = sensors.latest(ENERGY_EXPENDED)
+        if energy is None:
+            return None
+
+        return max(0, energy - self.energy_offset)
+
+    def reset_energy(self):
+        self.energy_offset = sensors.latest(ENERGY_EXPENDED, 0)
+
 
 class HeartRateMeasurementCharacteristic(Characteristic):
     HEARTRATE_CHARACTERISTIC_UUID = "0x2A37"
@@ -126,21 +131,41 @@ class HeartRateMeasurementCharacteristic(Characteristic):
         Characteristic.__init__(
             self, self.HEARTRATE_CHARACTERISTIC_UUID,
             ["notify"], service)
-        # self.add_descriptor(HeartRateDescriptor(self))
+        self.rr_pending = []
+        self.rr_since = sensors.ring(RR_INTERVAL).count
+        self.rr_last = None
+        # self.add_descriptor(CharacteristicUserDescriptionDescriptor(self, "Heart Rate"))
+
+    def collect_rr_intervals(self):
+        ring = sensors.ring(RR_INTERVAL)
+        count = ring.count
+        for timestamp, rr in ring.window(since=self.rr_since):
+            # A beat published while the window was read comes back next time too
+            if self.rr_last is None or timestamp > self.rr_last:
+                self.rr_pending.append(rr)
+                self.rr_last = timestamp
+        self.rr_since = count
+        del self.rr_pending[:-RR_BACKLOG]
 
     def get_heartrate(self):
-        value = []
-        flags = bytes([224])  # b'\xe0'
-        value.append(dbus.Byte(flags))
-        hrate = random.randrange(60, 120)
-        print("Heart Rate:" + str(hrate))
-        value.append(dbus.Byte(bytes([hrate])))
+        self.collect_rr_intervals()
+        contact = sensors.latest(SENSOR_CONTACT)
+        # BlueZ cuts each notification to the MTU of its link, and only AcquireNotify
+        # tells us one; without it, batch for the smallest link any central can have
+        value, sent = encode_heart_rate_measurement(
+            sensors.latest(HEART_RATE, 0),
+            None if contact is None else bool(contact),
+            self.service.get_energy(),
+            self.rr_pending,
+            self.notify_mtu or DEFAULT_MTU)
+        del self.rr_pending[:sent]
+        log.debug("Heart rate measurement: %s", value)
+
         return value
 
     def set_heartrate_callback(self):
         if self.notifying:
-            value = self.get_heartrate()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+            self.notify_value(self.get_heartrate())
 
         return self.notifying
 
@@ -149,55 +174,38 @@ class HeartRateMeasurementCharacteristic(Characteristic):
             return
 
         self.notifying = True
-
-        value = self.get_heartrate()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+        self.notify_value(self.get_heartrate(), force=True)
         self.add_timeout(NOTIFY_TIMEOUT, self.set_heartrate_callback)
 
     def StopNotify(self):
         self.notifying = False
-
-    def ReadValue(self, options):
-        value = self.get_heartrate()
-
-        return value
+        self.remove_timeout()
 
 
-class HeartRateDescriptor(Descriptor):
-    HEARTRATE_DESCRIPTOR_UUID = "2901"
-    HEARTRATE_DESCRIPTOR_VALUE = "Heart Rate"
+class HeartRateControlPoint(Characteristic):
+    HEART_RATE_CONTROL_POINT_UUID = "0x2A39"
 
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-            self, self.HEARTRATE_DESCRIPTOR_UUID,
-            ["read"],
-            characteristic)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.HEARTRATE_DESCRIPTOR_VALUE
+    def __init__(self, service):
+        Characteristic.__init__(
+            self, self.HEART_RATE_CONTROL_POINT_UUID,
+            ["write"], service)
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+    def WriteValue(self, value, options):
+        if bytes(value) != bytes([HRCP_RESET_ENERGY_EXPENDED]):
+            # Control Point Not Supported (0x80)
+            raise FailedException("Control point value not supported")
 
-        return value
+        self.service.reset_energy()
 
 
-class BodySensorLocation(Characteristic):
+class BodySensorLocation(StaticCharacteristic):
     UNIT_CHARACTERISTIC_UUID = "0x2A38"
+    CHEST = 0x01
 
     def __init__(self, service):
-        Characteristic.__init__(
+        StaticCharacteristic.__init__(
             self, self.UNIT_CHARACTERISTIC_UUID,
-            ["read"], service)
-
-    def ReadValue(self, options):
-        value = []
-
-        val = "Chest"
-        value.append(dbus.Byte(val.encode()))
-
-        return value
+            [self.CHEST], service)
 
 
 class HeartRateUnitCharacteristic(Characteristic):
@@ -207,11 +215,10 @@ class HeartRateUnitCharacteristic(Characteristic):
         Characteristic.__init__(
             self, self.UNIT_CHARACTERISTIC_UUID,
             ["read", "write"], service)
-        self.add_descriptor(HeartRateUnitDescriptor(self))
+        self.add_descriptor(CharacteristicUserDescriptionDescriptor(self, "Beats Per Minute (BPM)"))
 
     def WriteValue(self, value, options):
-        print("Received Value:")
-        print(value)
+        log.debug("Heart rate unit written: %s", bytes(value))
         # val = str(value[0]).upper()
 
     def ReadValue(self, options):
@@ -223,36 +230,33 @@ class HeartRateUnitCharacteristic(Characteristic):
         return value
 
 
-class HeartRateUnitDescriptor(Descriptor):
-    UNIT_DESCRIPTOR_UUID = "2901"
-    UNIT_DESCRIPTOR_VALUE = "Beats Per Minute (BPM)"
+def add_services(app, index, options=None):
+    app.add_service(HERLHeartRateService(index))
 
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-            self, self.UNIT_DESCRIPTOR_UUID,
-            ["read"],
-            characteristic)
+    return index + 1
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.UNIT_DESCRIPTOR_VALUE
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+def start_sensors(options=None):
+    if getattr(options, "replay", None):
+        # The launcher's RideReplay feeds the heart rate channels
+        return
 
-        return value
+    # Simulated heart rate until a real sensor reader is attached
+    start_producer(HEART_RATE, lambda: random.randrange(60, 120), 1)
+    start_producer(RR_INTERVAL, lambda: 60.0 / sensors.latest(HEART_RATE, 60), 1.5)
 
 
 if __name__ == '__main__':
+    setup_logging()
+    start_sensors()
+
     app = Application()
-    app.add_service(HERLHeartRateService(1))
+    add_services(app, 1)
     app.register()
 
     adv = HERLParacycleAdvertisement(0)
     adv.register()
 
-    print(app.services)
-
     try:
         app.run()
     except KeyboardInterrupt:
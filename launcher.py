@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+"""Serve any combination of the HERL profiles from one process.
+
+All selected profiles share one Application, one bus connection and one
+advertisement carrying the service UUIDs of every profile. Profile modules are
+imported only when selected.
+
+    python3 launcher.py ftms hrm thermometer --name "HERL Rig"
+"""
+import argparse
+import importlib
+
+from utils.core.bletools import BleTools
+from utils.core.log import get_logger, setup_logging
+from utils.gap.advertisement import Advertisement, REFRESH_SIGNAL, REFRESH_REREGISTER
+from utils.gap.broadcast import MetricsBroadcaster, BROADCAST_INTERVAL
+from utils.gatt.profile import Application
+
+# Profile name -> module providing SERVICE_UUIDS, SERVICE_DATA, add_services and start_sensors,
+# and optionally attach_replay(app, replay)
+PROFILES = {
+    "ftms": "fitness_machine",
+    "hrm": "heart_rate",
+    "thermometer": "temperature",
+}
+DEFAULT_NAME = "HERL"
+
+log = get_logger("launcher")
+
+
+class LauncherAdvertisement(Advertisement):
+    def __init__(self, index, name, modules):
+        Advertisement.__init__(self, index, "peripheral")
+        self.add_local_name(name)
+        self.include_tx_power = True
+        for module in modules:
+            for uuid in module.SERVICE_UUIDS:
+                if self.service_uuids is None or uuid not in self.service_uuids:
+                    self.add_service_uuid(uuid)
+            for uuid, data in module.SERVICE_DATA.items():
+                self.add_service_data(uuid, data)
+
+
+def load_profiles(names):
+    modules = []
+    for name in names:
+        log.debug("Loading profile %s", name)
+        modules.append(importlib.import_module(PROFILES[name]))
+
+    return modules
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve HERL GATT profiles from one process")
+    parser.add_argument("profiles", nargs="+", choices=sorted(PROFILES))
+    parser.add_argument("--name", default=DEFAULT_NAME, help="advertised local name")
+    parser.add_argument("--adapter", default=None,
+                        help='"first", "all", "round-robin" or an adapter name such as hci1')
+    parser.add_argument("--metrics", metavar="FILE", help="periodically write Prometheus metrics to FILE")
+    parser.add_argument("--acquisition-process", action="store_true",
+                        help="sample the thermal zones in a separate process")
+    parser.add_argument("--no-legacy", dest="legacy", action="store_false",
+                        help="do not serve the ASCII temperature service")
+    parser.add_argument("--broadcast", metavar="MS", type=int, nargs="?", const=BROADCAST_INTERVAL,
+                        help="broadcast live metrics in the advertisement every MS milliseconds")
+    parser.add_argument("--record", metavar="FILE",
+                        help="log every notification, read and write to FILE (see utils.core.recorder)")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay a CSV, FIT or recorded ride instead of the simulated sensors")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="replay speed relative to the ride, 0 for as fast as possible")
+    parser.add_argument("--loop", action="store_true", help="restart the replay when the ride ends")
+    parser.add_argument("--broadcast-refresh", choices=(REFRESH_SIGNAL, REFRESH_REREGISTER),
+                        default=REFRESH_SIGNAL, help="how broadcast updates reach BlueZ")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    setup_logging()
+
+    # Duplicates are dropped, the order given on the command line is kept
+    modules = load_profiles(list(dict.fromkeys(options.profiles)))
+
+    replay = None
+    if options.replay:
+        # Imported here: the replay readers pull in the decoders and NumPy
+        from utils.core.replay import RideReplay
+        replay = RideReplay(options.replay, options.time_scale, loop=options.loop)
+
+    app = Application()
+    index = 0
+    for module in modules:
+        module.start_sensors(options)
+        index = module.add_services(app, index, options)
+
+    if replay is not None:
+        for module in modules:
+            attach_replay = getattr(module, "attach_replay", None)
+            if attach_replay is not None:
+                attach_replay(app, replay)
+        replay.start()
+
+    if options.record:
+        app.record(options.record)
+    # Resolved once, so a round-robin choice puts the application and the
+    # advertisement on the same controller
+    adapters = BleTools.select_adapters(options.adapter, app.bus)
+    app.register(adapters)
+
+    adv = LauncherAdvertisement(0, options.name, modules)
+    if options.broadcast:
+        adv.refresh = options.broadcast_refresh
+        MetricsBroadcaster(adv, options.broadcast).start()
+    adv.register(adapters)
+
+    if options.metrics:
+        app.export_metrics(options.metrics)
+
+    try:
+        app.run()
+    except KeyboardInterrupt:
+        app.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -21,14 +21,38 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import argparse
+import time
+
 import dbus
 
+from utils.core.acquisition import AcquisitionWorker
 from utils.gap.advertisement  import Advertisement
-from utils.gatt.profile import Application, Service, Characteristic, Descriptor
-from gpiozero import CPUTemperature
+from utils.gatt.profile import Application, Service, Characteristic, FailedException
+from utils.gatt.profile import CharacteristicUserDescriptionDescriptor, PresentationFormatDescriptor
+from utils.gatt.profile import FORMAT_UINT16, UNIT_SECOND
+from utils.core.hts import encode_temperature_measurement, encode_measurement_interval, decode_measurement_interval
+from utils.core.log import setup_logging
+from utils.core.samples import sensors, start_producer, TEMPERATURE
+from utils.core.thermal import thermal_readers
 
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
 NOTIFY_TIMEOUT = 5000
+# Changes smaller than this (in the current unit) are not notified
+TEMPERATURE_DEADBAND = 0.1
+# Resend an unchanged temperature after this many suppressed notifications
+KEEPALIVE_TICKS = 12
+# Reads within this many seconds of each other share one encoded value
+READ_TTL = 1.0
+SAMPLE_RATE_HZ = 1
+# Health Thermometer measurement interval in seconds, 0 for no periodic measurements
+MEASUREMENT_INTERVAL = 5
+MEASUREMENT_INTERVAL_RANGE = (1, 3600)
+INTERMEDIATE_TIMEOUT = 1000
+
+# Advertised by the standalone script and merged into the launcher's advertisement
+SERVICE_UUIDS = ["0x1809"]
+SERVICE_DATA = {}
 
 
 class ThermometerAdvertisement(Advertisement):
@@ -36,9 +60,127 @@ class ThermometerAdvertisement(Advertisement):
         Advertisement.__init__(self, index, "peripheral")
         self.add_local_name("HERL Thermometer")
         self.include_tx_power = True
+        for uuid in SERVICE_UUIDS:
+            self.add_service_uuid(uuid)
+
+
+class HealthThermometerService(Service):
+    HEALTH_THERMOMETER_SVC_UUID = "0x1809"
+
+    def __init__(self, index):
+        self.interval = MEASUREMENT_INTERVAL
+
+        Service.__init__(self, index, self.HEALTH_THERMOMETER_SVC_UUID, True)
+        self.measurement = TemperatureMeasurement(self)
+        self.add_characteristic(self.measurement)
+        self.add_characteristic(IntermediateTemperature(self))
+        self.add_characteristic(MeasurementInterval(self))
+
+    def set_interval(self, interval):
+        self.interval = interval
+        self.measurement.reschedule()
+
+
+class TemperatureMeasurement(Characteristic):
+    TEMPERATURE_MEASUREMENT_UUID = "0x2A1C"
+
+    def __init__(self, service):
+        self.notifying = False
+
+        Characteristic.__init__(
+            self, self.TEMPERATURE_MEASUREMENT_UUID,
+            ["indicate"], service)
+
+    def get_measurement(self):
+        # Celsius, stamped with the wall clock time of the measurement
+        return encode_temperature_measurement(sensors.latest(TEMPERATURE), timestamp=time.time())
+
+    def set_measurement_callback(self):
+        if self.notifying:
+            self.notify_value(self.get_measurement())
+
+        return self.notifying
+
+    def reschedule(self):
+        self.remove_timeout()
+        if self.notifying and self.service.interval:
+            self.add_timeout(self.service.interval * 1000, self.set_measurement_callback)
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+
+        self.notifying = True
+        self.notify_value(self.get_measurement())
+        self.reschedule()
+
+    def StopNotify(self):
+        self.notifying = False
+        self.remove_timeout()
+
+
+class IntermediateTemperature(Characteristic):
+    INTERMEDIATE_TEMPERATURE_UUID = "0x2A1E"
+
+    def __init__(self, service):
+        self.notifying = False
+
+        Characteristic.__init__(
+            self, self.INTERMEDIATE_TEMPERATURE_UUID,
+            ["notify"], service)
+        self.set_change_only(keepalive=KEEPALIVE_TICKS,
+                             deadbands={"temperature": TEMPERATURE_DEADBAND})
+
+    def notify_temperature(self, force=False):
+        temp = sensors.latest(TEMPERATURE)
+        self.notify_value(encode_temperature_measurement(temp), {"temperature": temp}, force)
+
+    def set_temperature_callback(self):
+        if self.notifying:
+            self.notify_temperature()
+
+        return self.notifying
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+
+        self.notifying = True
+        self.notify_temperature(force=True)
+        self.add_timeout(INTERMEDIATE_TIMEOUT, self.set_temperature_callback)
+
+    def StopNotify(self):
+        self.notifying = False
+        self.remove_timeout()
+
+
+class MeasurementInterval(Characteristic):
+    MEASUREMENT_INTERVAL_UUID = "0x2A21"
+
+    def __init__(self, service):
+        Characteristic.__init__(
+            self, self.MEASUREMENT_INTERVAL_UUID,
+            ["read", "write"], service)
+        self.add_descriptor(PresentationFormatDescriptor(self, FORMAT_UINT16, 0, UNIT_SECOND))
+
+    def ReadValue(self, options):
+        return encode_measurement_interval(self.service.interval)
+
+    def WriteValue(self, value, options):
+        if len(value) != 2:
+            raise FailedException("Invalid value length")
+
+        interval = decode_measurement_interval(value)
+        low, high = MEASUREMENT_INTERVAL_RANGE
+        if interval and not low <= interval <= high:
+            # The specification's Out of Range (0xFF) cannot be sent through BlueZ
+            raise FailedException("Measurement interval out of range")
+
+        self.service.set_interval(interval)
 
 
 class ThermometerService(Service):
+    # Legacy ASCII temperature ("45.3 F"), kept for existing clients; disable with --no-legacy
     THERMOMETER_SVC_UUID = "00000001-710e-4a5b-8d75-3e5b444bc3cf"
 
     def __init__(self, index):
@@ -64,17 +206,21 @@ class TempCharacteristic(Characteristic):
         Characteristic.__init__(
             self, self.TEMP_CHARACTERISTIC_UUID,
             ["notify", "read"], service)
-        self.add_descriptor(TempDescriptor(self))
+        self.read_cache = None
+        self.add_descriptor(CharacteristicUserDescriptionDescriptor(self, "CPU Temperature"))
+        self.set_change_only(keepalive=KEEPALIVE_TICKS,
+                             deadbands={"temperature": TEMPERATURE_DEADBAND})
 
-    def get_temperature(self):
-        value = []
-        unit = "C"
-
-        cpu = CPUTemperature()
-        temp = cpu.temperature
+    def read_temperature(self):
+        temp = sensors.latest(TEMPERATURE, 0)
         if self.service.is_farenheit():
             temp = (temp * 1.8) + 32
-            unit = "F"
+
+        return temp
+
+    def encode_temperature(self, temp):
+        value = []
+        unit = "F" if self.service.is_farenheit() else "C"
 
         strtemp = str(round(temp, 1)) + " " + unit
         for c in strtemp:
@@ -82,10 +228,17 @@ class TempCharacteristic(Characteristic):
 
         return value
 
+    def get_temperature(self):
+        return self.encode_temperature(self.read_temperature())
+
+    def notify_temperature(self, force=False):
+        temp = self.read_temperature()
+        fields = {"temperature": temp, "farenheit": self.service.is_farenheit()}
+        self.notify_value(self.encode_temperature(temp), fields, force)
+
     def set_temperature_callback(self):
         if self.notifying:
-            value = self.get_temperature()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+            self.notify_temperature()
 
         return self.notifying
 
@@ -94,36 +247,23 @@ class TempCharacteristic(Characteristic):
             return
 
         self.notifying = True
-
-        value = self.get_temperature()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+        self.notify_temperature(force=True)
         self.add_timeout(NOTIFY_TIMEOUT, self.set_temperature_callback)
 
     def StopNotify(self):
         self.notifying = False
+        self.remove_timeout()
 
     def ReadValue(self, options):
-        value = self.get_temperature()
-
-        return value
-
-
-class TempDescriptor(Descriptor):
-    TEMP_DESCRIPTOR_UUID = "2901"
-    TEMP_DESCRIPTOR_VALUE = "CPU Temperature"
-
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-            self, self.TEMP_DESCRIPTOR_UUID,
-            ["read"],
-            characteristic)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.TEMP_DESCRIPTOR_VALUE
+        now = time.monotonic()
+        key = self.service.is_farenheit()
+        if self.read_cache is not None:
+            cached_at, cached_key, value = self.read_cache
+            if cached_key == key and now - cached_at < READ_TTL:
+                return value
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+        value = self.get_temperature()
+        self.read_cache = (now, key, value)
 
         return value
 
@@ -135,7 +275,7 @@ class UnitCharacteristic(Characteristic):
         Characteristic.__init__(
             self, self.UNIT_CHARACTERISTIC_UUID,
             ["read", "write"], service)
-        self.add_descriptor(UnitDescriptor(self))
+        self.add_descriptor(CharacteristicUserDescriptionDescriptor(self, "Temperature Units (F or C)"))
 
     def WriteValue(self, value, options):
         val = str(value[0]).upper()
@@ -156,34 +296,47 @@ class UnitCharacteristic(Characteristic):
         return value
 
 
-class UnitDescriptor(Descriptor):
-    UNIT_DESCRIPTOR_UUID = "2901"
-    UNIT_DESCRIPTOR_VALUE = "Temperature Units (F or C)"
+def add_services(app, index, options=None):
+    app.add_service(HealthThermometerService(index))
+    index += 1
+    if getattr(options, "legacy", True):
+        app.add_service(ThermometerService(index))
+        index += 1
 
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-            self, self.UNIT_DESCRIPTOR_UUID,
-            ["read"],
-            characteristic)
+    return index
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.UNIT_DESCRIPTOR_VALUE
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+def start_sensors(options=None):
+    if getattr(options, "acquisition_process", False):
+        # Sample the thermal zones in a separate process and share them through shared memory
+        acquisition = AcquisitionWorker(thermal_readers(), SAMPLE_RATE_HZ)
+        sensors.attach(acquisition.start())
+    else:
+        # Sample every thermal zone off the main loop thread
+        for channel, reader in thermal_readers().items():
+            start_producer(channel, reader, SAMPLE_RATE_HZ)
 
-        return value
 
+if __name__ == '__main__':
+    setup_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--acquisition-process", action="store_true",
+                        help="sample the thermal zones in a separate process")
+    parser.add_argument("--no-legacy", dest="legacy", action="store_false",
+                        help="do not serve the ASCII temperature service")
+    options = parser.parse_args()
+    start_sensors(options)
+
+    app = Application()
+    add_services(app, 0, options)
+    app.register()
 
-app = Application()
-app.add_service(ThermometerService(0))
-app.register()
+    adv = ThermometerAdvertisement(0)
+    adv.register()
 
-adv = ThermometerAdvertisement(0)
-adv.register()
+    try:
+        app.run()
+    except KeyboardInterrupt:
+        app.quit()
 
-try:
-    app.run()
-except KeyboardInterrupt:
-    app.quit()
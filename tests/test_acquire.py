@@ -0,0 +1,144 @@
+import itertools
+import select
+import socket
+
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("dbus.service")
+pytest.importorskip("gi")
+
+from utils.core.bletools import BleTools  # noqa: E402
+from utils.gatt import profile  # noqa: E402
+
+MTU = 100
+
+
+class ManualScheduler(profile.NotificationScheduler):
+    # Timers never fire; fd watches run when dispatch() finds their fd readable
+    def __init__(self):
+        profile.NotificationScheduler.__init__(self)
+        self.sources = itertools.count(1)
+        self.watches = {}
+
+    def timer_add(self, timeout, callback):
+        return next(self.sources)
+
+    def timer_remove(self, source):
+        pass
+
+    def io_add(self, fd, callback):
+        source = next(self.sources)
+        self.watches[source] = (fd, callback)
+        return source
+
+    def io_remove(self, source):
+        self.watches.pop(source, None)
+
+    def dispatch(self):
+        for source, (fd, callback) in list(self.watches.items()):
+            if source in self.watches and select.select([fd], [], [], 0)[0] and not callback():
+                self.watches.pop(source, None)
+
+
+class EchoCharacteristic(profile.Characteristic):
+    def __init__(self, service):
+        self.notifying = False
+        self.written = []
+        profile.Characteristic.__init__(self, "0x2AD2", ["notify", "write-without-response"], service)
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def StopNotify(self):
+        self.notifying = False
+
+    def WriteValue(self, value, options):
+        self.written.append((bytes(value), dict(options)))
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = ManualScheduler()
+    monkeypatch.setattr(profile.Characteristic, "scheduler", scheduler)
+
+    return scheduler
+
+
+@pytest.fixture
+def chrc(monkeypatch, scheduler):
+    # The objects are called directly and never exported, so no bus is needed
+    monkeypatch.setattr(BleTools, "get_bus", classmethod(lambda cls: None))
+    monkeypatch.setattr(dbus.service.Object, "__init__", lambda self, *args, **kwargs: None)
+    service = profile.Service(0, "0x1826", True)
+    chrc = EchoCharacteristic(service)
+    service.add_characteristic(chrc)
+
+    return chrc
+
+
+def acquired(chrc, name):
+    chrc_path = chrc.get_path()
+    return bool(chrc.service.get_managed_objects()[chrc_path][profile.GATT_CHRC_IFACE][name])
+
+
+def test_acquire_notify_sends_notifications_over_the_socket(chrc):
+    assert not acquired(chrc, "NotifyAcquired")
+
+    fd, mtu = chrc.AcquireNotify({"mtu": dbus.UInt16(MTU)})
+    remote = socket.socket(fileno=fd.take())
+
+    assert mtu == MTU
+    assert chrc.notifying
+    assert acquired(chrc, "NotifyAcquired")
+
+    for value in (b"\x00\x01", b"\x02\x03\x04"):
+        assert chrc.notify_value(value)
+    assert remote.recv(MTU) == b"\x00\x01"
+    assert remote.recv(MTU) == b"\x02\x03\x04"
+    assert chrc.metrics.notifications == 2
+    remote.close()
+
+
+def test_acquire_notify_is_released_on_hangup(chrc, scheduler):
+    fd, mtu = chrc.AcquireNotify({"mtu": dbus.UInt16(MTU)})
+    socket.socket(fileno=fd.take()).close()
+    scheduler.dispatch()
+
+    assert chrc.notify_socket is None
+    assert chrc.notify_mtu is None
+    assert not chrc.notifying
+    assert not scheduler.watches
+    assert not acquired(chrc, "NotifyAcquired")
+
+
+def test_acquire_notify_twice_is_not_permitted(chrc):
+    fd, mtu = chrc.AcquireNotify({})
+    try:
+        with pytest.raises(profile.NotPermittedException):
+            chrc.AcquireNotify({})
+    finally:
+        socket.socket(fileno=fd.take()).close()
+
+
+def test_acquire_write_passes_writes_to_write_value(chrc, scheduler):
+    fd, mtu = chrc.AcquireWrite({"mtu": dbus.UInt16(MTU), "device": "/org/bluez/hci0/dev_00"})
+    remote = socket.socket(fileno=fd.take())
+
+    assert mtu == MTU
+    assert acquired(chrc, "WriteAcquired")
+
+    remote.send(b"\x05\xc8\x00")
+    remote.send(b"\x07")
+    scheduler.dispatch()
+
+    assert [value for value, options in chrc.written] == [b"\x05\xc8\x00", b"\x07"]
+    assert all(options["type"] == "command" for value, options in chrc.written)
+    assert chrc.written[0][1]["device"] == "/org/bluez/hci0/dev_00"
+
+    remote.close()
+    scheduler.dispatch()
+
+    assert chrc.write_sockets == {}
+    assert not scheduler.watches
+    assert not acquired(chrc, "WriteAcquired")
@@ -0,0 +1,169 @@
+import random
+import struct
+
+import pytest
+
+from utils.core.codec import IBD_KEYS, CP_REQUEST_PARAMETERS, STATUS_PARAMETERS
+from utils.core.codec import decode_indoor_bike_data, decode_heart_rate_measurement
+from utils.core.codec import decode_control_point, decode_machine_status
+from utils.core.codec import decode_indoor_bike_data_batch, decode_heart_rate_measurement_batch
+from utils.core.ftms import INDOOR_BIKE_DATA_FIELDS, CP_RESPONSES, CP_SUCCESS, CP_CONTROL_NOT_PERMITTED
+from utils.core.ftms import encode_indoor_bike_data
+from utils.core.hrm import encode_heart_rate_measurement, RR_RESOLUTION
+
+ITERATIONS = 1000
+
+
+def random_indoor_bike_data(rng):
+    flags = rng.getrandbits(13)
+    sample = {}
+    for flag, key, fmt, scale in INDOOR_BIKE_DATA_FIELDS:
+        if key == "distance":
+            sample[key] = rng.randrange(1 << 24)
+        elif key == "energy":
+            sample[key] = (rng.randrange(1 << 16), rng.randrange(1 << 16), rng.randrange(1 << 8))
+        else:
+            bits = 8 * struct.calcsize(fmt)
+            if fmt == "h":
+                low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+            else:
+                low, high = 0, (1 << bits) - 1
+            sample[key] = rng.randint(low, high) / float(scale)
+
+    return flags, sample
+
+
+def random_indoor_bike_data_values(seed, count=ITERATIONS):
+    rng = random.Random(seed)
+
+    return [encode_indoor_bike_data(*random_indoor_bike_data(rng)) for _ in range(count)]
+
+
+def random_heart_rate_measurement(rng):
+    heart_rate = rng.randrange(1 << 16)
+    contact = rng.choice((None, False, True))
+    energy = rng.choice((None, rng.randrange(1 << 16)))
+    rr_intervals = [rng.randrange(1 << 16) / float(RR_RESOLUTION) for _ in range(rng.randrange(12))]
+    mtu = rng.choice((23, 185))
+
+    return heart_rate, contact, energy, rr_intervals, mtu
+
+
+def test_indoor_bike_data_round_trip():
+    rng = random.Random(0)
+    for _ in range(ITERATIONS):
+        flags, sample = random_indoor_bike_data(rng)
+        decoded = decode_indoor_bike_data(encode_indoor_bike_data(flags, sample))
+
+        assert decoded.flags == flags
+        for flag, key, fmt, scale in INDOOR_BIKE_DATA_FIELDS:
+            present = not (flags & flag) if key == "speed" else flags & flag
+            assert getattr(decoded, key) == (sample[key] if present else None), key
+
+
+def test_heart_rate_measurement_round_trip():
+    rng = random.Random(1)
+    for _ in range(ITERATIONS):
+        heart_rate, contact, energy, rr_intervals, mtu = random_heart_rate_measurement(rng)
+        value, sent = encode_heart_rate_measurement(heart_rate, contact, energy, rr_intervals, mtu)
+
+        assert len(value) <= mtu - 3
+        assert decode_heart_rate_measurement(value) == (
+            value[0], heart_rate, contact, energy, tuple(rr_intervals[:sent]))
+
+
+@pytest.mark.parametrize("opcode", sorted(CP_REQUEST_PARAMETERS))
+def test_control_point_round_trip(opcode):
+    layout = CP_REQUEST_PARAMETERS[opcode]
+    parameters = tuple(range(1, len(layout.format))) if layout else ()
+    value = bytes([opcode]) + (layout.pack(*parameters) if layout else b"")
+
+    assert decode_control_point(value) == (opcode, parameters)
+    for result in range(CP_SUCCESS, CP_CONTROL_NOT_PERMITTED + 1):
+        assert decode_control_point(CP_RESPONSES[(opcode, result)]) == (opcode, result, b"")
+
+
+@pytest.mark.parametrize("opcode", sorted(STATUS_PARAMETERS))
+def test_machine_status_round_trip(opcode):
+    layout = STATUS_PARAMETERS[opcode]
+    parameters = tuple(range(1, len(layout.format))) if layout else ()
+    value = bytes([opcode]) + (layout.pack(*parameters) if layout else b"")
+
+    assert decode_machine_status(value) == (opcode, parameters)
+
+
+def test_parameter_length_is_checked():
+    with pytest.raises(ValueError):
+        decode_machine_status(bytes([0x05, 0xC8]))
+
+
+@pytest.mark.parametrize("decode, value", [
+    (decode_control_point, b""),
+    (decode_control_point, b"\x80"),
+    (decode_control_point, b"\x80\x05"),
+    (decode_machine_status, b""),
+    (decode_indoor_bike_data, b"\x44"),
+    (decode_indoor_bike_data, b"\x44\x00\xe8\x03"),
+    (decode_heart_rate_measurement, b""),
+    (decode_heart_rate_measurement, b"\x01\x50"),
+    (decode_heart_rate_measurement, b"\x10\x50\x00"),
+])
+def test_malformed_value_is_rejected(decode, value):
+    with pytest.raises(ValueError):
+        decode(value)
+
+
+def test_indoor_bike_data_batch_matches_decoder():
+    numpy = pytest.importorskip("numpy")
+    values = random_indoor_bike_data_values(2)
+    columns = decode_indoor_bike_data_batch(values)
+
+    for i, value in enumerate(values):
+        decoded = decode_indoor_bike_data(value)
+        assert columns["flags"][i] == decoded.flags
+        for key in IBD_KEYS:
+            field = getattr(decoded, key)
+            if key == "energy":
+                for name, part in zip(("energy", "energy_per_hour", "energy_per_minute"),
+                                      field or (None,) * 3):
+                    assert numpy.isnan(columns[name][i]) if part is None else columns[name][i] == part
+            elif field is None:
+                assert numpy.isnan(columns[key][i]), key
+            else:
+                assert columns[key][i] == field, key
+
+
+def test_indoor_bike_data_batch_checks_lengths():
+    pytest.importorskip("numpy")
+    # Flags 0x44 need 8 bytes: a short and a long payload must not be read as two records
+    values = [bytes.fromhex("4400e803a000c8"), bytes.fromhex("4400e803a000c80000")]
+
+    with pytest.raises(ValueError):
+        decode_indoor_bike_data_batch(values)
+
+
+def test_heart_rate_measurement_batch_matches_decoder():
+    numpy = pytest.importorskip("numpy")
+    rng = random.Random(3)
+    values = [encode_heart_rate_measurement(*random_heart_rate_measurement(rng))[0]
+              for _ in range(ITERATIONS)]
+    columns = decode_heart_rate_measurement_batch(values)
+
+    rr_intervals = []
+    rr_index = []
+    for i, value in enumerate(values):
+        decoded = decode_heart_rate_measurement(value)
+        assert columns["heart_rate"][i] == decoded.heart_rate
+        if decoded.energy is None:
+            assert numpy.isnan(columns["energy"][i])
+        else:
+            assert columns["energy"][i] == decoded.energy
+        if decoded.contact is None:
+            assert numpy.isnan(columns["contact"][i])
+        else:
+            assert columns["contact"][i] == decoded.contact
+        rr_intervals.extend(decoded.rr_intervals)
+        rr_index.extend([i] * len(decoded.rr_intervals))
+
+    assert columns["rr_intervals"].tolist() == rr_intervals
+    assert columns["rr_index"].tolist() == rr_index
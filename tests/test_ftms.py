@@ -0,0 +1,31 @@
+from utils.core.ftms import ControlPointEngine, CP_RESPONSES, CP_REQUEST_CONTROL, CP_START_OR_RESUME
+from utils.core.ftms import CP_SUCCESS, CP_CONTROL_NOT_PERMITTED, STATUS_CONTROL_PERMISSION_LOST
+
+OWNER = "/org/bluez/hci0/dev_00_11_22_33_44_55"
+OTHER = "/org/bluez/hci0/dev_66_77_88_99_AA_BB"
+REQUEST_CONTROL = bytes([CP_REQUEST_CONTROL])
+START = bytes([CP_START_OR_RESUME])
+
+
+def test_control_is_released_when_the_owner_disconnects():
+    statuses = []
+    engine = ControlPointEngine(statuses.append)
+    assert engine.handle(REQUEST_CONTROL, OWNER) == CP_RESPONSES[(CP_REQUEST_CONTROL, CP_SUCCESS)]
+    assert engine.handle(REQUEST_CONTROL, OTHER) == CP_RESPONSES[(CP_REQUEST_CONTROL, CP_CONTROL_NOT_PERMITTED)]
+
+    assert engine.release_control(OWNER)
+    engine.flush()
+    assert statuses == [bytes([STATUS_CONTROL_PERMISSION_LOST])]
+    assert engine.owner is None and not engine.has_control
+
+    assert engine.handle(REQUEST_CONTROL, OTHER) == CP_RESPONSES[(CP_REQUEST_CONTROL, CP_SUCCESS)]
+    assert engine.handle(START, OTHER) == CP_RESPONSES[(CP_START_OR_RESUME, CP_SUCCESS)]
+
+
+def test_other_devices_disconnecting_keep_control():
+    engine = ControlPointEngine()
+    engine.handle(REQUEST_CONTROL, OWNER)
+
+    assert not engine.release_control(OTHER)
+    assert engine.owner == OWNER and engine.has_control
+    assert engine.pending_status == []
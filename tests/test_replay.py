@@ -0,0 +1,23 @@
+import datetime
+
+import pytest
+
+from utils.core.replay import parse_time
+
+
+@pytest.mark.parametrize("text, seconds", [
+    ("62", 62.0),
+    ("1.5", 1.5),
+    ("01:02", 62.0),
+    ("00:01:02", 62.0),
+    ("1:00:00.25", 3600.25),
+])
+def test_parse_time_durations(text, seconds):
+    assert parse_time(text) == seconds
+
+
+def test_parse_time_iso_8601():
+    expected = datetime.datetime(2024, 5, 1, 7, 30, 5, tzinfo=datetime.timezone.utc).timestamp()
+
+    assert parse_time("2024-05-01T07:30:05Z") == expected
+    assert parse_time("2024-05-01T07:30:05+00:00") == expected
@@ -0,0 +1,177 @@
+import math
+import multiprocessing
+import struct
+import time
+
+from multiprocessing import shared_memory
+
+from utils.core.log import get_logger
+
+SEQUENCE = struct.Struct("<Q")
+FIELD = struct.Struct("<d")
+# Write count and timestamp at the start of the block
+HEADER = struct.Struct("<Qd")
+# A sample older than this many sampling intervals means the worker is gone
+STALE_INTERVALS = 5
+
+log = get_logger("acquisition")
+
+
+class SampleSegment(object):
+    """
+    Fixed layout shared memory block holding the latest sample of each channel.
+
+    Layout: uint64 write count, float64 timestamp, one float64 per channel.
+    Python has no memory fences, so the block is guarded by a multiprocessing.Lock
+    (a POSIX semaphore): taking and releasing it orders the writer's stores
+    against the reader's loads on ARM as well as x86. Reads run on the main loop
+    and never wait for the lock; while the writer holds it they return the last
+    value read instead. Reads unpack straight from the shared buffer without
+    copying the block.
+
+    latest() returns its default once the sample is older than max_age seconds,
+    so a dead worker or a hung sensor is not served as a live value forever.
+    """
+
+    def __init__(self, channels, name=None, create=False, lock=None, max_age=None):
+        self.channels = tuple(channels)
+        self.offsets = dict((channel, SEQUENCE.size + FIELD.size * (i + 1))
+                            for i, channel in enumerate(self.channels))
+        self.layout = struct.Struct("<" + "d" * (len(self.channels) + 1))
+        self.shm = shared_memory.SharedMemory(name=name, create=create,
+                                              size=SEQUENCE.size + self.layout.size)
+        self.buf = self.shm.buf
+        self.name = self.shm.name
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self.max_age = max_age
+        self.stale = False
+        # Last reads, returned while the writer holds the lock
+        self.last_fields = {}
+        self.last_read = (0, math.nan, dict((channel, math.nan) for channel in self.channels))
+        if create:
+            SEQUENCE.pack_into(self.buf, 0, 0)
+
+    def write(self, values, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self.lock:
+            sequence = SEQUENCE.unpack_from(self.buf, 0)[0]
+            self.layout.pack_into(self.buf, SEQUENCE.size, timestamp, *values)
+            SEQUENCE.pack_into(self.buf, 0, sequence + 1)
+
+    def read_field(self, offset):
+        # (sequence, timestamp, value) of one channel
+        if not self.lock.acquire(block=False):
+            return self.last_fields.get(offset, (0, math.nan, math.nan))
+
+        try:
+            sequence, timestamp = HEADER.unpack_from(self.buf, 0)
+            value = FIELD.unpack_from(self.buf, offset)[0]
+        finally:
+            self.lock.release()
+
+        self.last_fields[offset] = (sequence, timestamp, value)
+
+        return sequence, timestamp, value
+
+    def read(self):
+        # (sequence, timestamp, {channel: value}) for the whole block
+        if not self.lock.acquire(block=False):
+            return self.last_read
+
+        try:
+            sequence = SEQUENCE.unpack_from(self.buf, 0)[0]
+            values = self.layout.unpack_from(self.buf, SEQUENCE.size)
+        finally:
+            self.lock.release()
+
+        self.last_read = (sequence, values[0], dict(zip(self.channels, values[1:])))
+
+        return self.last_read
+
+    def is_stale(self, timestamp):
+        stale = self.max_age is not None and time.monotonic() - timestamp > self.max_age
+        if stale != self.stale:
+            self.stale = stale
+            if stale:
+                log.warning("No samples from the acquisition worker for %.1f s, it is gone",
+                            time.monotonic() - timestamp)
+            else:
+                log.info("Acquisition worker samples are current again")
+
+        return stale
+
+    def latest(self, channel, default=None):
+        sequence, timestamp, value = self.read_field(self.offsets[channel])
+        if sequence == 0 or math.isnan(value) or self.is_stale(timestamp):
+            return default
+
+        return value
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def acquisition_main(name, channels, readers, rate_hz, stopped, lock):
+    segment = SampleSegment(channels, name, lock=lock)
+    values = [math.nan] * len(channels)
+    interval = 1.0 / rate_hz
+    deadline = time.monotonic()
+
+    try:
+        while not stopped.is_set():
+            for i, reader in enumerate(readers):
+                value = reader()
+                # Keep the previous value for a reader that has nothing new
+                if value is not None:
+                    values[i] = value
+            segment.write(values)
+
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline = time.monotonic()
+                delay = 0
+            stopped.wait(delay)
+    finally:
+        segment.close()
+
+
+class AcquisitionWorker(object):
+    """
+    Runs sensor readers in a separate process and publishes them in a SampleSegment.
+
+    readers maps a channel name to a function returning its current value. The
+    worker is forked, so readers do not need to be importable by name.
+    """
+
+    def __init__(self, readers, rate_hz):
+        context = multiprocessing.get_context("fork")
+        channels = tuple(readers)
+        self.segment = SampleSegment(channels, create=True, lock=context.Lock(),
+                                     max_age=STALE_INTERVALS / float(rate_hz))
+        self.stopped = context.Event()
+        self.process = context.Process(target=acquisition_main,
+                                       args=(self.segment.name, channels,
+                                             [readers[c] for c in channels],
+                                             rate_hz, self.stopped, self.segment.lock),
+                                       name="sensor-acquisition", daemon=True)
+
+    def start(self):
+        self.process.start()
+
+        return self.segment
+
+    def stop(self):
+        # A killed worker still counts as waiting on the event and set() would
+        # block on it forever
+        if self.process.is_alive():
+            self.stopped.set()
+        self.process.join()
+        self.segment.close()
+        self.segment.unlink()
@@ -19,7 +19,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
+
 import dbus
+import dbus.bus
+import dbus.mainloop.glib
 
 try:
     from gi.repository import GObject
@@ -28,32 +32,166 @@ except ImportError:
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+ADAPTER_IFACE = "org.bluez.Adapter1"
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+# "system" (default), "session" or a D-Bus address such as the one printed by
+# python -m utils.core.fakebluez
+BUS_ENV = "BLETOOLS_BUS"
+
+# Adapter selection policies for register()
+ADAPTER_FIRST = "first"
+ADAPTER_ALL = "all"
+ADAPTER_ROUND_ROBIN = "round-robin"
 
 
 class BleTools(object):
+    """
+    Process-wide registry of the system bus and the BlueZ adapters on it.
+
+    The adapter list is fetched with one GetManagedObjects call and then kept
+    current from the InterfacesAdded/InterfacesRemoved signals of org.bluez.
+    """
+    bus = None
+    bus_set = False
+    objects = None
+    watching = None
+    round_robin = 0
+
+    @classmethod
+    def get_bus(cls):
+        if not cls.bus_set:
+            # Signal tracking needs a main loop attached to the connection
+            dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+            address = os.environ.get(BUS_ENV, "system")
+            if address == "system":
+                cls.set_bus(dbus.SystemBus())
+            elif address == "session":
+                cls.set_bus(dbus.SessionBus())
+            else:
+                cls.set_bus(dbus.bus.BusConnection(address))
+
+        return cls.bus
+
+    @classmethod
+    def set_bus(cls, bus):
+        # Objects created afterwards are exported on bus. None leaves them unexported,
+        # for backends that publish them on a connection of their own.
+        cls.bus = bus
+        cls.bus_set = True
+        cls.objects = None
+
+    @classmethod
+    def get_objects(cls, bus=None):
+        if cls.objects is None:
+            bus = bus or cls.get_bus()
+            if cls.watching is not bus:
+                # Subscribed before the snapshot, so no change falls between the two
+                bus.add_signal_receiver(cls.interfaces_added,
+                                        dbus_interface=DBUS_OM_IFACE,
+                                        signal_name="InterfacesAdded",
+                                        bus_name=BLUEZ_SERVICE_NAME)
+                bus.add_signal_receiver(cls.interfaces_removed,
+                                        dbus_interface=DBUS_OM_IFACE,
+                                        signal_name="InterfacesRemoved",
+                                        bus_name=BLUEZ_SERVICE_NAME)
+                cls.watching = bus
+
+            remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"),
+                                       DBUS_OM_IFACE)
+            # Cached only once the call succeeds, so a bluetoothd that is not up
+            # yet is asked again next time
+            objects = {}
+            for o, props in remote_om.GetManagedObjects().items():
+                if ADAPTER_IFACE in props or LE_ADVERTISING_MANAGER_IFACE in props:
+                    objects[o] = set(props.keys())
+            cls.objects = objects
+
+        return cls.objects
+
     @classmethod
-    def get_bus(self):
-        bus = dbus.SystemBus()
+    def interfaces_added(cls, path, interfaces):
+        if cls.objects is None:
+            # Picked up by the next GetManagedObjects
+            return
 
-        return bus
+        if ADAPTER_IFACE in interfaces or LE_ADVERTISING_MANAGER_IFACE in interfaces:
+            cls.objects.setdefault(path, set()).update(interfaces.keys())
 
     @classmethod
-    def find_adapter(self, bus):
-        remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"),
-                                   DBUS_OM_IFACE)
-        objects = remote_om.GetManagedObjects()
+    def interfaces_removed(cls, path, interfaces):
+        if cls.objects is None:
+            return
+
+        ifaces = cls.objects.get(path)
+        if ifaces is None:
+            return
 
-        for o, props in objects.items():
-            if LE_ADVERTISING_MANAGER_IFACE in props:
-                return o
+        ifaces.difference_update(interfaces)
+        if ADAPTER_IFACE not in ifaces and LE_ADVERTISING_MANAGER_IFACE not in ifaces:
+            del cls.objects[path]
+
+    @classmethod
+    def find_adapters(cls, bus=None):
+        return sorted(o for o, ifaces in cls.get_objects(bus).items()
+                      if LE_ADVERTISING_MANAGER_IFACE in ifaces)
+
+    @classmethod
+    def find_adapter(cls, bus=None):
+        adapters = cls.find_adapters(bus)
+        if adapters:
+            return adapters[0]
 
         return None
 
     @classmethod
-    def power_adapter(self):
-        adapter = self.get_adapter()
+    def choose_adapters(cls, adapters, selector=None):
+        # selector is a policy (ADAPTER_FIRST, ADAPTER_ALL, ADAPTER_ROUND_ROBIN), an
+        # adapter name like "hci1" or object path, a list of those, or a callable that
+        # picks from the list of adapter paths
+        if not adapters:
+            return []
+        if selector is None or selector == ADAPTER_FIRST:
+            return adapters[:1]
+        if selector == ADAPTER_ALL:
+            return list(adapters)
+        if selector == ADAPTER_ROUND_ROBIN:
+            adapter = adapters[cls.round_robin % len(adapters)]
+            cls.round_robin += 1
+            return [adapter]
+        if callable(selector):
+            return list(selector(adapters))
+
+        if isinstance(selector, str):
+            selector = [selector]
+        return [a for a in adapters if a in selector or a.rsplit("/", 1)[-1] in selector]
+
+    @classmethod
+    def select_adapters(cls, selector=None, bus=None):
+        return cls.choose_adapters(cls.find_adapters(bus), selector)
+
+    @classmethod
+    def get_adapter(cls, adapter=None):
+        if adapter is None:
+            adapter = cls.find_adapter()
+
+        return dbus.Interface(cls.get_bus().get_object(BLUEZ_SERVICE_NAME, adapter),
+                              DBUS_PROP_IFACE)
 
-        adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                                       "org.freedesktop.DBus.Properties");
-        adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
+    @classmethod
+    def get_adapter_property(cls, name, adapter=None):
+        return cls.get_adapter(adapter).Get(ADAPTER_IFACE, name)
+
+    @classmethod
+    def set_adapter_property(cls, name, value, adapter=None):
+        cls.get_adapter(adapter).Set(ADAPTER_IFACE, name, value)
+
+    @classmethod
+    def power_adapter(cls, powered=True, adapter=None):
+        cls.set_adapter_property("Powered", dbus.Boolean(powered), adapter)
+
+    @classmethod
+    def configure_adapter(cls, adapter=None, **properties):
+        # e.g. configure_adapter(Alias=dbus.String("HERL FM"), Discoverable=dbus.Boolean(1))
+        for name, value in properties.items():
+            cls.set_adapter_property(name, value, adapter)
@@ -0,0 +1,242 @@
+"""Decoders for the payloads the HERL peripherals emit, for central-side tools.
+
+Each decoder returns a namedtuple and reuses the struct layouts the encoders in
+utils.core.ftms and utils.core.hrm cache per flags value. The *_batch functions
+decode many buffered notifications into NumPy column arrays (NumPy is optional
+and only needed for them).
+"""
+import collections
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils.core.ftms import INDOOR_BIKE_DATA_FIELDS, indoor_bike_data_encoder
+from utils.core.ftms import CP_REQUEST_CONTROL, CP_RESET, CP_SET_TARGET_SPEED, CP_SET_TARGET_INCLINATION
+from utils.core.ftms import CP_SET_TARGET_RESISTANCE_LEVEL, CP_SET_TARGET_POWER, CP_SET_TARGET_HEART_RATE
+from utils.core.ftms import CP_START_OR_RESUME, CP_STOP_OR_PAUSE, CP_SET_INDOOR_BIKE_SIMULATION
+from utils.core.ftms import CP_RESPONSE_CODE
+from utils.core.ftms import STATUS_RESET, STATUS_STOPPED_OR_PAUSED, STATUS_STARTED_OR_RESUMED
+from utils.core.ftms import STATUS_TARGET_SPEED_CHANGED, STATUS_TARGET_INCLINATION_CHANGED
+from utils.core.ftms import STATUS_TARGET_RESISTANCE_LEVEL_CHANGED, STATUS_TARGET_POWER_CHANGED
+from utils.core.ftms import STATUS_TARGET_HEART_RATE_CHANGED, STATUS_INDOOR_BIKE_SIMULATION_CHANGED
+from utils.core.ftms import STATUS_CONTROL_PERMISSION_LOST
+from utils.core.ftms import SPEED_PARAMETER, INCLINATION_PARAMETER, RESISTANCE_PARAMETER, POWER_PARAMETER
+from utils.core.ftms import HEART_RATE_PARAMETER, STOP_OR_PAUSE_PARAMETER, SIMULATION_PARAMETERS
+from utils.core.hrm import heart_rate_measurement_encoder
+from utils.core.hrm import HR_CONTACT_SUPPORTED, HR_CONTACT_DETECTED, HR_ENERGY_EXPENDED, HR_RR_INTERVAL
+from utils.core.hrm import HR_VALUE_UINT16, RR_RESOLUTION
+
+IBD_KEYS = tuple(key for flag, key, fmt, scale in INDOOR_BIKE_DATA_FIELDS)
+FLAGS16 = struct.Struct("<H")
+
+# Absent fields are None
+IndoorBikeData = collections.namedtuple("IndoorBikeData", ("flags",) + IBD_KEYS)
+HeartRateMeasurement = collections.namedtuple(
+    "HeartRateMeasurement", ("flags", "heart_rate", "contact", "energy", "rr_intervals"))
+ControlPointRequest = collections.namedtuple("ControlPointRequest", ("opcode", "parameters"))
+ControlPointResponse = collections.namedtuple("ControlPointResponse", ("request_opcode", "result", "parameters"))
+MachineStatus = collections.namedtuple("MachineStatus", ("opcode", "parameters"))
+
+# Parameter layout of each Control Point request and Fitness Machine Status op code
+CP_REQUEST_PARAMETERS = {
+    CP_REQUEST_CONTROL: None,
+    CP_RESET: None,
+    CP_SET_TARGET_SPEED: SPEED_PARAMETER,
+    CP_SET_TARGET_INCLINATION: INCLINATION_PARAMETER,
+    CP_SET_TARGET_RESISTANCE_LEVEL: RESISTANCE_PARAMETER,
+    CP_SET_TARGET_POWER: POWER_PARAMETER,
+    CP_SET_TARGET_HEART_RATE: HEART_RATE_PARAMETER,
+    CP_START_OR_RESUME: None,
+    CP_STOP_OR_PAUSE: STOP_OR_PAUSE_PARAMETER,
+    CP_SET_INDOOR_BIKE_SIMULATION: SIMULATION_PARAMETERS,
+}
+STATUS_PARAMETERS = {
+    STATUS_RESET: None,
+    STATUS_STOPPED_OR_PAUSED: STOP_OR_PAUSE_PARAMETER,
+    STATUS_STARTED_OR_RESUMED: None,
+    STATUS_TARGET_SPEED_CHANGED: SPEED_PARAMETER,
+    STATUS_TARGET_INCLINATION_CHANGED: INCLINATION_PARAMETER,
+    STATUS_TARGET_RESISTANCE_LEVEL_CHANGED: RESISTANCE_PARAMETER,
+    STATUS_TARGET_POWER_CHANGED: POWER_PARAMETER,
+    STATUS_TARGET_HEART_RATE_CHANGED: HEART_RATE_PARAMETER,
+    STATUS_INDOOR_BIKE_SIMULATION_CHANGED: SIMULATION_PARAMETERS,
+    STATUS_CONTROL_PERMISSION_LOST: None,
+}
+
+# struct format character -> NumPy dtype, for the batch decoders
+NUMPY_TYPES = {"B": "u1", "b": "i1", "H": "<u2", "h": "<i2", "I": "<u4", "i": "<i4"}
+
+
+def check_length(value, size, name):
+    if len(value) < size:
+        raise ValueError("%s needs at least %d bytes, got %d" % (name, size, len(value)))
+
+
+def decode_indoor_bike_data(value):
+    value = bytes(value)
+    check_length(value, FLAGS16.size, "Indoor Bike Data")
+    flags = FLAGS16.unpack_from(value)[0]
+    packer, fields = indoor_bike_data_encoder.get_layout(flags)
+    if len(value) != packer.size:
+        raise ValueError("Indoor Bike Data with flags 0x%04X needs %d bytes, got %d"
+                         % (flags, packer.size, len(value)))
+    raw = packer.unpack(value)
+
+    decoded = dict.fromkeys(IBD_KEYS)
+    position = 1
+    for key, count, scale in fields:
+        if key == "distance":
+            decoded[key] = raw[position] | (raw[position + 1] << 16)
+        elif count > 1:
+            decoded[key] = raw[position:position + count]
+        else:
+            decoded[key] = raw[position] if scale == 1 else raw[position] / float(scale)
+        position += count
+
+    return IndoorBikeData(flags=flags, **decoded)
+
+
+def decode_heart_rate_measurement(value):
+    value = bytes(value)
+    check_length(value, 1, "Heart Rate Measurement")
+    flags = value[0]
+    header = 2 + (1 if flags & HR_VALUE_UINT16 else 0) + (2 if flags & HR_ENERGY_EXPENDED else 0)
+    check_length(value, header, "Heart Rate Measurement with flags 0x%02X" % flags)
+    rr_count = (len(value) - header) // 2 if flags & HR_RR_INTERVAL else 0
+    layout = heart_rate_measurement_encoder.get_layout(flags, rr_count)
+    if len(value) != layout.size:
+        raise ValueError("Heart Rate Measurement with flags 0x%02X has %d trailing bytes"
+                         % (flags, len(value) - layout.size))
+    raw = layout.unpack(value)
+
+    contact = bool(flags & HR_CONTACT_DETECTED) if flags & HR_CONTACT_SUPPORTED else None
+    energy = raw[2] if flags & HR_ENERGY_EXPENDED else None
+    rr_intervals = tuple(rr / float(RR_RESOLUTION) for rr in raw[len(raw) - rr_count:])
+
+    return HeartRateMeasurement(flags, raw[1], contact, energy, rr_intervals)
+
+
+def decode_parameters(layouts, opcode, value, offset):
+    layout = layouts.get(opcode)
+    if layout is None:
+        return ()
+    if len(value) != offset + layout.size:
+        raise ValueError("Op code 0x%02X needs %d parameter bytes, got %d"
+                         % (opcode, layout.size, len(value) - offset))
+
+    return layout.unpack_from(value, offset)
+
+
+def decode_control_point(value):
+    # Requests written by the central and Response Code indications from the machine
+    value = bytes(value)
+    check_length(value, 1, "Control Point value")
+    if value[0] == CP_RESPONSE_CODE:
+        check_length(value, 3, "Control Point response")
+        return ControlPointResponse(value[1], value[2], value[3:])
+
+    return ControlPointRequest(value[0], decode_parameters(CP_REQUEST_PARAMETERS, value[0], value, 1))
+
+
+def decode_machine_status(value):
+    value = bytes(value)
+    check_length(value, 1, "Fitness Machine Status")
+
+    return MachineStatus(value[0], decode_parameters(STATUS_PARAMETERS, value[0], value, 1))
+
+
+def indoor_bike_data_dtype(flags):
+    packer, fields = indoor_bike_data_encoder.get_layout(flags)
+    dtype = [("flags", "<u2")]
+    formats = iter(packer.format.lstrip("<")[1:])
+    for key, count, scale in fields:
+        for i in range(count):
+            dtype.append(("%s_%d" % (key, i), NUMPY_TYPES[next(formats)]))
+
+    return numpy.dtype(dtype), fields
+
+
+def decode_indoor_bike_data_batch(values):
+    """
+    Decode a sequence of Indoor Bike Data notifications into columns.
+
+    Returns a dict of float64 arrays, one per field plus "flags", with NaN where a
+    notification did not carry the field. Energy is split into energy, energy_per_hour
+    and energy_per_minute. Notifications sharing a flags value are decoded together
+    with one structured frombuffer.
+    """
+    if numpy is None:
+        raise RuntimeError("Batch decoding needs NumPy")
+
+    values = [bytes(value) for value in values]
+    count = len(values)
+    groups = collections.defaultdict(list)
+    for i, value in enumerate(values):
+        groups[FLAGS16.unpack_from(value)[0]].append(i)
+
+    columns = {"flags": numpy.zeros(count)}
+    for key in IBD_KEYS:
+        if key == "energy":
+            for name in ("energy", "energy_per_hour", "energy_per_minute"):
+                columns[name] = numpy.full(count, numpy.nan)
+        else:
+            columns[key] = numpy.full(count, numpy.nan)
+
+    for flags, indices in groups.items():
+        dtype, fields = indoor_bike_data_dtype(flags)
+        for i in indices:
+            if len(values[i]) != dtype.itemsize:
+                raise ValueError("Indoor Bike Data %d with flags 0x%04X needs %d bytes, got %d"
+                                 % (i, flags, dtype.itemsize, len(values[i])))
+        records = numpy.frombuffer(b"".join(values[i] for i in indices), dtype=dtype)
+        rows = numpy.asarray(indices)
+        columns["flags"][rows] = flags
+        for key, count, scale in fields:
+            if key == "distance":
+                columns[key][rows] = records["distance_0"] + records["distance_1"].astype("<u4") * 65536
+            elif key == "energy":
+                for i, name in enumerate(("energy", "energy_per_hour", "energy_per_minute")):
+                    columns[name][rows] = records["energy_%d" % i]
+            else:
+                columns[key][rows] = records[key + "_0"] / float(scale)
+
+    return columns
+
+
+def decode_heart_rate_measurement_batch(values):
+    """
+    Decode a sequence of Heart Rate Measurement notifications into columns.
+
+    Returns heart_rate, energy and contact as float64 arrays (NaN when absent), plus
+    rr_intervals, all RR-Intervals in seconds concatenated, and rr_index, the
+    notification each of them came from.
+    """
+    if numpy is None:
+        raise RuntimeError("Batch decoding needs NumPy")
+
+    count = len(values)
+    heart_rate = numpy.empty(count)
+    energy = numpy.full(count, numpy.nan)
+    contact = numpy.full(count, numpy.nan)
+    rr_intervals = []
+    rr_index = []
+    for i, value in enumerate(values):
+        decoded = decode_heart_rate_measurement(value)
+        heart_rate[i] = decoded.heart_rate
+        if decoded.energy is not None:
+            energy[i] = decoded.energy
+        if decoded.contact is not None:
+            contact[i] = decoded.contact
+        rr_intervals.extend(decoded.rr_intervals)
+        rr_index.extend([i] * len(decoded.rr_intervals))
+
+    return {
+        "heart_rate": heart_rate,
+        "energy": energy,
+        "contact": contact,
+        "rr_intervals": numpy.asarray(rr_intervals, dtype=float),
+        "rr_index": numpy.asarray(rr_index, dtype=int),
+    }
@@ -0,0 +1,341 @@
+"""Stand-in for org.bluez on a private D-Bus, for headless testing and benchmarking.
+
+Start a private bus with the fake BlueZ on it and point BleTools at it:
+
+    $ python -m utils.core.fakebluez
+    BLETOOLS_BUS=unix:abstract=/tmp/dbus-...
+    $ BLETOOLS_BUS=unix:abstract=/tmp/dbus-... python3 heart_rate.py
+
+or from Python:
+
+    fake = FakeBluezProcess()
+    fake.start()
+    BleTools.set_bus(fake.connect())
+    app = Application()
+    ...
+    central = FakeCentral.for_application(BleTools.get_bus(), app)
+    central.start_notify("0x2A37", print)
+
+The stand-in runs in a forked process because dbus-python blocks the calling
+thread on synchronous calls (e.g. BleTools.find_adapter), so a BlueZ served
+from the same thread would deadlock. FakeCentral lives in the caller's process
+and only uses asynchronous calls, spinning the main loop until replies arrive.
+"""
+import multiprocessing
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.bus
+import dbus.service
+import dbus.mainloop.glib
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+DEFAULT_DEVICE = "/org/bluez/hci0/dev_00_00_00_00_00_01"
+
+
+class FakeAdapter(dbus.service.Object):
+    def __init__(self, bluez, index):
+        self.bluez = bluez
+        self.bus = bluez.bus
+        self.path = "/org/bluez/hci%d" % index
+        self.properties = {
+            "Address": dbus.String("00:00:00:00:00:%02X" % index),
+            "Name": dbus.String("fake-hci%d" % index),
+            "Alias": dbus.String("fake-hci%d" % index),
+            "Powered": dbus.Boolean(1),
+            "Discoverable": dbus.Boolean(0),
+        }
+        self.applications = {}
+        self.advertisements = {}
+        dbus.service.Object.__init__(self, self.bus, self.path)
+
+    def get_interfaces(self):
+        return {
+            ADAPTER_IFACE: self.properties,
+            GATT_MANAGER_IFACE: {},
+            LE_ADVERTISING_MANAGER_IFACE: {
+                "ActiveInstances": dbus.Byte(len(self.advertisements)),
+                "SupportedInstances": dbus.Byte(5),
+            },
+        }
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        return self.get_interfaces()[interface][name]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        self.properties[name] = value
+        self.PropertiesChanged(interface, {name: value}, [])
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        return self.get_interfaces()[interface]
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="oa{sv}",
+                         sender_keyword="sender", async_callbacks=("reply", "error"))
+    def RegisterApplication(self, path, options, sender, reply, error):
+        # Like BlueZ, read the whole object tree before acknowledging
+        remote_om = dbus.Interface(self.bus.get_object(sender, path, introspect=False),
+                                   DBUS_OM_IFACE)
+
+        def objects_received(objects):
+            self.applications[(sender, path)] = objects
+            reply()
+
+        remote_om.GetManagedObjects(reply_handler=objects_received, error_handler=error)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="o", sender_keyword="sender")
+    def UnregisterApplication(self, path, sender):
+        self.applications.pop((sender, path), None)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="oa{sv}",
+                         sender_keyword="sender", async_callbacks=("reply", "error"))
+    def RegisterAdvertisement(self, path, options, sender, reply, error):
+        remote_props = dbus.Interface(self.bus.get_object(sender, path, introspect=False),
+                                      DBUS_PROP_IFACE)
+
+        def properties_received(properties):
+            self.advertisements[(sender, path)] = properties
+            reply()
+
+        def properties_changed(interface, changed, invalidated):
+            # Live advertisement updates, as BlueZ applies them
+            properties = self.advertisements.get((sender, path))
+            if properties is not None:
+                properties.update(changed)
+
+        self.bus.add_signal_receiver(properties_changed, signal_name="PropertiesChanged",
+                                     dbus_interface=DBUS_PROP_IFACE, bus_name=sender, path=path)
+
+        remote_props.GetAll(LE_ADVERTISEMENT_IFACE,
+                            reply_handler=properties_received, error_handler=error)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="o", sender_keyword="sender")
+    def UnregisterAdvertisement(self, path, sender):
+        self.advertisements.pop((sender, path), None)
+
+
+class FakeBluez(dbus.service.Object):
+    """
+    org.bluez root object: ObjectManager for the fake adapters
+    """
+
+    def __init__(self, bus, adapters=1):
+        self.bus = bus
+        self.name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+        self.adapters = []
+        dbus.service.Object.__init__(self, bus, "/")
+        for _ in range(adapters):
+            self.add_adapter()
+
+    def add_adapter(self):
+        adapter = FakeAdapter(self, len(self.adapters))
+        self.adapters.append(adapter)
+        self.InterfacesAdded(adapter.path, adapter.get_interfaces())
+
+        return adapter
+
+    def remove_adapter(self):
+        adapter = self.adapters.pop()
+        adapter.remove_from_connection()
+        self.InterfacesRemoved(adapter.path, list(adapter.get_interfaces()))
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return dict((adapter.path, adapter.get_interfaces()) for adapter in self.adapters)
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+
+def start_private_bus():
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+
+    return daemon, address
+
+
+def serve(address, adapters, ready=None):
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    bluez = FakeBluez(bus, adapters)
+    mainloop = GObject.MainLoop()
+    if ready is not None:
+        ready.set()
+    mainloop.run()
+
+
+class FakeBluezProcess(object):
+    """
+    Private dbus-daemon plus a forked process serving FakeBluez on it
+    """
+
+    def __init__(self, adapters=1):
+        self.adapters = adapters
+        self.daemon = None
+        self.process = None
+        self.address = None
+
+    def start(self):
+        context = multiprocessing.get_context("fork")
+        self.daemon, self.address = start_private_bus()
+        ready = context.Event()
+        self.process = context.Process(target=serve, args=(self.address, self.adapters, ready),
+                                       name="fake-bluez", daemon=True)
+        self.process.start()
+        ready.wait()
+
+        return self.address
+
+    def connect(self):
+        # The connection must be attached to the main loop to serve exported objects
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+        return dbus.bus.BusConnection(self.address)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.daemon.terminate()
+        self.daemon.wait()
+
+
+class FakeCentral(object):
+    """
+    Drives a GATT application the way BlueZ does for a connected central.
+
+    Characteristics are addressed by UUID as given in the application (e.g. "0x2A37").
+    Calls are asynchronous underneath and spin the default main context until the
+    reply arrives, so the application may live in the same thread.
+    """
+
+    def __init__(self, bus, destination, root="/", device=DEFAULT_DEVICE, timeout=5.0):
+        # destination is the bus name of the process serving the application
+        self.bus = bus
+        self.destination = destination
+        self.root = root
+        self.device = device
+        self.timeout = timeout
+        self.context = GObject.MainContext.default()
+        self.paths = {}
+        self.receivers = {}
+
+    @classmethod
+    def for_application(cls, bus, application, **kwargs):
+        return cls(bus, application.bus.get_unique_name(), application.get_path(), **kwargs)
+
+    def wait(self, method, *args):
+        result = {}
+        method(*args,
+               reply_handler=lambda *reply: result.setdefault("reply", reply),
+               error_handler=lambda error: result.setdefault("error", error))
+
+        deadline = time.monotonic() + self.timeout
+        while not result:
+            if time.monotonic() > deadline:
+                raise TimeoutError("no reply from " + self.destination)
+            self.context.iteration(True)
+
+        if "error" in result:
+            raise result["error"]
+        reply = result["reply"]
+
+        return reply[0] if len(reply) == 1 else None
+
+    def spin(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if not self.context.iteration(False):
+                time.sleep(0.0005)
+
+    def discover(self):
+        remote_om = dbus.Interface(
+            self.bus.get_object(self.destination, self.root, introspect=False), DBUS_OM_IFACE)
+        for path, interfaces in self.wait(remote_om.GetManagedObjects).items():
+            for interface in (GATT_CHRC_IFACE, GATT_DESC_IFACE):
+                if interface in interfaces:
+                    uuid = str(interfaces[interface]["UUID"]).lower()
+                    self.paths.setdefault(uuid, (str(path), interface))
+
+        return self.paths
+
+    def get_interface(self, uuid):
+        if not self.paths:
+            self.discover()
+        path, interface = self.paths[uuid.lower()]
+
+        return path, dbus.Interface(
+            self.bus.get_object(self.destination, path, introspect=False), interface)
+
+    def options(self, **extra):
+        options = {"device": dbus.ObjectPath(self.device)}
+        options.update(extra)
+
+        return options
+
+    def read(self, uuid, offset=0):
+        path, iface = self.get_interface(uuid)
+
+        return bytes(self.wait(iface.ReadValue, self.options(offset=dbus.UInt16(offset))))
+
+    def write(self, uuid, value):
+        path, iface = self.get_interface(uuid)
+        self.wait(iface.WriteValue, dbus.Array(bytes(value), signature="y"), self.options())
+
+    def start_notify(self, uuid, callback):
+        path, iface = self.get_interface(uuid)
+
+        def properties_changed(interface, changed, invalidated):
+            if "Value" in changed:
+                callback(bytes(changed["Value"]))
+
+        self.receivers[uuid.lower()] = self.bus.add_signal_receiver(
+            properties_changed, signal_name="PropertiesChanged",
+            dbus_interface=DBUS_PROP_IFACE, bus_name=self.destination, path=path)
+        self.wait(iface.StartNotify)
+
+    def stop_notify(self, uuid):
+        path, iface = self.get_interface(uuid)
+        receiver = self.receivers.pop(uuid.lower(), None)
+        if receiver is not None:
+            receiver.remove()
+        self.wait(iface.StopNotify)
+
+
+if __name__ == '__main__':
+    daemon, address = start_private_bus()
+    print("BLETOOLS_BUS=" + address)
+    sys.stdout.flush()
+
+    try:
+        serve(address, int(sys.argv[1]) if len(sys.argv) > 1 else 1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.terminate()
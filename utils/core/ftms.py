@@ -0,0 +1,323 @@
+import struct
+
+# Indoor Bike Data (0x2AD2) flag bits
+# Refer to: https://www.bluetooth.com/specifications/specs/fitness-machine-service-1-0/
+# Bit 0 is inverted: when "More Data" is cleared the Instantaneous Speed field is present
+IBD_MORE_DATA = 1 << 0
+IBD_AVERAGE_SPEED = 1 << 1
+IBD_INSTANTANEOUS_CADENCE = 1 << 2
+IBD_AVERAGE_CADENCE = 1 << 3
+IBD_TOTAL_DISTANCE = 1 << 4
+IBD_RESISTANCE_LEVEL = 1 << 5
+IBD_INSTANTANEOUS_POWER = 1 << 6
+IBD_AVERAGE_POWER = 1 << 7
+IBD_EXPENDED_ENERGY = 1 << 8
+IBD_HEART_RATE = 1 << 9
+IBD_METABOLIC_EQUIVALENT = 1 << 10
+IBD_ELAPSED_TIME = 1 << 11
+IBD_REMAINING_TIME = 1 << 12
+
+# (flag, sample key, struct format, multiplier) in the order the fields appear on the air.
+# Multipliers convert from SI-ish sample units (km/h, rpm, metres, watts, ...) into the
+# field resolution defined by the specification.
+INDOOR_BIKE_DATA_FIELDS = (
+    (IBD_MORE_DATA, "speed", "H", 100),  # 0.01 km/h
+    (IBD_AVERAGE_SPEED, "average_speed", "H", 100),  # 0.01 km/h
+    (IBD_INSTANTANEOUS_CADENCE, "cadence", "H", 2),  # 0.5 rpm
+    (IBD_AVERAGE_CADENCE, "average_cadence", "H", 2),  # 0.5 rpm
+    (IBD_TOTAL_DISTANCE, "distance", "HB", 1),  # uint24, 1 m
+    (IBD_RESISTANCE_LEVEL, "resistance", "h", 1),  # unitless
+    (IBD_INSTANTANEOUS_POWER, "power", "h", 1),  # 1 W
+    (IBD_AVERAGE_POWER, "average_power", "h", 1),  # 1 W
+    (IBD_EXPENDED_ENERGY, "energy", "HHB", 1),  # total kcal, kcal/h, kcal/min
+    (IBD_HEART_RATE, "heart_rate", "B", 1),  # 1 bpm
+    (IBD_METABOLIC_EQUIVALENT, "metabolic_equivalent", "B", 10),  # 0.1 MET
+    (IBD_ELAPSED_TIME, "elapsed_time", "H", 1),  # 1 s
+    (IBD_REMAINING_TIME, "remaining_time", "H", 1),  # 1 s
+)
+
+
+# Value range of each struct format; encoded fields are clamped to it
+FORMAT_RANGES = {
+    "B": (0, 0xFF),
+    "b": (-0x80, 0x7F),
+    "H": (0, 0xFFFF),
+    "h": (-0x8000, 0x7FFF),
+}
+UINT24_MAX = 0xFFFFFF
+
+
+def clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+class IndoorBikeDataEncoder(object):
+    """
+    Packs Indoor Bike Data samples with one precompiled struct.Struct per flags word
+    """
+
+    def __init__(self):
+        self._layouts = {}
+
+    def get_layout(self, flags):
+        layout = self._layouts.get(flags)
+        if layout is None:
+            layout = self._compile(flags)
+            self._layouts[flags] = layout
+
+        return layout
+
+    def _compile(self, flags):
+        fmt = "<H"
+        fields = []
+        for flag, key, field_fmt, scale in INDOOR_BIKE_DATA_FIELDS:
+            present = not (flags & flag) if flag == IBD_MORE_DATA else flags & flag
+            if present:
+                fmt += field_fmt
+                fields.append((key, len(field_fmt), scale))
+
+        return struct.Struct(fmt), tuple(fields)
+
+    def encode(self, flags, sample):
+        packer, fields = self.get_layout(flags)
+        values = [flags]
+        for key, count, scale in fields:
+            if key == "distance":
+                # uint24 is split into a uint16 and a uint8
+                value = clamp(int(sample.get(key, 0)), 0, UINT24_MAX)
+                values.append(value & 0xFFFF)
+                values.append(value >> 16)
+            elif count > 1:
+                values.extend(int(v) for v in sample.get(key, (0,) * count))
+            else:
+                values.append(int(round(sample.get(key, 0) * scale)))
+
+        # Out of range sensor or replay values saturate instead of failing the pack
+        for i, fmt in enumerate(packer.format[2:], 1):
+            values[i] = clamp(values[i], *FORMAT_RANGES[fmt])
+
+        return packer.pack(*values)
+
+
+indoor_bike_data_encoder = IndoorBikeDataEncoder()
+
+
+def encode_indoor_bike_data(flags, sample):
+    return indoor_bike_data_encoder.encode(flags, sample)
+
+
+# Fitness Machine Control Point (0x2AD9) op codes
+CP_REQUEST_CONTROL = 0x00
+CP_RESET = 0x01
+CP_SET_TARGET_SPEED = 0x02
+CP_SET_TARGET_INCLINATION = 0x03
+CP_SET_TARGET_RESISTANCE_LEVEL = 0x04
+CP_SET_TARGET_POWER = 0x05
+CP_SET_TARGET_HEART_RATE = 0x06
+CP_START_OR_RESUME = 0x07
+CP_STOP_OR_PAUSE = 0x08
+CP_SET_INDOOR_BIKE_SIMULATION = 0x11
+CP_RESPONSE_CODE = 0x80
+
+# Control Point result codes
+CP_SUCCESS = 0x01
+CP_NOT_SUPPORTED = 0x02
+CP_INVALID_PARAMETER = 0x03
+CP_OPERATION_FAILED = 0x04
+CP_CONTROL_NOT_PERMITTED = 0x05
+
+# Stop or Pause parameter values
+CP_STOP = 0x01
+CP_PAUSE = 0x02
+
+# Fitness Machine Status (0x2ADA) op codes
+STATUS_RESET = 0x01
+STATUS_STOPPED_OR_PAUSED = 0x02
+STATUS_STARTED_OR_RESUMED = 0x04
+STATUS_TARGET_SPEED_CHANGED = 0x05
+STATUS_TARGET_INCLINATION_CHANGED = 0x06
+STATUS_TARGET_RESISTANCE_LEVEL_CHANGED = 0x07
+STATUS_TARGET_POWER_CHANGED = 0x08
+STATUS_TARGET_HEART_RATE_CHANGED = 0x09
+STATUS_INDOOR_BIKE_SIMULATION_CHANGED = 0x12
+STATUS_CONTROL_PERMISSION_LOST = 0xFF
+
+MACHINE_IDLE = "idle"
+MACHINE_RUNNING = "running"
+MACHINE_PAUSED = "paused"
+MACHINE_STOPPED = "stopped"
+
+# Response Code op code, request op code, result code for every possible request
+CP_RESPONSES = dict(((opcode, result), bytes([CP_RESPONSE_CODE, opcode, result]))
+                    for opcode in range(256)
+                    for result in range(CP_SUCCESS, CP_CONTROL_NOT_PERMITTED + 1))
+
+SPEED_PARAMETER = struct.Struct("<H")  # 0.01 km/h
+INCLINATION_PARAMETER = struct.Struct("<h")  # 0.1 %
+RESISTANCE_PARAMETER = struct.Struct("<B")  # 0.1, unitless
+POWER_PARAMETER = struct.Struct("<h")  # 1 W
+HEART_RATE_PARAMETER = struct.Struct("<B")  # 1 bpm
+STOP_OR_PAUSE_PARAMETER = struct.Struct("<B")
+# wind speed (0.001 m/s), grade (0.01 %), rolling resistance (0.0001), wind resistance (0.01 kg/m)
+SIMULATION_PARAMETERS = struct.Struct("<hhBB")
+
+
+class ControlPointEngine(object):
+    """
+    Fitness Machine Control Point request handling and control/ownership state.
+
+    handle() takes the raw request and returns the precomputed indication payload.
+    Status changes are queued as Fitness Machine Status payloads and handed to
+    status_callback by flush(), after the response has been indicated.
+    """
+
+    def __init__(self, status_callback=None, power_range=(0, 2000), resistance_range=(0, 100)):
+        self.status_callback = status_callback
+        self.power_range = power_range
+        # Resistance range in the 0.1 resolution of the request parameter
+        self.resistance_range = resistance_range
+        self.owner = None
+        self.has_control = False
+        self.state = MACHINE_IDLE
+        self.targets = {}
+        self.pending_status = []
+
+        # op code: (parameter layout, handler, requires control)
+        self.handlers = {
+            CP_REQUEST_CONTROL: (None, self.request_control, False),
+            CP_RESET: (None, self.reset, True),
+            CP_SET_TARGET_SPEED: (SPEED_PARAMETER, self.set_target_speed, True),
+            CP_SET_TARGET_INCLINATION: (INCLINATION_PARAMETER, self.set_target_inclination, True),
+            CP_SET_TARGET_RESISTANCE_LEVEL: (RESISTANCE_PARAMETER, self.set_target_resistance, True),
+            CP_SET_TARGET_POWER: (POWER_PARAMETER, self.set_target_power, True),
+            CP_SET_TARGET_HEART_RATE: (HEART_RATE_PARAMETER, self.set_target_heart_rate, True),
+            CP_START_OR_RESUME: (None, self.start, True),
+            CP_STOP_OR_PAUSE: (STOP_OR_PAUSE_PARAMETER, self.stop_or_pause, True),
+            CP_SET_INDOOR_BIKE_SIMULATION: (SIMULATION_PARAMETERS, self.set_simulation, True),
+        }
+
+    def handle(self, value, device=None):
+        if not value:
+            return None
+
+        opcode = value[0]
+        entry = self.handlers.get(opcode)
+        if entry is None:
+            return CP_RESPONSES[(opcode, CP_NOT_SUPPORTED)]
+
+        parameters, handler, requires_control = entry
+        if requires_control and (not self.has_control or device != self.owner):
+            return CP_RESPONSES[(opcode, CP_CONTROL_NOT_PERMITTED)]
+
+        if parameters is None:
+            result = handler(device)
+        elif len(value) != parameters.size + 1:
+            result = CP_INVALID_PARAMETER
+        else:
+            result = handler(*parameters.unpack_from(value, 1))
+
+        return CP_RESPONSES[(opcode, result)]
+
+    def notify_status(self, *payload):
+        self.pending_status.append(bytes(payload))
+
+    def flush(self):
+        pending, self.pending_status = self.pending_status, []
+        if self.status_callback is not None:
+            for value in pending:
+                self.status_callback(value)
+
+    def request_control(self, device):
+        if self.has_control and device != self.owner:
+            return CP_CONTROL_NOT_PERMITTED
+
+        self.has_control = True
+        self.owner = device
+
+        return CP_SUCCESS
+
+    def release_control(self, device):
+        # The owner disconnected: anyone may request control again
+        if not self.has_control or device != self.owner:
+            return False
+
+        self.has_control = False
+        self.owner = None
+        self.notify_status(STATUS_CONTROL_PERMISSION_LOST)
+
+        return True
+
+    def reset(self, device):
+        self.targets = {}
+        self.state = MACHINE_IDLE
+        self.has_control = False
+        self.owner = None
+        self.notify_status(STATUS_RESET)
+
+        return CP_SUCCESS
+
+    def set_target_speed(self, speed):
+        self.targets["speed"] = speed / 100.0
+        self.notify_status(STATUS_TARGET_SPEED_CHANGED, *SPEED_PARAMETER.pack(speed))
+
+        return CP_SUCCESS
+
+    def set_target_inclination(self, inclination):
+        self.targets["inclination"] = inclination / 10.0
+        self.notify_status(STATUS_TARGET_INCLINATION_CHANGED, *INCLINATION_PARAMETER.pack(inclination))
+
+        return CP_SUCCESS
+
+    def set_target_resistance(self, resistance):
+        if not self.resistance_range[0] <= resistance <= self.resistance_range[1]:
+            return CP_INVALID_PARAMETER
+
+        self.targets["resistance"] = resistance / 10.0
+        self.notify_status(STATUS_TARGET_RESISTANCE_LEVEL_CHANGED, resistance)
+
+        return CP_SUCCESS
+
+    def set_target_power(self, power):
+        if not self.power_range[0] <= power <= self.power_range[1]:
+            return CP_INVALID_PARAMETER
+
+        self.targets["power"] = power
+        self.notify_status(STATUS_TARGET_POWER_CHANGED, *POWER_PARAMETER.pack(power))
+
+        return CP_SUCCESS
+
+    def set_target_heart_rate(self, heart_rate):
+        self.targets["heart_rate"] = heart_rate
+        self.notify_status(STATUS_TARGET_HEART_RATE_CHANGED, heart_rate)
+
+        return CP_SUCCESS
+
+    def start(self, device):
+        self.state = MACHINE_RUNNING
+        self.notify_status(STATUS_STARTED_OR_RESUMED)
+
+        return CP_SUCCESS
+
+    def stop_or_pause(self, control):
+        if control == CP_STOP:
+            self.state = MACHINE_STOPPED
+        elif control == CP_PAUSE:
+            self.state = MACHINE_PAUSED
+        else:
+            return CP_INVALID_PARAMETER
+
+        self.notify_status(STATUS_STOPPED_OR_PAUSED, control)
+
+        return CP_SUCCESS
+
+    def set_simulation(self, wind_speed, grade, crr, cw):
+        self.targets["simulation"] = {
+            "wind_speed": wind_speed / 1000.0,
+            "grade": grade / 100.0,
+            "crr": crr / 10000.0,
+            "cw": cw / 100.0,
+        }
+        self.notify_status(STATUS_INDOOR_BIKE_SIMULATION_CHANGED,
+                           *SIMULATION_PARAMETERS.pack(wind_speed, grade, crr, cw))
+
+        return CP_SUCCESS
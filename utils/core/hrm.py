@@ -0,0 +1,79 @@
+import struct
+
+# Heart Rate Measurement (0x2A37) flag bits
+# Refer to: https://www.bluetooth.com/specifications/specs/heart-rate-service-1-0/
+HR_VALUE_UINT16 = 1 << 0
+HR_CONTACT_DETECTED = 1 << 1
+HR_CONTACT_SUPPORTED = 1 << 2
+HR_ENERGY_EXPENDED = 1 << 3
+HR_RR_INTERVAL = 1 << 4
+
+RR_RESOLUTION = 1024  # RR-Interval unit is 1/1024 s
+FIELD_MAX = 0xFFFF  # Energy Expended (kJ) and RR-Interval saturate here
+
+# Notifications carry ATT_MTU - 3 bytes of value; 23 is the default ATT_MTU
+DEFAULT_MTU = 23
+NOTIFY_OVERHEAD = 3
+
+# Heart Rate Control Point (0x2A39)
+HRCP_RESET_ENERGY_EXPENDED = 0x01
+HRCP_NOT_SUPPORTED = 0x80  # Control Point Not Supported error
+
+
+class HeartRateMeasurementEncoder(object):
+    """
+    Packs Heart Rate Measurement values with one precompiled struct.Struct per
+    (flags, RR-Interval count)
+    """
+
+    def __init__(self):
+        self._layouts = {}
+
+    def get_layout(self, flags, rr_count):
+        layout = self._layouts.get((flags, rr_count))
+        if layout is None:
+            fmt = "<B" + ("H" if flags & HR_VALUE_UINT16 else "B")
+            if flags & HR_ENERGY_EXPENDED:
+                fmt += "H"
+            fmt += "H" * rr_count
+            layout = self._layouts[(flags, rr_count)] = struct.Struct(fmt)
+
+        return layout
+
+    @staticmethod
+    def max_rr_intervals(flags, mtu=DEFAULT_MTU):
+        size = 2 + (1 if flags & HR_VALUE_UINT16 else 0) + (2 if flags & HR_ENERGY_EXPENDED else 0)
+
+        return max(0, (mtu - NOTIFY_OVERHEAD - size) // 2)
+
+    def encode(self, heart_rate, contact=None, energy=None, rr_intervals=(), mtu=DEFAULT_MTU):
+        # contact is None when contact detection is not supported, energy is in kJ and
+        # rr_intervals in seconds, oldest first. Returns (value, RR-Intervals packed);
+        # the caller keeps the rest for the next notification.
+        heart_rate = max(0, int(round(heart_rate)))
+        flags = 0
+        if heart_rate > 0xFF:
+            flags |= HR_VALUE_UINT16
+            heart_rate = min(heart_rate, FIELD_MAX)
+        if contact is not None:
+            flags |= HR_CONTACT_SUPPORTED | (HR_CONTACT_DETECTED if contact else 0)
+
+        values = [heart_rate]
+        if energy is not None:
+            flags |= HR_ENERGY_EXPENDED
+            values.append(min(max(0, int(energy)), FIELD_MAX))
+
+        count = min(len(rr_intervals), self.max_rr_intervals(flags, mtu))
+        if count:
+            flags |= HR_RR_INTERVAL
+            values.extend(min(int(round(rr * RR_RESOLUTION)), FIELD_MAX)
+                          for rr in rr_intervals[:count])
+
+        return self.get_layout(flags, count).pack(flags, *values), count
+
+
+heart_rate_measurement_encoder = HeartRateMeasurementEncoder()
+
+
+def encode_heart_rate_measurement(heart_rate, contact=None, energy=None, rr_intervals=(), mtu=DEFAULT_MTU):
+    return heart_rate_measurement_encoder.encode(heart_rate, contact, energy, rr_intervals, mtu)
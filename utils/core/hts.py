@@ -0,0 +1,107 @@
+import struct
+import time
+
+# Temperature Measurement (0x2A1C) and Intermediate Temperature (0x2A1E) flag bits
+# Refer to: https://www.bluetooth.com/specifications/specs/health-thermometer-service-1-0/
+TM_FAHRENHEIT = 1 << 0
+TM_TIME_STAMP = 1 << 1
+TM_TEMPERATURE_TYPE = 1 << 2
+
+# Temperature Type (0x2A1D) values
+TEMPERATURE_TYPE_ARMPIT = 0x01
+TEMPERATURE_TYPE_BODY = 0x02
+TEMPERATURE_TYPE_EAR = 0x03
+TEMPERATURE_TYPE_FINGER = 0x04
+TEMPERATURE_TYPE_GASTRO_INTESTINAL = 0x05
+TEMPERATURE_TYPE_MOUTH = 0x06
+TEMPERATURE_TYPE_RECTUM = 0x07
+TEMPERATURE_TYPE_TOE = 0x08
+TEMPERATURE_TYPE_TYMPANUM = 0x09
+
+# IEEE-11073 32-bit FLOAT: int8 exponent in the top byte, int24 mantissa below it
+FLOAT_NAN = 0x007FFFFF
+FLOAT_MANTISSA_MAX = 0x7FFFFD
+FLOAT_EXPONENT_MAX = 127
+
+# Date Time: year, month, day, hours, minutes, seconds
+TIME_STAMP_FORMAT = "HBBBBB"
+
+MEASUREMENT_INTERVAL = struct.Struct("<H")  # 1 s, 0 disables periodic measurements
+
+
+def encode_float(value, precision=1):
+    # precision is the number of decimal digits kept in the mantissa
+    if value is None or value != value:
+        return FLOAT_NAN
+
+    mantissa = int(round(value * 10 ** precision))
+    exponent = -precision
+    while abs(mantissa) > FLOAT_MANTISSA_MAX and exponent < FLOAT_EXPONENT_MAX:
+        mantissa = int(round(mantissa / 10.0))
+        exponent += 1
+
+    return ((exponent & 0xFF) << 24) | (mantissa & 0xFFFFFF)
+
+
+def decode_float(raw):
+    mantissa = raw & 0xFFFFFF
+    if mantissa == FLOAT_NAN:
+        return float("nan")
+    if mantissa & 0x800000:
+        mantissa -= 1 << 24
+    exponent = raw >> 24
+    if exponent & 0x80:
+        exponent -= 1 << 8
+
+    return mantissa * 10.0 ** exponent
+
+
+class TemperatureMeasurementEncoder(object):
+    """
+    Packs Temperature Measurement and Intermediate Temperature values with one
+    precompiled struct.Struct per flags byte
+    """
+
+    def __init__(self, precision=1):
+        self.precision = precision
+        self._layouts = {}
+
+    def get_layout(self, flags):
+        layout = self._layouts.get(flags)
+        if layout is None:
+            fmt = "<BI"
+            if flags & TM_TIME_STAMP:
+                fmt += TIME_STAMP_FORMAT
+            if flags & TM_TEMPERATURE_TYPE:
+                fmt += "B"
+            layout = self._layouts[flags] = struct.Struct(fmt)
+
+        return layout
+
+    def encode(self, temperature, fahrenheit=False, timestamp=None, temperature_type=None):
+        # timestamp is seconds since the epoch, sent as local time
+        flags = TM_FAHRENHEIT if fahrenheit else 0
+        values = [encode_float(temperature, self.precision)]
+        if timestamp is not None:
+            flags |= TM_TIME_STAMP
+            values.extend(time.localtime(timestamp)[:6])
+        if temperature_type is not None:
+            flags |= TM_TEMPERATURE_TYPE
+            values.append(temperature_type)
+
+        return self.get_layout(flags).pack(flags, *values)
+
+
+temperature_measurement_encoder = TemperatureMeasurementEncoder()
+
+
+def encode_temperature_measurement(temperature, fahrenheit=False, timestamp=None, temperature_type=None):
+    return temperature_measurement_encoder.encode(temperature, fahrenheit, timestamp, temperature_type)
+
+
+def encode_measurement_interval(seconds):
+    return MEASUREMENT_INTERVAL.pack(seconds)
+
+
+def decode_measurement_interval(value):
+    return MEASUREMENT_INTERVAL.unpack(bytes(value))[0]
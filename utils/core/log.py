@@ -0,0 +1,120 @@
+import atexit
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import signal
+import sys
+
+# e.g. BLE_LOG_LEVELS="INFO,gatt=DEBUG,ftms=WARNING"; a bare level applies to all subsystems
+LOG_LEVELS_ENV = "BLE_LOG_LEVELS"
+ROOT_LOGGER = "herl"
+DEFAULT_LEVEL = logging.INFO
+RECENT_CAPACITY = 1000
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+listener = None
+recent = None
+
+
+def get_logger(subsystem):
+    return logging.getLogger(ROOT_LOGGER + "." + subsystem)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() merges the message and arguments in the calling thread,
+    which is the work the queue is there to move off the main loop.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RecentHandler(logging.Handler):
+    """
+    Keeps the last capacity records in memory, formatted only when dumped
+    """
+
+    def __init__(self, capacity=RECENT_CAPACITY):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream=None):
+        stream = stream or sys.stderr
+        for record in list(self.records):
+            stream.write(self.format(record) + "\n")
+        stream.flush()
+
+
+def parse_levels(spec):
+    # "INFO,gatt=DEBUG" -> {"": INFO, "gatt": DEBUG}
+    levels = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        subsystem, _, name = item.rpartition("=")
+        name = name.strip().upper()
+        level = int(name) if name.isdigit() else logging.getLevelName(name)
+        if not isinstance(level, int):
+            # getLevelName maps names it does not know to "Level <name>"
+            logging.getLogger(ROOT_LOGGER).warning("Ignoring unknown log level %r in %s",
+                                                   item, LOG_LEVELS_ENV)
+            continue
+        levels[subsystem.strip()] = level
+
+    return levels
+
+
+def set_levels(levels):
+    for subsystem, level in levels.items():
+        name = ROOT_LOGGER + "." + subsystem if subsystem else ROOT_LOGGER
+        logging.getLogger(name).setLevel(level)
+
+
+def dump_recent(stream=None):
+    if recent is not None:
+        recent.dump(stream)
+
+
+def setup_logging(levels=None, stream=None, capacity=RECENT_CAPACITY, dump_signal=signal.SIGUSR1):
+    """
+    Route the herl loggers through a queue to a listener thread writing to stream.
+
+    levels maps subsystem names to levels ("" for all of them) and defaults to
+    the BLE_LOG_LEVELS environment variable. Records that pass the level gate are
+    also kept in memory and written to stderr by dump_recent() or dump_signal.
+    """
+    global listener, recent
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(DEFAULT_LEVEL)
+    if levels is None:
+        levels = parse_levels(os.environ.get(LOG_LEVELS_ENV, ""))
+    set_levels(levels)
+
+    if listener is not None:
+        return logger
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    recent = RecentHandler(capacity)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, output, recent)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.addHandler(DeferredQueueHandler(records))
+    logger.propagate = False
+    if dump_signal is not None:
+        signal.signal(dump_signal, lambda signum, frame: dump_recent())
+
+    return logger
@@ -0,0 +1,228 @@
+import functools
+import os
+import time
+
+# Each power of two is split into this many linear steps, which bounds the
+# relative error of a recorded value to 1/SUB_BUCKETS
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+LINEAR_LIMIT = SUB_BUCKETS * 2
+
+QUANTILES = (0.5, 0.9, 0.99)
+SUBSCRIPTION_HANDLERS = ("StartNotify", "StopNotify")
+
+
+class Histogram(object):
+    """
+    HDR-style histogram of durations, recorded in whole microseconds.
+
+    Values below LINEAR_LIMIT get a bucket each; above that every power of two
+    is split into SUB_BUCKETS buckets, so the bucket count grows with log(max).
+    """
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(value):
+        if value < LINEAR_LIMIT:
+            return value
+
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        return LINEAR_LIMIT + (shift - 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def bucket_value(index):
+        # Upper bound of the bucket
+        if index < LINEAR_LIMIT:
+            return index
+
+        shift = (index - LINEAR_LIMIT) // SUB_BUCKETS + 1
+        mantissa = (index - LINEAR_LIMIT) % SUB_BUCKETS + SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        index = self.bucket(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        # Seconds
+        if self.count == 0:
+            return 0.0
+
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.bucket_value(index) / 1e6, self.max)
+
+        return self.max
+
+
+class ObjectMetrics(object):
+    """
+    Counters and histograms for one exported D-Bus object
+    """
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+        self.notifications = 0
+        self.dropped = 0
+        self.notify_interval = Histogram()
+        self.last_notify = None
+        self.subscribed = False
+
+    def observe(self, name, seconds, failed=False):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram()
+        histogram.record(seconds)
+
+    def notified(self):
+        now = time.monotonic()
+        if self.last_notify is not None:
+            self.notify_interval.record(now - self.last_notify)
+        self.last_notify = now
+        self.notifications += 1
+
+    def snapshot(self):
+        stats = {"subscribed": float(self.subscribed), "notifications": float(self.notifications),
+                 "dropped": float(self.dropped)}
+        for name, calls in self.calls.items():
+            stats[name + ".calls"] = float(calls)
+            stats[name + ".errors"] = float(self.errors.get(name, 0))
+            for fraction in QUANTILES:
+                stats["%s.p%g" % (name, fraction * 100)] = self.latency[name].quantile(fraction)
+        if self.notify_interval.count:
+            for fraction in QUANTILES:
+                stats["notify_interval.p%g" % (fraction * 100)] = self.notify_interval.quantile(fraction)
+
+        return stats
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, path, kind):
+        metrics = self.objects.get(path)
+        if metrics is None:
+            metrics = self.objects[path] = ObjectMetrics(path, kind)
+
+        return metrics
+
+    def snapshot(self):
+        return dict((path, metrics.snapshot()) for path, metrics in self.objects.items())
+
+    def prometheus(self, prefix="ble"):
+        # Samples are grouped per metric family, as the text format requires
+        families = [
+            ("calls_total", "counter"),
+            ("errors_total", "counter"),
+            ("handler_seconds", "summary"),
+            ("notifications_total", "counter"),
+            ("dropped_total", "counter"),
+            ("notify_interval_seconds", "summary"),
+            ("subscribed", "gauge"),
+        ]
+        samples = dict((family, []) for family, _ in families)
+
+        def sample(family, name, labels, value):
+            label_text = ",".join('%s="%s"' % item for item in sorted(labels.items()))
+            samples[family].append("%s_%s{%s} %r" % (prefix, name, label_text, float(value)))
+
+        def summary(family, labels, histogram):
+            for fraction in QUANTILES:
+                sample(family, family, dict(labels, quantile=str(fraction)),
+                       histogram.quantile(fraction))
+            sample(family, family + "_sum", labels, histogram.total)
+            sample(family, family + "_count", labels, histogram.count)
+
+        for path, metrics in sorted(self.objects.items()):
+            base = {"path": path, "kind": metrics.kind}
+            for name, calls in sorted(metrics.calls.items()):
+                labels = dict(base, method=name)
+                sample("calls_total", "calls_total", labels, calls)
+                sample("errors_total", "errors_total", labels, metrics.errors.get(name, 0))
+                summary("handler_seconds", labels, metrics.latency[name])
+            if metrics.kind == "characteristic":
+                sample("notifications_total", "notifications_total", base, metrics.notifications)
+                sample("dropped_total", "dropped_total", base, metrics.dropped)
+                sample("subscribed", "subscribed", base, metrics.subscribed)
+                summary("notify_interval_seconds", base, metrics.notify_interval)
+
+        lines = []
+        for family, kind in families:
+            lines.append("# TYPE %s_%s %s" % (prefix, family, kind))
+            lines.extend(samples[family])
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename):
+        # Replace atomically so a scraper never reads a partial file
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.prometheus())
+        os.replace(temporary, filename)
+
+
+registry = MetricsRegistry()
+
+
+def instrumented(name, func):
+    # Wraps a handler so each call records latency and failures in self.metrics,
+    # and the call in self.recorder when a session is being recorded.
+    # functools.wraps keeps the dbus-python method attributes of decorated handlers.
+    if getattr(func, "instrumented", False):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        result = None
+        try:
+            result = func(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self.metrics.observe(name, time.perf_counter() - start, failed)
+            if name in SUBSCRIPTION_HANDLERS:
+                self.metrics.subscribed = bool(getattr(self, "notifying", False))
+            recorder = getattr(self, "recorder", None)
+            if recorder is not None:
+                recorder.handled(self, name, args, result)
+
+    wrapper.instrumented = True
+
+    return wrapper
+
+
+def instrument(cls, names):
+    for name in names:
+        func = cls.__dict__.get(name)
+        if func is not None:
+            setattr(cls, name, instrumented(name, func))
@@ -0,0 +1,207 @@
+"""Binary session log of everything the GATT server sent and received.
+
+A recording is a 32 byte file header followed by records:
+
+    timestamp  Q  time.monotonic_ns() of the event
+    path id    H  object, declared by an OP_PATH record before first use
+    opcode     B  OP_*
+    length     H  payload bytes that follow
+
+The file is preallocated and memory mapped, so appending a record is a
+pack_into and a slice copy with no system call; the kernel writes dirty pages
+back on its own schedule. OP_PATH records carry the object path and UUID,
+separated by a NUL. The map grows by another preallocation when full and
+the file is truncated to the records written on close. A zero opcode marks the
+end of a log that was not closed cleanly.
+
+    python -m utils.core.recorder ride.herl
+"""
+import collections
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"HERLREC1"
+VERSION = 1
+# magic, version, time.time_ns() and time.monotonic_ns() when the recording started
+FILE_HEADER = struct.Struct("<8sIQQ4x")
+RECORD_HEADER = struct.Struct("<QHBH")
+
+OP_END = 0
+OP_PATH = 1
+OP_NOTIFY = 2
+OP_READ = 3
+OP_WRITE = 4
+OP_START_NOTIFY = 5
+OP_STOP_NOTIFY = 6
+
+OPCODE_NAMES = {
+    OP_PATH: "path",
+    OP_NOTIFY: "notify",
+    OP_READ: "read",
+    OP_WRITE: "write",
+    OP_START_NOTIFY: "start-notify",
+    OP_STOP_NOTIFY: "stop-notify",
+}
+HANDLER_OPCODES = {
+    "ReadValue": OP_READ,
+    "WriteValue": OP_WRITE,
+    "StartNotify": OP_START_NOTIFY,
+    "StopNotify": OP_STOP_NOTIFY,
+}
+
+# 10 Hz from a handful of characteristics is a few MiB an hour
+PREALLOCATE = 16 * 1024 * 1024
+
+Record = collections.namedtuple("Record", ("timestamp", "path", "uuid", "opcode", "value"))
+
+
+class SessionRecorder(object):
+    """
+    Appends records to a preallocated, memory mapped log.
+
+    Records are written from the main loop only: the D-Bus handlers and
+    notifications that feed it all run there.
+    """
+
+    def __init__(self, filename, preallocate=PREALLOCATE):
+        self.filename = filename
+        self.preallocate = preallocate
+        self.paths = {}
+        self.dropped = 0
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.size = 0
+        self.map = None
+        self.grow(FILE_HEADER.size)
+        FILE_HEADER.pack_into(self.map, 0, MAGIC, VERSION, time.time_ns(), time.monotonic_ns())
+        self.offset = FILE_HEADER.size
+
+    def grow(self, needed):
+        # Allocating the blocks up front keeps SD card writes from failing with
+        # SIGBUS on a full disk and keeps the log contiguous
+        size = self.size + max(self.preallocate, needed)
+        os.posix_fallocate(self.fd, 0, size)
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, size)
+        self.size = size
+
+    def path_id(self, obj):
+        path_id = self.paths.get(obj.path)
+        if path_id is None:
+            path_id = len(self.paths)
+            if path_id > 0xFFFF:
+                return None
+            self.paths[obj.path] = path_id
+            self.append(path_id, OP_PATH, ("%s\0%s" % (obj.path, obj.uuid)).encode("utf-8"))
+
+        return path_id
+
+    def append(self, path_id, opcode, value):
+        end = self.offset + RECORD_HEADER.size + len(value)
+        if end > self.size:
+            try:
+                self.grow(end - self.size)
+            except OSError:
+                self.dropped += 1
+                return
+
+        # Payload first, so a record is never complete before its data
+        self.map[self.offset + RECORD_HEADER.size:end] = value
+        RECORD_HEADER.pack_into(self.map, self.offset, time.monotonic_ns(), path_id, opcode, len(value))
+        self.offset = end
+
+    def record(self, obj, opcode, value=b""):
+        # obj is the characteristic or descriptor, identified by its path and uuid
+        if self.map is None:
+            return
+
+        path_id = self.path_id(obj)
+        if path_id is None:
+            self.dropped += 1
+            return
+
+        self.append(path_id, opcode, bytes(value))
+
+    def notified(self, obj, value):
+        self.record(obj, OP_NOTIFY, value)
+
+    def handled(self, obj, name, args, result):
+        # Called by the instrumented D-Bus handlers: reads log what was returned,
+        # failed reads nothing, writes what was received
+        opcode = HANDLER_OPCODES.get(name)
+        if opcode == OP_READ:
+            if result is not None:
+                self.record(obj, opcode, result)
+        elif opcode == OP_WRITE:
+            self.record(obj, opcode, args[0])
+        elif opcode is not None:
+            self.record(obj, opcode)
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+        return True
+
+    def close(self):
+        if self.map is None:
+            return
+
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        os.ftruncate(self.fd, self.offset)
+        os.close(self.fd)
+
+
+def read_records(filename):
+    """
+    Lazily yield the Records of a recording, oldest first.
+
+    Timestamps are wall clock seconds; they advance with the monotonic clock of
+    the recording, so gaps between records are exact even if the clock was set.
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < FILE_HEADER.size:
+            raise ValueError("%s is not a recording" % filename)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, wall_ns, monotonic_ns = FILE_HEADER.unpack_from(data)
+            if magic != MAGIC:
+                raise ValueError("%s is not a recording" % filename)
+            if version != VERSION:
+                raise ValueError("Unsupported recording version %d" % version)
+
+            paths = {}
+            offset = FILE_HEADER.size
+            while offset + RECORD_HEADER.size <= size:
+                timestamp, path_id, opcode, length = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                if opcode == OP_END or start + length > size:
+                    break
+
+                value = data[start:start + length]
+                offset = start + length
+                if opcode == OP_PATH:
+                    path, _, uuid = value.decode("utf-8").partition("\0")
+                    paths[path_id] = (path, uuid)
+                    continue
+
+                path, uuid = paths.get(path_id, (None, None))
+                yield Record((wall_ns + timestamp - monotonic_ns) / 1e9, path, uuid, opcode, value)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for filename in argv:
+        for record in read_records(filename):
+            print("%.6f %-12s %s %s %s" % (record.timestamp, OPCODE_NAMES.get(record.opcode, record.opcode),
+                                           record.path, record.uuid, record.value.hex()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""Replay a recorded ride into the sensor hub.
+
+Rides come from a CSV file, a FIT activity or a session recording made with
+utils.core.recorder. Every reader is a generator over the file, read through a
+CHUNK_SIZE buffer, so hours of data never sit in memory. RideReplay pushes the
+samples into the hub on its own thread, time_scale times faster than they were
+recorded, and the profiles serve them as if they came from live sensors.
+"""
+import collections
+import csv
+import datetime
+import struct
+import threading
+import time
+
+from utils.core.codec import decode_indoor_bike_data, decode_heart_rate_measurement
+from utils.core.ftms import STATUS_STARTED_OR_RESUMED, STATUS_STOPPED_OR_PAUSED, CP_STOP
+from utils.core.log import get_logger
+from utils.core.recorder import read_records, MAGIC, OP_NOTIFY
+from utils.core.samples import sensors, SPEED, CADENCE, POWER, HEART_RATE, RR_INTERVAL
+from utils.core.samples import ENERGY_EXPENDED, SENSOR_CONTACT
+
+CHUNK_SIZE = 64 * 1024
+
+# One ride sample: channel values to push and an optional Fitness Machine Status payload
+RideSample = collections.namedtuple("RideSample", ("timestamp", "values", "status"))
+
+# Lower case CSV header -> (channel, scale to the channel's unit)
+CSV_COLUMNS = {
+    "power": (POWER, 1.0),
+    "watts": (POWER, 1.0),
+    "cadence": (CADENCE, 1.0),
+    "rpm": (CADENCE, 1.0),
+    "speed": (SPEED, 1.0),
+    "kph": (SPEED, 1.0),
+    "speed_kmh": (SPEED, 1.0),
+    "speed_mps": (SPEED, 3.6),
+    "heart_rate": (HEART_RATE, 1.0),
+    "heartrate": (HEART_RATE, 1.0),
+    "hr": (HEART_RATE, 1.0),
+    "bpm": (HEART_RATE, 1.0),
+}
+CSV_TIME_COLUMNS = ("timestamp", "time", "elapsed", "seconds", "secs")
+# Rows without a time column are taken to be this far apart
+CSV_INTERVAL = 1.0
+
+FIT_HEADER = struct.Struct("<BBHI4s")
+FIT_EPOCH = 631065600  # 1989-12-31T00:00:00Z in Unix time
+FIT_RECORD = 20
+# record field number -> (channel, scale to the channel's unit)
+FIT_FIELDS = {
+    3: (HEART_RATE, 1.0),
+    4: (CADENCE, 1.0),
+    6: (SPEED, 3.6 / 1000),
+    7: (POWER, 1.0),
+    73: (SPEED, 3.6 / 1000),  # enhanced_speed
+}
+FIT_TIMESTAMP = 253
+FIT_INVALID = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
+FIT_INTEGERS = {1: "B", 2: "H", 4: "I"}
+
+INDOOR_BIKE_DATA_UUID = 0x2AD2
+HEART_RATE_MEASUREMENT_UUID = 0x2A37
+FITNESS_MACHINE_STATUS_UUID = 0x2ADA
+BASE_UUID_SUFFIX = "-0000-1000-8000-00805f9b34fb"
+
+log = get_logger("replay")
+
+
+def parse_time(text):
+    # Seconds, an [h:]mm:ss[.f] duration, or an ISO 8601 date and time
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    parts = text.split(":")
+    if 2 <= len(parts) <= 3:
+        try:
+            seconds = 0.0
+            for part in parts:
+                seconds = seconds * 60 + float(part)
+            return seconds
+        except ValueError:
+            pass
+
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def read_csv(filename):
+    with open(filename, newline="", buffering=CHUNK_SIZE) as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader, [])]
+        time_column = next((header.index(name) for name in CSV_TIME_COLUMNS if name in header), None)
+        columns = [(i, CSV_COLUMNS[name]) for i, name in enumerate(header) if name in CSV_COLUMNS]
+
+        for row_number, row in enumerate(reader):
+            if not row:
+                continue
+            if time_column is None:
+                timestamp = row_number * CSV_INTERVAL
+            else:
+                timestamp = parse_time(row[time_column].strip())
+
+            values = []
+            for i, (channel, scale) in columns:
+                cell = row[i].strip() if i < len(row) else ""
+                if cell:
+                    values.append((channel, float(cell) * scale))
+
+            yield RideSample(timestamp, values, None)
+
+
+def read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated FIT file %s" % f.name)
+
+    return data
+
+
+def read_fit(filename):
+    """
+    Yield the record messages of a FIT activity.
+
+    Only what a replay needs is decoded: timestamp, heart rate, cadence, speed and
+    power of each record; every other message is skipped by its definition.
+    """
+    with open(filename, "rb", buffering=CHUNK_SIZE) as f:
+        header_size = read_exact(f, 1)[0]
+        if header_size < FIT_HEADER.size:
+            raise ValueError("%s is not a FIT file" % filename)
+        header = read_exact(f, header_size - 1)
+        _, _, _, data_size, signature = FIT_HEADER.unpack_from(bytes([header_size]) + header)
+        if signature != b".FIT":
+            raise ValueError("%s is not a FIT file" % filename)
+
+        definitions = {}
+        timestamp = 0
+        remaining = data_size
+        while remaining > 0:
+            byte = f.read(1)
+            if not byte:
+                break
+            record_header = byte[0]
+            remaining -= 1
+
+            if record_header & 0x80:
+                # Compressed timestamp header: 5 bit offset from the last full timestamp
+                local = (record_header >> 5) & 0x03
+                offset = record_header & 0x1F
+                timestamp = (timestamp & ~0x1F) + offset + (0x20 if offset < (timestamp & 0x1F) else 0)
+                compressed = True
+            else:
+                local = record_header & 0x0F
+                compressed = False
+
+            if not compressed and record_header & 0x40:
+                definition = read_exact(f, 5)
+                endian = ">" if definition[1] else "<"
+                global_number, field_count = struct.unpack_from(endian + "HB", definition, 2)
+                fields = [struct.unpack("BBB", read_exact(f, 3)) for _ in range(field_count)]
+                size = 5 + 3 * field_count
+                if record_header & 0x20:
+                    developer_count = read_exact(f, 1)[0]
+                    developer_size = sum(read_exact(f, 3)[1] for _ in range(developer_count))
+                    size += 1 + 3 * developer_count
+                else:
+                    developer_size = 0
+                definitions[local] = (global_number, endian, fields, developer_size)
+                remaining -= size
+                continue
+
+            if local not in definitions:
+                raise ValueError("FIT message uses undefined local type %d" % local)
+            global_number, endian, fields, developer_size = definitions[local]
+            data = read_exact(f, sum(field[1] for field in fields) + developer_size)
+            remaining -= len(data)
+            if global_number != FIT_RECORD:
+                continue
+
+            values = []
+            position = 0
+            for number, size, base_type in fields:
+                raw = data[position:position + size]
+                position += size
+                if size not in FIT_INTEGERS:
+                    continue
+                value = struct.unpack(endian + FIT_INTEGERS[size], raw)[0]
+                if value == FIT_INVALID[size]:
+                    continue
+                if number == FIT_TIMESTAMP:
+                    timestamp = value
+                elif number in FIT_FIELDS:
+                    channel, scale = FIT_FIELDS[number]
+                    values.append((channel, value * scale))
+
+            yield RideSample(FIT_EPOCH + timestamp, values, None)
+
+
+def short_uuid(uuid):
+    # 16 bit UUID of "0x2AD2", "2ad2" or the full Bluetooth base UUID, else None
+    uuid = (uuid or "").lower()
+    try:
+        if uuid.startswith("0x"):
+            return int(uuid, 16)
+        if len(uuid) == 4:
+            return int(uuid, 16)
+        if len(uuid) == 36 and uuid.startswith("0000") and uuid.endswith(BASE_UUID_SUFFIX):
+            return int(uuid[4:8], 16)
+    except ValueError:
+        pass
+
+    return None
+
+
+def read_recording(filename):
+    # What the peripheral notified, decoded back into channel values
+    for record in read_records(filename):
+        if record.opcode != OP_NOTIFY:
+            continue
+
+        uuid = short_uuid(record.uuid)
+        try:
+            if uuid == INDOOR_BIKE_DATA_UUID:
+                data = decode_indoor_bike_data(record.value)
+                values = [(channel, value) for channel, value in
+                          ((SPEED, data.speed), (CADENCE, data.cadence), (POWER, data.power),
+                           (HEART_RATE, data.heart_rate)) if value is not None]
+                yield RideSample(record.timestamp, values, None)
+            elif uuid == HEART_RATE_MEASUREMENT_UUID:
+                data = decode_heart_rate_measurement(record.value)
+                values = [(HEART_RATE, data.heart_rate)]
+                if data.energy is not None:
+                    values.append((ENERGY_EXPENDED, data.energy))
+                if data.contact is not None:
+                    values.append((SENSOR_CONTACT, float(data.contact)))
+                values.extend((RR_INTERVAL, rr) for rr in data.rr_intervals)
+                yield RideSample(record.timestamp, values, None)
+            elif uuid == FITNESS_MACHINE_STATUS_UUID:
+                yield RideSample(record.timestamp, [], record.value)
+        except (IndexError, ValueError, struct.error) as e:
+            log.debug("Skipping malformed %s notification: %s", record.uuid, e)
+
+
+def open_ride(filename):
+    # Picks the reader by file contents, falling back to the extension
+    with open(filename, "rb") as f:
+        head = f.read(len(MAGIC) + 12)
+
+    if head.startswith(MAGIC):
+        return read_recording(filename)
+    if head[8:12] == b".FIT" or filename.lower().endswith(".fit"):
+        return read_fit(filename)
+
+    return read_csv(filename)
+
+
+class RideReplay(threading.Thread):
+    """
+    Pushes the samples of a ride file into the hub at time_scale times real time.
+
+    A time_scale of 0 pushes samples as fast as the file is read, for soak tests.
+    Each status listener is called with every Fitness Machine Status payload: a
+    started one before the first sample, those found in a recording, and a
+    stopped one at the end. Listeners run on the replay thread.
+    """
+
+    def __init__(self, filename, time_scale=1.0, hub=sensors, loop=False):
+        threading.Thread.__init__(self, name="replay", daemon=True)
+        self.filename = filename
+        self.time_scale = time_scale
+        self.hub = hub
+        self.loop = loop
+        self.status_listeners = []
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def add_status_listener(self, callback):
+        self.status_listeners.append(callback)
+
+    def notify_status(self, value):
+        for callback in self.status_listeners:
+            callback(value)
+
+    def replay(self):
+        # Returns the number of samples pushed
+        start = time.monotonic()
+        first = None
+        count = 0
+        for sample in open_ride(self.filename):
+            if self.stopped.is_set():
+                break
+            if first is None:
+                first = sample.timestamp
+
+            if self.time_scale:
+                delay = start + (sample.timestamp - first) / self.time_scale - time.monotonic()
+                if delay > 0 and self.stopped.wait(delay):
+                    break
+
+            for channel, value in sample.values:
+                self.hub.push(channel, value)
+            if sample.status is not None:
+                self.notify_status(sample.status)
+            count += 1
+            self.samples += 1
+
+        return count
+
+    def run(self):
+        log.info("Replaying %s at %sx", self.filename, self.time_scale or "max")
+        self.notify_status(bytes([STATUS_STARTED_OR_RESUMED]))
+        try:
+            while self.replay() and self.loop and not self.stopped.is_set():
+                pass
+        except (OSError, ValueError, IndexError, KeyError, struct.error) as e:
+            # Malformed rows or files end the replay, not the process
+            log.error("Replay of %s failed: %s", self.filename, e)
+        finally:
+            self.notify_status(bytes([STATUS_STOPPED_OR_PAUSED, CP_STOP]))
+            log.info("Replay of %s finished after %d samples", self.filename, self.samples)
+
+    def stop(self):
+        self.stopped.set()
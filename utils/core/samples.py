@@ -0,0 +1,167 @@
+import array
+import threading
+import time
+
+# Channels pushed by the sensor readers and read by the GATT characteristics
+SPEED = "speed"  # km/h
+CADENCE = "cadence"  # rpm
+POWER = "power"  # W
+HEART_RATE = "heart_rate"  # bpm
+TEMPERATURE = "temperature"  # degrees Celsius
+RR_INTERVAL = "rr_interval"  # s, one sample per beat
+ENERGY_EXPENDED = "energy_expended"  # kJ since the producer started
+SENSOR_CONTACT = "sensor_contact"  # 1 in contact, 0 not
+
+RING_CAPACITY = 1024
+
+
+class SampleRing(object):
+    """
+    Fixed size, array backed ring of timestamped samples with a single producer.
+
+    The producer fills a slot before publishing it by bumping count, so readers
+    never take a lock and never see a half written sample. Window reads retry
+    if the producer lapped them while they were copying.
+    """
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.values = array.array("d", bytes(8 * capacity))
+        self.times = array.array("d", bytes(8 * capacity))
+        self.count = 0
+
+    def push(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        index = self.count % self.capacity
+        self.values[index] = value
+        self.times[index] = timestamp
+        self.count += 1
+
+    def latest(self, default=None):
+        count = self.count
+        if count == 0:
+            return default
+
+        return self.values[(count - 1) % self.capacity]
+
+    def latest_sample(self):
+        count = self.count
+        if count == 0:
+            return None
+
+        index = (count - 1) % self.capacity
+        return self.times[index], self.values[index]
+
+    def window(self, seconds=None, samples=None, since=None):
+        # Oldest first list of (timestamp, value). Limits combine: at most `samples`
+        # entries, none older than `seconds`, none published before count `since`.
+        while True:
+            count = self.count
+            n = min(count, self.capacity)
+            if samples is not None:
+                n = min(n, samples)
+            if since is not None:
+                n = min(n, max(count - since, 0))
+
+            oldest = time.monotonic() - seconds if seconds is not None else None
+            result = []
+            for position in range(count - 1, count - n - 1, -1):
+                index = position % self.capacity
+                timestamp = self.times[index]
+                if oldest is not None and timestamp < oldest:
+                    break
+                result.append((timestamp, self.values[index]))
+
+            if self.count - count + n <= self.capacity:
+                result.reverse()
+                return result
+
+
+class SensorHub(object):
+    """
+    Named SampleRings shared between sensor producers and the GATT characteristics
+    """
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.rings = {}
+        self.sources = {}
+
+    def ring(self, channel):
+        ring = self.rings.get(channel)
+        if ring is None:
+            ring = self.rings.setdefault(channel, SampleRing(self.capacity))
+
+        return ring
+
+    def attach(self, source):
+        # Serve latest() for the source's channels from it, e.g. a shared memory
+        # SampleSegment written by an acquisition process
+        for channel in source.channels:
+            self.sources[channel] = source
+
+    def push(self, channel, value, timestamp=None):
+        self.ring(channel).push(value, timestamp)
+
+    def latest(self, channel, default=None):
+        source = self.sources.get(channel)
+        if source is not None:
+            return source.latest(channel, default)
+
+        ring = self.rings.get(channel)
+        if ring is None:
+            return default
+
+        return ring.latest(default)
+
+    def window(self, channel, seconds=None, samples=None, since=None):
+        ring = self.rings.get(channel)
+        if ring is None:
+            return []
+
+        return ring.window(seconds, samples, since)
+
+
+class SensorProducer(threading.Thread):
+    """
+    Polls a reader function at a fixed rate on its own thread and pushes into the hub.
+
+    The reader returns the value for channel, or None to skip the sample.
+    """
+
+    def __init__(self, hub, channel, reader, rate_hz):
+        threading.Thread.__init__(self, name="sensor-" + channel, daemon=True)
+        self.hub = hub
+        self.channel = channel
+        self.reader = reader
+        self.interval = 1.0 / rate_hz
+        self.stopped = threading.Event()
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self.stopped.is_set():
+            value = self.reader()
+            if value is not None:
+                self.hub.push(self.channel, value)
+
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline = time.monotonic()
+                delay = 0
+            self.stopped.wait(delay)
+
+    def stop(self):
+        self.stopped.set()
+
+
+sensors = SensorHub()
+
+
+def start_producer(channel, reader, rate_hz, hub=sensors):
+    producer = SensorProducer(hub, channel, reader, rate_hz)
+    producer.start()
+
+    return producer
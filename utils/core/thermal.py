@@ -0,0 +1,136 @@
+import collections
+import os
+
+from utils.core.log import get_logger
+from utils.core.samples import TEMPERATURE
+
+THERMAL_ROOT = "/sys/class/thermal"
+# Hub channel of each zone: "thermal.<zone name>", e.g. thermal.thermal_zone0
+ZONE_CHANNEL_PREFIX = "thermal."
+# Zone types that measure the CPU, in order of preference
+CPU_ZONE_TYPES = ("cpu-thermal", "cpu_thermal", "x86_pkg_temp", "soc_thermal", "soc-thermal")
+MEDIAN_WINDOW = 5
+EMA_ALPHA = 0.3
+
+log = get_logger("thermal")
+
+
+class ThermalZone(object):
+    """
+    One /sys/class/thermal zone, with its temp attribute kept open.
+
+    Sysfs regenerates an attribute when it is read from offset 0, so pread on the
+    same descriptor returns a fresh value without reopening the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "type")) as f:
+            self.type = f.read().strip()
+        self.fd = os.open(os.path.join(path, "temp"), os.O_RDONLY)
+
+    def read(self):
+        # Degrees Celsius, or None if the sensor has nothing to report right now
+        try:
+            return int(os.pread(self.fd, 16, 0)) / 1000.0
+        except (OSError, ValueError):
+            return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Smoother(object):
+    """
+    Median of the last `window` readings, to drop single sample spikes, followed by an EMA
+    """
+
+    def __init__(self, window=MEDIAN_WINDOW, alpha=EMA_ALPHA):
+        self.alpha = alpha
+        self.recent = collections.deque(maxlen=window)
+        self.value = None
+
+    def update(self, reading):
+        self.recent.append(reading)
+        ordered = sorted(self.recent)
+        median = ordered[len(ordered) // 2]
+        if self.value is None:
+            self.value = median
+        else:
+            self.value += self.alpha * (median - self.value)
+
+        return self.value
+
+
+class ZoneReader(object):
+    """
+    Smoothed reader for one zone, suitable for start_producer or AcquisitionWorker
+    """
+
+    def __init__(self, zone, window=MEDIAN_WINDOW, alpha=EMA_ALPHA):
+        self.zone = zone
+        self.smoother = Smoother(window, alpha)
+
+    def __call__(self):
+        reading = self.zone.read()
+        if reading is None:
+            return None
+
+        return self.smoother.update(reading)
+
+
+def find_zones(root=THERMAL_ROOT):
+    zones = []
+    try:
+        names = os.listdir(root)
+    except OSError:
+        names = []
+
+    for name in sorted(names, key=lambda n: (len(n), n)):
+        if not name.startswith("thermal_zone"):
+            continue
+        try:
+            zones.append(ThermalZone(os.path.join(root, name)))
+        except OSError as e:
+            log.warning("Skipping thermal zone %s: %s", name, e)
+
+    return zones
+
+
+def cpu_zone(zones):
+    for zone_type in CPU_ZONE_TYPES:
+        for zone in zones:
+            if zone.type == zone_type:
+                return zone
+
+    return zones[0] if zones else None
+
+
+def zone_channel(zone):
+    # Keyed by name, as several zones can share a type (two acpitz zones, say)
+    return ZONE_CHANNEL_PREFIX + zone.name
+
+
+def thermal_readers(zones=None, window=MEDIAN_WINDOW, alpha=EMA_ALPHA):
+    """
+    Map hub channels to smoothed zone readers.
+
+    The CPU zone is published as TEMPERATURE, every zone (including the CPU one)
+    as thermal.<zone name>, such as thermal.thermal_zone0.
+    """
+    if zones is None:
+        zones = find_zones()
+
+    readers = {}
+    for zone in zones:
+        readers[zone_channel(zone)] = ZoneReader(zone, window, alpha)
+
+    # Own smoother, as each channel is polled by its own producer thread
+    cpu = cpu_zone(zones)
+    if cpu is not None:
+        readers[TEMPERATURE] = ZoneReader(cpu, window, alpha)
+
+    return readers
@@ -23,12 +23,49 @@ import dbus
 import dbus.service
 
 from utils.core.bletools import BleTools
+from utils.core.log import get_logger
+from utils.core.metrics import registry, instrument
+from utils.gatt.profile import InvalidArgsException
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
 LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+ADVERTISEMENT_HANDLERS = ("GetAll", "Release")
+# Optional LEAdvertisement1 properties, in the order they are published
+ADVERTISEMENT_PROPERTIES = ("ServiceUUIDs", "SolicitUUIDs", "ManufacturerData",
+                            "ServiceData", "IncludeTxPower", "LocalName")
+
+# How a live update reaches BlueZ: a PropertiesChanged signal, which BlueZ applies
+# to the running advertisement, or unregistering and registering it again
+REFRESH_SIGNAL = "signal"
+REFRESH_REREGISTER = "reregister"
+
+# Legacy (Bluetooth 4.x) advertising data is at most 31 bytes; every AD structure
+# costs a length and a type byte on top of its data
+LEGACY_AD_MAX = 31
+AD_HEADER = 2
+FLAGS_AD_LENGTH = 3
+TX_POWER_AD_LENGTH = 3
+BASE_UUID_SUFFIX = "-0000-1000-8000-00805f9b34fb"
+
+log = get_logger("gap")
+
+
+def uuid_size(uuid):
+    # Bytes a UUID takes on the air; bluetoothd shortens Bluetooth base UUIDs
+    uuid = str(uuid).lower()
+    if uuid.startswith("0x"):
+        uuid = uuid[2:]
+    if len(uuid) == 36 and uuid.endswith(BASE_UUID_SUFFIX):
+        uuid = uuid[:8].lstrip("0").rjust(4, "0")
+    if len(uuid) <= 4:
+        return 2
+    if len(uuid) <= 8:
+        return 4
+
+    return 16
 
 
 class Advertisement(dbus.service.Object):
@@ -44,63 +81,159 @@ class Advertisement(dbus.service.Object):
         self.manufacturer_data = None
         self.service_data = None
         self.include_tx_power = None
+        self.adapters = []
+        # D-Bus values of the optional properties, rebuilt only when they change
+        self.properties = {}
+        self.refresh = REFRESH_SIGNAL
+        self.checked_length = None
+        self.metrics = registry.get(self.path, "advertisement")
         dbus.service.Object.__init__(self, self.bus, self.path)
 
-    def get_properties(self):
-        properties = dict()
-        properties["Type"] = self.ad_type
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument(cls, ADVERTISEMENT_HANDLERS)
 
-        if self.local_name is not None:
-            properties["LocalName"] = dbus.String(self.local_name)
+    def build_property(self, name):
+        if name == "ServiceUUIDs" and self.service_uuids is not None:
+            return dbus.Array(self.service_uuids, signature='s')
+        if name == "SolicitUUIDs" and self.solicit_uuids is not None:
+            return dbus.Array(self.solicit_uuids, signature='s')
+        if name == "ManufacturerData" and self.manufacturer_data is not None:
+            return dbus.Dictionary(self.manufacturer_data, signature='qv')
+        if name == "ServiceData" and self.service_data is not None:
+            return dbus.Dictionary(self.service_data, signature='sv')
+        if name == "IncludeTxPower" and self.include_tx_power is not None:
+            return dbus.Boolean(self.include_tx_power)
+        if name == "LocalName" and self.local_name is not None:
+            return dbus.String(self.local_name)
 
-        if self.service_uuids is not None:
-            properties["ServiceUUIDs"] = dbus.Array(self.service_uuids,
-                                                    signature='s')
-        if self.solicit_uuids is not None:
-            properties["SolicitUUIDs"] = dbus.Array(self.solicit_uuids,
-                                                    signature='s')
-        if self.manufacturer_data is not None:
-            properties["ManufacturerData"] = dbus.Dictionary(
-                self.manufacturer_data, signature='qv')
+        return None
 
-        if self.service_data is not None:
-            properties["ServiceData"] = dbus.Dictionary(self.service_data,
-                                                        signature='sv')
-        if self.include_tx_power is not None:
-            properties["IncludeTxPower"] = dbus.Boolean(self.include_tx_power)
+    def invalidate(self, *names):
+        # Drop the cached values of names, or of every property
+        if not names:
+            self.properties.clear()
+        for name in names:
+            self.properties.pop(name, None)
 
-        if self.local_name is not None:
-            properties["LocalName"] = dbus.String(self.local_name)
+    def get_properties(self):
+        properties = dict()
+        properties["Type"] = self.ad_type
+
+        for name in ADVERTISEMENT_PROPERTIES:
+            if name not in self.properties:
+                self.properties[name] = self.build_property(name)
+            value = self.properties[name]
+            if value is not None:
+                properties[name] = value
 
         return {LE_ADVERTISEMENT_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def data_length(self):
+        # Advertising data bytes bluetoothd needs for the current properties,
+        # including the flags it adds itself
+        length = FLAGS_AD_LENGTH
+        for uuids in (self.service_uuids, self.solicit_uuids):
+            sizes = {}
+            for uuid in uuids or ():
+                size = uuid_size(uuid)
+                sizes[size] = sizes.get(size, 0) + size
+            length += sum(AD_HEADER + size for size in sizes.values())
+        for data in (self.manufacturer_data or {}).values():
+            length += AD_HEADER + 2 + len(data)
+        for uuid, data in (self.service_data or {}).items():
+            length += AD_HEADER + uuid_size(uuid) + len(data)
+        if self.include_tx_power:
+            length += TX_POWER_AD_LENGTH
+        if self.local_name:
+            length += AD_HEADER + len(self.local_name.encode("utf-8"))
+
+        return length
+
+    def check_length(self):
+        # Warns once per oversized length, as publish() runs on every live update
+        length = self.data_length()
+        if length > LEGACY_AD_MAX:
+            if length != self.checked_length:
+                log.warning("%s: advertising data is %d bytes, legacy controllers only take %d",
+                            self.path, length, LEGACY_AD_MAX)
+            self.checked_length = length
+            return False
+
+        return True
+
     def add_service_uuid(self, uuid):
         if not self.service_uuids:
             self.service_uuids = []
         self.service_uuids.append(uuid)
+        self.invalidate("ServiceUUIDs")
 
     def add_solicit_uuid(self, uuid):
         if not self.solicit_uuids:
             self.solicit_uuids = []
         self.solicit_uuids.append(uuid)
+        self.invalidate("SolicitUUIDs")
 
     def add_manufacturer_data(self, manuf_code, data):
         if not self.manufacturer_data:
             self.manufacturer_data = dbus.Dictionary({}, signature="qv")
         self.manufacturer_data[manuf_code] = dbus.Array(data, signature="y")
+        self.invalidate("ManufacturerData")
 
     def add_service_data(self, uuid, data):
         if not self.service_data:
             self.service_data = dbus.Dictionary({}, signature="sv")
         self.service_data[uuid] = dbus.Array(data, signature="y")
+        self.invalidate("ServiceData")
 
     def add_local_name(self, name):
         if not self.local_name:
             self.local_name = ""
         self.local_name = dbus.String(name)
+        self.invalidate("LocalName")
+
+    def update_manufacturer_data(self, manuf_code, data):
+        # Live update of a registered advertisement; False if data did not change
+        data = bytes(data)
+        if self.manufacturer_data is not None and manuf_code in self.manufacturer_data \
+                and bytes(self.manufacturer_data[manuf_code]) == data:
+            return False
+
+        self.add_manufacturer_data(manuf_code, data)
+        self.publish("ManufacturerData")
+
+        return True
+
+    def update_service_data(self, uuid, data):
+        data = bytes(data)
+        if self.service_data is not None and uuid in self.service_data \
+                and bytes(self.service_data[uuid]) == data:
+            return False
+
+        self.add_service_data(uuid, data)
+        self.publish("ServiceData")
+
+        return True
+
+    def publish(self, name):
+        if not self.adapters:
+            return
+
+        if self.refresh == REFRESH_REREGISTER:
+            self.unregister()
+            self.register(self.adapters)
+        else:
+            self.check_length()
+            value = self.get_properties()[LE_ADVERTISEMENT_IFACE][name]
+            self.PropertiesChanged(LE_ADVERTISEMENT_IFACE, {name: value}, [])
+
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
 
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature="s",
@@ -115,20 +248,33 @@ class Advertisement(dbus.service.Object):
                          in_signature='',
                          out_signature='')
     def Release(self):
-        print ('%s: Released!' % self.path)
+        log.info("%s: Released!", self.path)
 
     def register_ad_callback(self):
-        print("GATT advertisement registered")
+        log.info("%s: advertisement registered", self.path)
+
+    def register_ad_error_callback(self, error=None):
+        log.error("%s: failed to register advertisement: %s", self.path, error)
+
+    def register(self, adapter=None):
+        # adapter selects the controllers to advertise on, see BleTools.choose_adapters
+        self.adapters = BleTools.select_adapters(adapter, self.bus)
+        self.check_length()
+
+        for adapter_path in self.adapters:
+            ad_manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
+                                        LE_ADVERTISING_MANAGER_IFACE)
+            ad_manager.RegisterAdvertisement(self.get_path(), {},
+                                             reply_handler=self.register_ad_callback,
+                                             error_handler=self.register_ad_error_callback)
 
-    def register_ad_error_callback(self):
-        print("Failed to register GATT advertisement")
+    def unregister(self):
+        for adapter_path in self.adapters:
+            ad_manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
+                                        LE_ADVERTISING_MANAGER_IFACE)
+            ad_manager.UnregisterAdvertisement(self.get_path(),
+                                               reply_handler=lambda: None,
+                                               error_handler=self.register_ad_error_callback)
 
-    def register(self):
-        bus = BleTools.get_bus()
-        adapter = BleTools.find_adapter(bus)
 
-        ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                                LE_ADVERTISING_MANAGER_IFACE)
-        ad_manager.RegisterAdvertisement(self.get_path(), {},
-                                     reply_handler=self.register_ad_callback,
-                                     error_handler=self.register_ad_error_callback)
+instrument(Advertisement, ADVERTISEMENT_HANDLERS)
@@ -0,0 +1,115 @@
+import struct
+
+from utils.core.log import get_logger
+from utils.core.samples import sensors, POWER, CADENCE, HEART_RATE, SPEED
+from utils.gap.advertisement import LEGACY_AD_MAX
+from utils.gatt.profile import Characteristic
+
+# Manufacturer data company identifier reserved for testing; replace with an assigned one
+BROADCAST_COMPANY_ID = 0xFFFF
+BROADCAST_VERSION = 1
+BROADCAST_INTERVAL = 500
+
+# version, sequence, power (1 W), cadence (0.5 rpm), speed (0.01 km/h), heart rate (1 bpm)
+# The sequence only advances when a metric changes, so listeners can drop repeats.
+BROADCAST_PAYLOAD = struct.Struct("<BBhHHB")
+
+log = get_logger("gap")
+
+
+def clamp(value, low, high):
+    return min(max(int(round(value)), low), high)
+
+
+def encode_broadcast(sequence, power, cadence, speed, heart_rate):
+    return BROADCAST_PAYLOAD.pack(BROADCAST_VERSION, sequence & 0xFF,
+                                  clamp(power, -0x8000, 0x7FFF), clamp(cadence * 2, 0, 0xFFFF),
+                                  clamp(speed * 100, 0, 0xFFFF), clamp(heart_rate, 0, 0xFF))
+
+
+def decode_broadcast(data):
+    version, sequence, power, cadence, speed, heart_rate = BROADCAST_PAYLOAD.unpack(bytes(data))
+
+    return {
+        "version": version,
+        "sequence": sequence,
+        "power": power,
+        "cadence": cadence / 2.0,
+        "speed": speed / 100.0,
+        "heart_rate": heart_rate,
+    }
+
+
+class MetricsBroadcaster(object):
+    """
+    Publishes live power, cadence, speed and heart rate in an advertisement's
+    manufacturer data, so any number of passive scanners can follow a rider
+    without connecting.
+
+    The payload is rebuilt every interval milliseconds and pushed to BlueZ only
+    when it changed (see Advertisement.update_manufacturer_data).
+
+    The metrics take 13 of the 31 bytes legacy advertising allows, so the rest of
+    the advertisement is trimmed to fit: first IncludeTxPower, then the service
+    data, then the local name, which is shortened (centrals can still read the
+    GAP Device Name after connecting). Service UUIDs are always kept.
+    """
+
+    def __init__(self, advertisement, interval=BROADCAST_INTERVAL, hub=sensors,
+                 company_id=BROADCAST_COMPANY_ID):
+        self.advertisement = advertisement
+        self.interval = interval
+        self.hub = hub
+        self.company_id = company_id
+        self.sequence = 0
+        self.last_payload = None
+        # Present from the first GetAll, so BlueZ sizes the advertisement for it
+        advertisement.add_manufacturer_data(company_id, encode_broadcast(0, 0, 0, 0, 0))
+        self.make_room()
+
+    def make_room(self):
+        adv = self.advertisement
+        if adv.data_length() > LEGACY_AD_MAX and adv.include_tx_power:
+            adv.include_tx_power = None
+            adv.invalidate("IncludeTxPower")
+        if adv.data_length() > LEGACY_AD_MAX and adv.service_data:
+            adv.service_data = None
+            adv.invalidate("ServiceData")
+
+        excess = adv.data_length() - LEGACY_AD_MAX
+        if excess > 0 and adv.local_name:
+            name = adv.local_name.encode("utf-8")
+            name = name[:max(0, len(name) - excess)].decode("utf-8", "ignore")
+            if name:
+                adv.add_local_name(name)
+            else:
+                adv.local_name = None
+                adv.invalidate("LocalName")
+
+        if adv.data_length() > LEGACY_AD_MAX:
+            log.warning("%s: service UUIDs and metrics alone need %d bytes of advertising data",
+                        adv.path, adv.data_length())
+        else:
+            log.debug("%s: broadcast advertisement trimmed to %d bytes", adv.path, adv.data_length())
+
+    def read_metrics(self):
+        return (self.hub.latest(POWER, 0), self.hub.latest(CADENCE, 0),
+                self.hub.latest(SPEED, 0), self.hub.latest(HEART_RATE, 0))
+
+    def update(self):
+        # Compare at broadcast resolution, so sensor jitter below it is not sent
+        metrics = self.read_metrics()
+        payload = encode_broadcast(0, *metrics)
+        if payload != self.last_payload:
+            self.last_payload = payload
+            self.sequence += 1
+            self.advertisement.update_manufacturer_data(
+                self.company_id, encode_broadcast(self.sequence, *metrics))
+
+        return True
+
+    def start(self):
+        Characteristic.scheduler.add(self, self.interval, self.update)
+
+    def stop(self):
+        Characteristic.scheduler.remove(self)
@@ -0,0 +1,326 @@
+"""asyncio backend for the GATT server, built on the pure Python dbus-next client.
+
+Services, characteristics, descriptors and advertisements are the same classes used
+with the GLib backend; only the application object changes:
+
+    app = AsyncApplication()
+    app.add_service(HERLHeartRateService(1))
+    app.add_advertisement(HERLParacycleAdvertisement(0))
+    app.register()
+    app.run()
+
+AsyncApplication must be created before any service, so that the objects are built
+without a dbus-python connection. Each one is then published through a dbus-next
+interface that forwards to its ReadValue/WriteValue/StartNotify/StopNotify, and
+periodic notifications are scheduled on the asyncio event loop.
+"""
+import asyncio
+
+import dbus.exceptions
+
+from dbus_next import BusType, DBusError, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.constants import PropertyAccess
+from dbus_next.service import ServiceInterface, method, dbus_property
+
+from utils.core.bletools import BleTools
+from utils.core.log import get_logger
+from utils.gatt.profile import Characteristic, NotificationScheduler, APP_NAME
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+GATT_SERVICE_IFACE = "org.bluez.GattService1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+
+ADVERTISEMENT_SIGNATURES = {
+    "Type": "s",
+    "LocalName": "s",
+    "ServiceUUIDs": "as",
+    "SolicitUUIDs": "as",
+    "ManufacturerData": "a{qv}",
+    "ServiceData": "a{sv}",
+    "IncludeTxPower": "b",
+}
+
+log = get_logger("aio")
+
+
+def to_options(options):
+    return dict((key, variant.value) for key, variant in options.items())
+
+
+def to_dbus_error(error):
+    return DBusError(error.get_dbus_name() or "org.bluez.Error.Failed", str(error))
+
+
+def to_variant_dict(data):
+    # ServiceData/ManufacturerData values are byte arrays
+    return dict((key, Variant("ay", bytes(value))) for key, value in data.items())
+
+
+class AsyncioNotificationScheduler(NotificationScheduler):
+    def timer_add(self, timeout, callback):
+        return asyncio.get_event_loop().call_later(timeout / 1000.0, callback)
+
+    def timer_remove(self, source):
+        source.cancel()
+
+
+class ServiceBridge(ServiceInterface):
+    def __init__(self, service):
+        ServiceInterface.__init__(self, GATT_SERVICE_IFACE)
+        self.service = service
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.service.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> "b":
+        return bool(self.service.primary)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristics(self) -> "ao":
+        return [str(path) for path in self.service.get_characteristic_paths()]
+
+
+class CharacteristicBridge(ServiceInterface):
+    def __init__(self, chrc):
+        ServiceInterface.__init__(self, GATT_CHRC_IFACE)
+        self.chrc = chrc
+        self.value = b""
+        # Notifications from the unchanged subclasses end up here
+        chrc.PropertiesChanged = self.properties_changed
+
+    def properties_changed(self, interface, changed, invalidated):
+        if "Value" in changed:
+            self.value = bytes(changed["Value"])
+            self.chrc.metrics.notified()
+            if self.chrc.recorder is not None:
+                self.chrc.recorder.notified(self.chrc, self.value)
+            self.emit_properties_changed({"Value": self.value}, invalidated)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> "o":
+        return str(self.chrc.service.get_path())
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.chrc.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "as":
+        return list(self.chrc.flags)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Descriptors(self) -> "ao":
+        return [str(path) for path in self.chrc.get_descriptor_paths()]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> "ay":
+        return self.value
+
+    @method()
+    def ReadValue(self, options: "a{sv}") -> "ay":
+        try:
+            return bytes(self.chrc.ReadValue(to_options(options)))
+        except dbus.exceptions.DBusException as e:
+            raise to_dbus_error(e)
+
+    @method()
+    def WriteValue(self, value: "ay", options: "a{sv}"):
+        try:
+            self.chrc.WriteValue(value, to_options(options))
+        except dbus.exceptions.DBusException as e:
+            raise to_dbus_error(e)
+
+    @method()
+    def StartNotify(self):
+        try:
+            self.chrc.StartNotify()
+        except dbus.exceptions.DBusException as e:
+            raise to_dbus_error(e)
+
+    @method()
+    def StopNotify(self):
+        try:
+            self.chrc.StopNotify()
+        except dbus.exceptions.DBusException as e:
+            raise to_dbus_error(e)
+
+
+class DescriptorBridge(ServiceInterface):
+    def __init__(self, desc):
+        ServiceInterface.__init__(self, GATT_DESC_IFACE)
+        self.desc = desc
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristic(self) -> "o":
+        return str(self.desc.chrc.get_path())
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.desc.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "as":
+        return list(self.desc.flags)
+
+    @method()
+    def ReadValue(self, options: "a{sv}") -> "ay":
+        try:
+            return bytes(self.desc.ReadValue(to_options(options)))
+        except dbus.exceptions.DBusException as e:
+            raise to_dbus_error(e)
+
+    @method()
+    def WriteValue(self, value: "ay", options: "a{sv}"):
+        try:
+            self.desc.WriteValue(value, to_options(options))
+        except dbus.exceptions.DBusException as e:
+            raise to_dbus_error(e)
+
+
+def to_advertisement_value(value, signature):
+    if signature in ("a{sv}", "a{qv}"):
+        return to_variant_dict(value)
+    if signature == "as":
+        return [str(v) for v in value]
+    if signature == "b":
+        return bool(value)
+
+    return str(value)
+
+
+def advertisement_property(name, signature):
+    def getter(self):
+        return to_advertisement_value(self.adv.get_properties()[LE_ADVERTISEMENT_IFACE][name], signature)
+
+    getter.__name__ = name
+    getter.__annotations__ = {"return": signature}
+
+    return dbus_property(access=PropertyAccess.READ, name=name)(getter)
+
+
+class AdvertisementBridge(ServiceInterface):
+    def __init__(self, adv):
+        ServiceInterface.__init__(self, LE_ADVERTISEMENT_IFACE)
+        self.adv = adv
+        # Live updates (see Advertisement.publish) end up here
+        adv.PropertiesChanged = self.properties_changed
+
+    def properties_changed(self, interface, changed, invalidated):
+        self.emit_properties_changed(dict(
+            (name, to_advertisement_value(value, ADVERTISEMENT_SIGNATURES[name]))
+            for name, value in changed.items()), invalidated)
+
+    @method()
+    def Release(self):
+        self.adv.Release()
+
+
+def advertisement_bridge(adv):
+    # LEAdvertisement1 properties are optional, so only the ones this advertisement
+    # sets are declared on its interface class
+    members = {}
+    for name in adv.get_properties()[LE_ADVERTISEMENT_IFACE]:
+        members[name] = advertisement_property(name, ADVERTISEMENT_SIGNATURES[name])
+
+    return type("AdvertisementBridge", (AdvertisementBridge,), members)(adv)
+
+
+class AsyncApplication(object):
+    def __init__(self, bus_type=BusType.SYSTEM):
+        BleTools.set_bus(None)
+        Characteristic.scheduler = AsyncioNotificationScheduler()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.bus_type = bus_type
+        self.bus = None
+        self.path = "/"
+        self.services = []
+        self.advertisements = []
+        self.pending = []
+
+    def get_path(self):
+        return self.path
+
+    def add_service(self, service):
+        self.services.append(service)
+        service.application = self
+
+    def invalidate(self):
+        # The object tree is published by dbus-next, which keeps no cache to drop
+        pass
+
+    def add_advertisement(self, advertisement):
+        self.advertisements.append(advertisement)
+
+    async def connect(self):
+        self.bus = await MessageBus(bus_type=self.bus_type).connect()
+
+        for service in self.services:
+            self.bus.export(service.path, ServiceBridge(service))
+            for chrc in service.get_characteristics():
+                self.bus.export(chrc.path, CharacteristicBridge(chrc))
+                for desc in chrc.get_descriptors():
+                    self.bus.export(desc.path, DescriptorBridge(desc))
+
+        for adv in self.advertisements:
+            self.bus.export(adv.path, advertisement_bridge(adv))
+
+    async def get_interface(self, path, interface):
+        introspection = await self.bus.introspect(BLUEZ_SERVICE_NAME, path)
+        proxy = self.bus.get_proxy_object(BLUEZ_SERVICE_NAME, path, introspection)
+
+        return proxy.get_interface(interface)
+
+    async def find_adapters(self):
+        remote_om = await self.get_interface("/", DBUS_OM_IFACE)
+        objects = await remote_om.call_get_managed_objects()
+
+        return sorted(o for o, props in objects.items()
+                      if LE_ADVERTISING_MANAGER_IFACE in props)
+
+    async def register_async(self, adapter=None):
+        adapters = BleTools.choose_adapters(await self.find_adapters(), adapter)
+
+        for adapter_path in adapters:
+            service_manager = await self.get_interface(adapter_path, GATT_MANAGER_IFACE)
+            try:
+                await service_manager.call_register_application(self.path, {})
+                log.info("%s application registered", APP_NAME)
+            except DBusError as e:
+                log.error("Failed to register %s application: %s", APP_NAME, e)
+
+            ad_manager = await self.get_interface(adapter_path, LE_ADVERTISING_MANAGER_IFACE)
+            for adv in self.advertisements:
+                try:
+                    await ad_manager.call_register_advertisement(adv.path, {})
+                    adv.adapters.append(adapter_path)
+                    adv.register_ad_callback()
+                except DBusError as e:
+                    adv.register_ad_error_callback(e)
+
+    def register(self, adapter=None):
+        # Registration needs the bus, so it runs once run() has connected
+        self.pending.append(lambda: self.register_async(adapter))
+
+    async def serve(self):
+        await self.connect()
+        for coroutine in self.pending:
+            await coroutine()
+        self.pending = []
+        await self.bus.wait_for_disconnect()
+
+    def run(self):
+        self.loop.run_until_complete(self.serve())
+
+    def quit(self):
+        log.info("%s application terminated", APP_NAME)
+        if self.bus is not None:
+            self.bus.disconnect()
@@ -19,6 +19,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import heapq
+import itertools
+import math
+import socket
+import struct
+import time
+
 import dbus
 import dbus.mainloop.glib
 import dbus.exceptions
@@ -28,6 +35,9 @@ try:
 except ImportError:
     import gobject as GObject
 from utils.core.bletools import BleTools
+from utils.core.log import get_logger
+from utils.core.metrics import registry, instrument
+from utils.core.recorder import SessionRecorder
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
@@ -36,8 +46,37 @@ DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
 GATT_SERVICE_IFACE = "org.bluez.GattService1"
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
 GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
+STATS_IFACE = "org.herl.Stats1"
+CHRC_HANDLERS = ("ReadValue", "WriteValue", "StartNotify", "StopNotify")
+DESC_HANDLERS = ("ReadValue", "WriteValue")
+# Client Characteristic Configuration value and Characteristic Presentation Format
+# (format, exponent, unit, namespace, description)
+CCCD_VALUE = struct.Struct("<H")
+PRESENTATION_FORMAT = struct.Struct("<BbHBH")
+NAMESPACE_BLUETOOTH_SIG = 0x01
+# Presentation Format formats and units from the Bluetooth Assigned Numbers
+FORMAT_BOOLEAN = 0x01
+FORMAT_UINT8 = 0x04
+FORMAT_UINT16 = 0x06
+FORMAT_UINT32 = 0x08
+FORMAT_SINT8 = 0x0C
+FORMAT_SINT16 = 0x0E
+FORMAT_SINT32 = 0x10
+FORMAT_FLOAT32 = 0x14
+FORMAT_UTF8S = 0x19
+UNIT_UNITLESS = 0x2700
+UNIT_SECOND = 0x2703
+UNIT_WATT = 0x2726
+UNIT_CELSIUS = 0x272F
+UNIT_RPM = 0x27A7
+UNIT_FAHRENHEIT = 0x27AC
+UNIT_BPM = 0x27AF
+# ATT_MTU assumed when BlueZ does not pass one with AcquireNotify/AcquireWrite
+DEFAULT_MTU = 23
 APP_NAME = "HERL Paracycle"
 
+log = get_logger("gatt")
+
 
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
@@ -51,14 +90,157 @@ class NotPermittedException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.bluez.Error.NotPermitted"
 
 
-class Application(dbus.service.Object):
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidOffset"
+
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
+
+
+class FailedException(dbus.exceptions.DBusException):
+    # BlueZ answers the ATT request with application error 0x80
+    _dbus_error_name = "org.bluez.Error.Failed"
+
+
+class Subscription(object):
+    __slots__ = ("owner", "interval", "callback", "deadline", "failures")
+
+    def __init__(self, owner, interval, callback, deadline):
+        self.owner = owner
+        self.interval = interval
+        self.callback = callback
+        self.deadline = deadline
+        self.failures = 0
+
+
+class NotificationScheduler(object):
+    """
+    Drives every periodic notification from a single main loop timer.
+
+    Deadlines advance by whole intervals from the moment a subscription was
+    added, so emissions do not drift, and every subscription that falls due
+    within TICK_SLACK of the earliest deadline is served in the same wakeup.
+    """
+    TICK_SLACK = 0.002
+
     def __init__(self):
+        self.subscriptions = {}
+        self.queue = []
+        self.counter = itertools.count()
+        self.source = None
+        self.armed_deadline = None
+
+    def add(self, owner, interval, callback):
+        # interval is in milliseconds, like GObject.timeout_add. Adding again for the
+        # same owner replaces its subscription, so Stop/StartNotify never stacks timers.
+        interval = interval / 1000.0
+        subscription = Subscription(owner, interval, callback, time.monotonic() + interval)
+        self.subscriptions[owner] = subscription
+        self.push(subscription)
+        self.arm()
+
+    def remove(self, owner):
+        # Stale queue entries are skipped when they come up
+        self.subscriptions.pop(owner, None)
+
+    def is_active(self, subscription):
+        return self.subscriptions.get(subscription.owner) is subscription
+
+    def push(self, subscription):
+        heapq.heappush(self.queue, (subscription.deadline, next(self.counter), subscription))
+
+    def arm(self):
+        while self.queue and not self.is_active(self.queue[0][2]):
+            heapq.heappop(self.queue)
+
+        if not self.queue:
+            self.disarm()
+            return
+
+        deadline = self.queue[0][0]
+        if self.source is not None and self.armed_deadline <= deadline:
+            return
+
+        self.disarm()
+        delay = max(0, int(math.ceil((deadline - time.monotonic()) * 1000)))
+        self.source = self.timer_add(delay, self.tick)
+        self.armed_deadline = deadline
+
+    def disarm(self):
+        if self.source is not None:
+            self.timer_remove(self.source)
+            self.source = None
+            self.armed_deadline = None
+
+    def tick(self):
+        self.source = None
+        self.armed_deadline = None
+        now = time.monotonic()
+        due = []
+        while self.queue and self.queue[0][0] <= now + self.TICK_SLACK:
+            subscription = heapq.heappop(self.queue)[2]
+            if self.is_active(subscription):
+                due.append(subscription)
+
+        for subscription in due:
+            # A failing callback keeps its subscription: the owner still believes it is
+            # notifying, so dropping it would silence it until StopNotify/StartNotify.
+            # Only the first failure in a row is logged with its traceback.
+            try:
+                keep = subscription.callback()
+                subscription.failures = 0
+            except Exception:
+                if subscription.failures == 0:
+                    log.exception("Notification callback of %s failed", subscription.owner)
+                else:
+                    log.debug("Notification callback of %s failed again", subscription.owner)
+                subscription.failures += 1
+                keep = True
+
+            # The callback may have removed or replaced its own subscription
+            if not self.is_active(subscription):
+                continue
+            if not keep:
+                self.remove(subscription.owner)
+                continue
+
+            subscription.deadline += subscription.interval
+            if subscription.deadline <= now:
+                # Skip ticks missed during a stall instead of bursting to catch up
+                missed = math.floor((now - subscription.deadline) / subscription.interval) + 1
+                subscription.deadline += missed * subscription.interval
+            self.push(subscription)
+
+        self.arm()
+
+        return False
+
+    def timer_add(self, timeout, callback):
+        return GObject.timeout_add(timeout, callback)
+
+    def timer_remove(self, source):
+        GObject.source_remove(source)
+
+    def io_add(self, fd, callback):
+        # callback() runs when fd is readable or hung up and returns False to stop watching
+        return GObject.io_add_watch(fd, GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                                    lambda source, condition: callback())
+
+    def io_remove(self, source):
+        GObject.source_remove(source)
+
+
+class Application(dbus.service.Object):
+    def __init__(self, path="/"):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         self.mainloop = GObject.MainLoop()
         self.bus = BleTools.get_bus()
-        self.path = "/"
+        self.path = path
         self.services = []
+        self.adapters = []
         self.next_index = 0
+        self.managed_objects = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_path(self):
@@ -66,44 +248,85 @@ class Application(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.invalidate()
+
+    def invalidate(self):
+        self.managed_objects = None
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
     def GetManagedObjects(self):
-        response = {}
-
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
+        if self.managed_objects is None:
+            response = {}
+            for service in self.services:
+                response.update(service.get_managed_objects())
+            self.managed_objects = response
+
+        return self.managed_objects
+
+    @dbus.service.method(STATS_IFACE, out_signature="a{sa{sd}}")
+    def GetStats(self):
+        return registry.snapshot()
+
+    @dbus.service.method(STATS_IFACE, out_signature="s")
+    def GetPrometheus(self):
+        return registry.prometheus()
+
+    def export_metrics(self, filename, interval=10000):
+        # Rewrite a Prometheus text file every interval milliseconds
+        self.metrics_filename = filename
+        Characteristic.scheduler.add(self, interval, self.write_metrics)
+
+    def write_metrics(self):
+        registry.write_prometheus(self.metrics_filename)
+
+        return True
+
+    def record(self, filename, flush_interval=None):
+        # Log every notification, read and write to filename (see utils.core.recorder).
+        # Dirty pages reach the disk on the kernel's schedule unless flush_interval
+        # milliseconds is given.
+        recorder = SessionRecorder(filename)
+        Characteristic.recorder = recorder
+        Descriptor.recorder = recorder
+        if flush_interval:
+            Characteristic.scheduler.add(recorder, flush_interval, recorder.flush)
+
+        return recorder
+
+    def stop_recording(self):
+        recorder = Characteristic.recorder
+        if recorder is not None:
+            Characteristic.scheduler.remove(recorder)
+            Characteristic.recorder = None
+            Descriptor.recorder = None
+            recorder.close()
 
     def register_app_callback(self):
-        print(f"{APP_NAME} Application Registered")
+        log.info("%s application registered", APP_NAME)
 
     def register_app_error_callback(self, error):
-        print(f"Failed to register {APP_NAME} application: " + str(error))
+        log.error("Failed to register %s application: %s", APP_NAME, error)
 
-    def register(self):
-        adapter = BleTools.find_adapter(self.bus)
+    def register(self, adapter=None):
+        # adapter selects the controllers to serve on, see BleTools.choose_adapters
+        self.adapters = BleTools.select_adapters(adapter, self.bus)
 
-        service_manager = dbus.Interface(
-            self.bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-            GATT_MANAGER_IFACE)
+        for adapter_path in self.adapters:
+            service_manager = dbus.Interface(
+                self.bus.get_object(BLUEZ_SERVICE_NAME, adapter_path),
+                GATT_MANAGER_IFACE)
 
-        service_manager.RegisterApplication(self.get_path(), {},
-                                            reply_handler=self.register_app_callback,
-                                            error_handler=self.register_app_error_callback)
+            service_manager.RegisterApplication(self.get_path(), {},
+                                                reply_handler=self.register_app_callback,
+                                                error_handler=self.register_app_error_callback)
 
     def run(self):
         self.mainloop.run()
 
     def quit(self):
-        print(f"\n{APP_NAME} application terminated")
+        log.info("%s application terminated", APP_NAME)
+        self.stop_recording()
         self.mainloop.quit()
 
 
@@ -117,6 +340,8 @@ class Service(dbus.service.Object):
         self.primary = primary
         self.characteristics = []
         self.next_index = 0
+        self.application = None
+        self.managed_objects = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
@@ -135,6 +360,21 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def invalidate(self):
+        self.managed_objects = None
+        if self.application is not None:
+            self.application.invalidate()
+
+    def get_managed_objects(self):
+        if self.managed_objects is None:
+            response = {self.get_path(): self.get_properties()}
+            for chrc in self.characteristics:
+                response.update(chrc.get_managed_objects())
+            self.managed_objects = response
+
+        return self.managed_objects
 
     def get_characteristic_paths(self):
         result = []
@@ -167,7 +407,17 @@ class Service(dbus.service.Object):
 class Characteristic(dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Notifications go out as PropertiesChanged signals unless BlueZ acquired the
+    characteristic with AcquireNotify, in which case each value is one send() on a
+    SOCK_SEQPACKET socket. Likewise AcquireWrite delivers write-without-response
+    values through a socket, read on the main loop and passed to WriteValue.
+    Set ACQUIRE to False to keep a characteristic on the D-Bus path.
     """
+    scheduler = NotificationScheduler()
+    ACQUIRE = True
+    # Set by Application.record
+    recorder = None
 
     def __init__(self, uuid, flags, service):
         index = service.get_next_index()
@@ -178,25 +428,61 @@ class Characteristic(dbus.service.Object):
         self.flags = flags
         self.descriptors = []
         self.next_index = 0
+        self.managed_objects = None
+        self.change_only = False
+        self.keepalive = None
+        self.deadbands = {}
+        self.last_value = None
+        self.last_fields = None
+        self.suppressed = 0
+        self.notify_socket = None
+        self.notify_source = None
+        # Link MTU BlueZ gave with AcquireNotify, None while not acquired
+        self.notify_mtu = None
+        self.write_sockets = {}
+        self.metrics = registry.get(self.path, "characteristic")
         dbus.service.Object.__init__(self, self.bus, self.path)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument(cls, CHRC_HANDLERS)
+
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
-                'Service': self.service.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
-                'Descriptors': dbus.Array(
-                    self.get_descriptor_paths(),
-                    signature='o')
-            }
+        properties = {
+            'Service': self.service.get_path(),
+            'UUID': self.uuid,
+            'Flags': self.flags,
+            'Descriptors': dbus.Array(
+                self.get_descriptor_paths(),
+                signature='o')
         }
+        # BlueZ only offers the fd paths for characteristics that have these properties
+        if self.ACQUIRE and "notify" in self.flags:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_socket is not None)
+        if self.ACQUIRE and "write-without-response" in self.flags:
+            properties['WriteAcquired'] = dbus.Boolean(bool(self.write_sockets))
+
+        return {GATT_CHRC_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate()
+
+    def invalidate(self):
+        self.managed_objects = None
+        self.service.invalidate()
+
+    def get_managed_objects(self):
+        if self.managed_objects is None:
+            response = {self.get_path(): self.get_properties()}
+            for desc in self.descriptors:
+                response[desc.get_path()] = desc.get_properties()
+            self.managed_objects = response
+
+        return self.managed_objects
 
     def get_descriptor_paths(self):
         result = []
@@ -220,28 +506,131 @@ class Characteristic(dbus.service.Object):
                          in_signature='a{sv}',
                          out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
+        log.debug("Default ReadValue called on %s, returning error", self.path)
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        log.debug("Default WriteValue called on %s, returning error", self.path)
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        print('Default StartNotify called, returning error')
+        log.debug("Default StartNotify called on %s, returning error", self.path)
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        print('Default StopNotify called, returning error')
+        log.debug("Default StopNotify called on %s, returning error", self.path)
         raise NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.ACQUIRE or "notify" not in self.flags:
+            raise NotSupportedException()
+        if self.notify_socket is not None:
+            raise NotPermittedException("Notify already acquired")
+
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        local.setblocking(False)
+        self.notify_socket = local
+        self.notify_mtu = int(options.get("mtu", DEFAULT_MTU))
+        # BlueZ never writes to the socket; it becomes readable when BlueZ closes it
+        self.notify_source = self.scheduler.io_add(local.fileno(), self.release_notify)
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+        # NotifyAcquired changed
+        self.invalidate()
+        # BlueZ does not call StartNotify on an acquired characteristic
+        self.StartNotify()
+
+        return fd, dbus.UInt16(self.notify_mtu)
+
+    def release_notify(self):
+        if self.notify_socket is None:
+            return False
+
+        self.scheduler.io_remove(self.notify_source)
+        self.notify_socket.close()
+        self.notify_socket = None
+        self.notify_source = None
+        self.notify_mtu = None
+        self.invalidate()
+        self.StopNotify()
+
+        return False
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireWrite(self, options):
+        if not self.ACQUIRE or "write-without-response" not in self.flags:
+            raise NotSupportedException()
+
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        local.setblocking(False)
+        mtu = int(options.get("mtu", DEFAULT_MTU))
+        write_options = dict(options)
+        write_options["type"] = "command"
+        self.write_sockets[local.fileno()] = (
+            local, mtu, write_options,
+            self.scheduler.io_add(local.fileno(), lambda: self.receive_writes(local.fileno())))
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+        # WriteAcquired changed
+        self.invalidate()
+
+        return fd, dbus.UInt16(mtu)
+
+    def receive_writes(self, fileno):
+        sock, mtu, options, source = self.write_sockets[fileno]
+        while True:
+            try:
+                value = sock.recv(mtu)
+            except BlockingIOError:
+                return True
+            except OSError:
+                value = b""
+
+            if not value:
+                # BlueZ closed its end: the device disconnected or released the write
+                self.scheduler.io_remove(source)
+                sock.close()
+                del self.write_sockets[fileno]
+                self.invalidate()
+                return False
+
+            try:
+                self.WriteValue(value, options)
+            except dbus.exceptions.DBusException as e:
+                # Write without response has no way to report an error
+                log.debug("Acquired write to %s failed: %s", self.path, e)
+
+    def send_notification(self, value):
+        try:
+            self.notify_socket.send(value)
+        except BlockingIOError:
+            # BlueZ is not keeping up; drop this value rather than stall the main loop
+            self.metrics.dropped += 1
+            return False
+        except OSError:
+            self.release_notify()
+            return False
+
+        self.metrics.notified()
+        if self.recorder is not None:
+            self.recorder.notified(self, value)
+
+        return True
+
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
-        pass
+        self.metrics.notified()
+        if self.recorder is not None and "Value" in changed:
+            self.recorder.notified(self, changed["Value"])
 
     def get_bus(self):
         bus = self.bus
@@ -254,11 +643,63 @@ class Characteristic(dbus.service.Object):
 
         return idx
 
+    def set_change_only(self, keepalive=None, deadbands=None):
+        # Only notify when the value changes. keepalive forces a notification after that
+        # many suppressed ticks; deadbands maps a field name to the smallest change that
+        # counts, for fields passed to notify_value.
+        self.change_only = True
+        self.keepalive = keepalive
+        self.deadbands = deadbands or {}
+
+    def is_unchanged(self, value, fields):
+        if self.last_value is None:
+            return False
+        if value == self.last_value:
+            return True
+        if not fields or self.last_fields is None:
+            return False
+
+        for name, field in fields.items():
+            last = self.last_fields.get(name)
+            deadband = self.deadbands.get(name)
+            if deadband is None:
+                if field != last:
+                    return False
+            elif last is None or abs(field - last) >= deadband:
+                return False
+
+        return True
+
+    def notify_value(self, value, fields=None, force=False):
+        value = bytes(value)
+        if self.change_only and not force and self.is_unchanged(value, fields):
+            if self.keepalive is None or self.suppressed < self.keepalive:
+                self.suppressed += 1
+                return False
+
+        self.last_value = value
+        self.last_fields = fields
+        self.suppressed = 0
+        if self.notify_socket is not None:
+            return self.send_notification(value)
+
+        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+
+        return True
+
     def add_timeout(self, timeout, callback):
-        GObject.timeout_add(timeout, callback)
+        self.scheduler.add(self, timeout, callback)
+
+    def remove_timeout(self):
+        self.scheduler.remove(self)
+
+
+instrument(Characteristic, CHRC_HANDLERS)
 
 
 class Descriptor(dbus.service.Object):
+    recorder = None
+
     def __init__(self, uuid, flags, characteristic):
         index = characteristic.get_next_index()
         self.path = characteristic.path + '/desc' + str(index)
@@ -266,8 +707,13 @@ class Descriptor(dbus.service.Object):
         self.flags = flags
         self.chrc = characteristic
         self.bus = characteristic.get_bus()
+        self.metrics = registry.get(self.path, "descriptor")
         dbus.service.Object.__init__(self, self.bus, self.path)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument(cls, DESC_HANDLERS)
+
     def get_properties(self):
         return {
             GATT_DESC_IFACE: {
@@ -293,32 +739,123 @@ class Descriptor(dbus.service.Object):
                          in_signature='a{sv}',
                          out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
+        log.debug("Default ReadValue called on %s, returning error", self.path)
         raise NotSupportedException()
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        log.debug("Default WriteValue called on %s, returning error", self.path)
         raise NotSupportedException()
 
 
-class CharacteristicUserDescriptionDescriptor(Descriptor):
-    CUD_UUID = '2901'
+instrument(Descriptor, DESC_HANDLERS)
 
-    def __init__(self, bus, index, characteristic):
-        self.writable = 'writable-auxiliaries' in characteristic.flags
-        self.value = array.array('B', b'This is a characteristic for testing')
-        self.value = self.value.tolist()
-        Descriptor.__init__(
-            self, bus, index,
-            self.CUD_UUID,
-            ['read', 'write'],
-            characteristic)
+
+def to_byte_array(value):
+    # str is sent as UTF-8, anything else as its bytes
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+
+    return dbus.Array(bytes(value), signature='y')
+
+
+def read_offset(value, options):
+    # Long reads arrive as a series of ReadValue calls with increasing offsets
+    offset = int(options.get("offset", 0))
+    if offset == 0:
+        return value
+    if offset > len(value):
+        raise InvalidOffsetException()
+
+    return dbus.Array(value[offset:], signature='y')
+
+
+class StaticCharacteristic(Characteristic):
+    """
+    Characteristic with a fixed value, encoded once and served from the cached array
+    """
+
+    def __init__(self, uuid, value, service, flags=("read",)):
+        Characteristic.__init__(self, uuid, list(flags), service)
+        self.value = to_byte_array(value)
 
     def ReadValue(self, options):
-        return self.value
+        return read_offset(self.value, options)
+
+
+class StaticDescriptor(Descriptor):
+    """
+    Descriptor with a fixed value, encoded once and served from the cached array
+    """
+
+    def __init__(self, uuid, value, characteristic, flags=("read",)):
+        Descriptor.__init__(self, uuid, list(flags), characteristic)
+        self.value = to_byte_array(value)
+
+    def ReadValue(self, options):
+        return read_offset(self.value, options)
+
+
+class CharacteristicUserDescriptionDescriptor(StaticDescriptor):
+    """
+    Characteristic User Description (0x2901), writable when the characteristic
+    has the writable-auxiliaries flag
+    """
+    CUD_UUID = "2901"
+
+    def __init__(self, characteristic, description):
+        self.writable = "writable-auxiliaries" in characteristic.flags
+        flags = ["read", "write"] if self.writable else ["read"]
+        StaticDescriptor.__init__(self, self.CUD_UUID, description, characteristic, flags)
 
     def WriteValue(self, value, options):
         if not self.writable:
             raise NotPermittedException()
-        self.value = value
+
+        self.value = to_byte_array(value)
+
+
+class ClientCharacteristicConfigurationDescriptor(Descriptor):
+    """
+    Client Characteristic Configuration (0x2902) mapped onto StartNotify/StopNotify.
+
+    BlueZ serves its own CCCD for notify and indicate characteristics; this one is
+    for stacks that expose the descriptor to the application instead.
+    """
+    CCCD_UUID = "2902"
+    NOTIFICATION = 0x0001
+    INDICATION = 0x0002
+
+    def __init__(self, characteristic):
+        Descriptor.__init__(self, self.CCCD_UUID, ["read", "write"], characteristic)
+
+    def ReadValue(self, options):
+        if not getattr(self.chrc, "notifying", False):
+            return CCCD_VALUE.pack(0)
+
+        mode = self.INDICATION if "indicate" in self.chrc.flags else self.NOTIFICATION
+        return CCCD_VALUE.pack(mode)
+
+    def WriteValue(self, value, options):
+        if len(value) != CCCD_VALUE.size:
+            raise InvalidValueLengthException()
+
+        if CCCD_VALUE.unpack(bytes(value))[0] & (self.NOTIFICATION | self.INDICATION):
+            self.chrc.StartNotify()
+        else:
+            self.chrc.StopNotify()
+
+
+class PresentationFormatDescriptor(StaticDescriptor):
+    """
+    Characteristic Presentation Format (0x2904): format, exponent, unit, namespace
+    and description, e.g. (FORMAT_SINT16, 0, UNIT_WATT) for a power value in watts
+    """
+    CPF_UUID = "2904"
+
+    def __init__(self, characteristic, value_format, exponent=0, unit=UNIT_UNITLESS,
+                 namespace=NAMESPACE_BLUETOOTH_SIG, description=0):
+        StaticDescriptor.__init__(
+            self, self.CPF_UUID,
+            PRESENTATION_FORMAT.pack(value_format, exponent, unit, namespace, description),
+            characteristic)
@@ -0,0 +1,175 @@
+"""Declarative GATT services.
+
+A schema describes services, characteristics and descriptors as plain data and
+is compiled into the same Service/Characteristic/Descriptor objects the profile
+scripts build by hand:
+
+    {
+        "services": [{
+            "uuid": "0x1809",
+            "characteristics": [{
+                "uuid": "0x2A1C",
+                "flags": ["indicate"],
+                "encoder": "utils.core.hts.encode_temperature_measurement",
+                "channels": {"temperature": "temperature"},
+                "notify_interval": 5000,
+                "descriptors": [{"uuid": "2901", "value": "CPU temperature"}]
+            }, {
+                "uuid": "0x2A21",
+                "flags": ["read"],
+                "value": {"struct": "<H", "values": [5]}
+            }]
+        }]
+    }
+
+Values are a string (UTF-8), a list of byte values, {"hex": "..."} or
+{"struct": fmt, "values": [...]} and are encoded once at compile time.
+Encoders are dotted paths to callables returning the value; they are called with
+"args" plus the latest sensor hub value of each entry in "channels". Writes go to
+the dotted "write" callable as write(characteristic, value, options).
+JSON and TOML files are loaded by extension.
+"""
+import importlib
+import json
+import struct
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from utils.core.samples import sensors
+from utils.gatt.profile import Service, Characteristic, StaticDescriptor, NotSupportedException
+from utils.gatt.profile import to_byte_array, read_offset
+
+DEFAULT_NOTIFY_INTERVAL = 1000
+
+
+def resolve(dotted):
+    # "package.module.attribute" or "package.module:attribute"
+    if ":" in dotted:
+        module, _, attribute = dotted.partition(":")
+    else:
+        module, _, attribute = dotted.rpartition(".")
+
+    return getattr(importlib.import_module(module), attribute)
+
+
+def compile_value(spec):
+    if isinstance(spec, str):
+        return spec.encode("utf-8")
+    if isinstance(spec, (list, tuple, bytes, bytearray)):
+        return bytes(spec)
+    if isinstance(spec, dict) and "hex" in spec:
+        return bytes.fromhex(spec["hex"])
+    if isinstance(spec, dict) and "struct" in spec:
+        return struct.pack(spec["struct"], *spec.get("values", ()))
+
+    raise ValueError("Unsupported static value: %r" % (spec,))
+
+
+def load_schema(source):
+    # A dict is used as is, anything else is a JSON or TOML file name
+    if isinstance(source, dict):
+        return source
+
+    if str(source).endswith(".toml"):
+        if tomllib is None:
+            raise ValueError("TOML schemas need Python 3.11 or later")
+        with open(source, "rb") as f:
+            return tomllib.load(f)
+
+    with open(source) as f:
+        return json.load(f)
+
+
+class SchemaDescriptor(StaticDescriptor):
+    def __init__(self, spec, characteristic):
+        StaticDescriptor.__init__(self, spec["uuid"], compile_value(spec.get("value", b"")),
+                                  characteristic, spec.get("flags", ["read"]))
+
+
+class SchemaCharacteristic(Characteristic):
+    def __init__(self, spec, service):
+        Characteristic.__init__(self, spec["uuid"], spec.get("flags", ["read"]), service)
+        self.notifying = False
+        self.value = to_byte_array(compile_value(spec.get("value", b"")))
+        self.encoder = resolve(spec["encoder"]) if "encoder" in spec else None
+        self.args = dict(spec.get("args", {}))
+        self.channels = dict(spec.get("channels", {}))
+        self.writer = resolve(spec["write"]) if "write" in spec else None
+        self.notify_interval = spec.get("notify_interval", DEFAULT_NOTIFY_INTERVAL)
+
+        change_only = spec.get("change_only")
+        if change_only:
+            options = change_only if isinstance(change_only, dict) else {}
+            self.set_change_only(options.get("keepalive"), options.get("deadbands"))
+
+        for descriptor in spec.get("descriptors", ()):
+            self.add_descriptor(SchemaDescriptor(descriptor, self))
+
+    def get_value(self):
+        if self.encoder is None:
+            return self.value
+
+        kwargs = dict(self.args)
+        for name, channel in self.channels.items():
+            kwargs[name] = sensors.latest(channel)
+
+        return self.encoder(**kwargs)
+
+    def set_value_callback(self):
+        if self.notifying:
+            self.notify_value(self.get_value())
+
+        return self.notifying
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+
+        self.notifying = True
+        self.notify_value(self.get_value(), force=True)
+        if self.encoder is not None and self.notify_interval:
+            self.add_timeout(self.notify_interval, self.set_value_callback)
+
+    def StopNotify(self):
+        self.notifying = False
+        self.remove_timeout()
+
+    def ReadValue(self, options):
+        if self.encoder is None:
+            return read_offset(self.value, options)
+
+        return self.get_value()[int(options.get("offset", 0)):]
+
+    def WriteValue(self, value, options):
+        if self.writer is None:
+            raise NotSupportedException()
+
+        self.writer(self, bytes(value), options)
+
+
+class SchemaService(Service):
+    def __init__(self, index, spec):
+        Service.__init__(self, index, spec["uuid"], spec.get("primary", True))
+        for characteristic in spec.get("characteristics", ()):
+            self.add_characteristic(SchemaCharacteristic(characteristic, self))
+
+
+def compile_schema(source, application=None, index=0):
+    """
+    Build the services of a schema (dict or file name), numbering them from index.
+
+    With an application the services are added to it and its managed objects are
+    built once here, so the first GetManagedObjects from BlueZ is served from cache.
+    """
+    schema = load_schema(source)
+    services = [SchemaService(index + i, spec) for i, spec in enumerate(schema.get("services", ()))]
+
+    if application is not None:
+        for service in services:
+            application.add_service(service)
+        application.GetManagedObjects()
+
+    return services